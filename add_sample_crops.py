@@ -1,4 +1,6 @@
 import sqlite3
+import matching
+from quantities import parse_quantity
 
 # Connect to the database
 conn = sqlite3.connect('agrilink.db')
@@ -25,7 +27,9 @@ sample_crops = [
 ]
 
 # Insert sample crops
-c.executemany("INSERT INTO crops (farmer_id, crop_name, quantity, price, quality, harvest_date, image) VALUES (?, ?, ?, ?, ?, ?, ?)", sample_crops)
+c.executemany("INSERT INTO crops (farmer_id, crop_name, quantity, quantity_value, quantity_unit, price, quality, harvest_date, image) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+              [(farmer_id, name, quantity) + parse_quantity(quantity) + tuple(rest) for farmer_id, name, quantity, *rest in sample_crops])
+matching.rebuild(conn)
 
 # Commit and close
 conn.commit()
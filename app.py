@@ -1,4 +1,3 @@
-import sqlite3
 from flask import Flask, render_template, request, redirect, url_for, session, flash
 from flask_login import login_required, LoginManager, UserMixin, login_user, logout_user, current_user
 from flask_mail import Mail
@@ -11,116 +10,137 @@ from blueprints.auth import auth_bp
 from blueprints.farmer import farmer_bp
 from blueprints.buyer import buyer_bp
 from blueprints.messaging import messaging_bp
-from models import User
+from blueprints.api import api_bp
+import db
+from db import get_db_connection
+from pagination import fetch_page, approximate_count
+import inventory
+import outbox
+import payments
+import stats
+import uploads
+import user_cache
+import page_cache
+import push
+import query_log
+import metrics
+import exports
+import crop_import
+import passwords
+import ratelimit
+import sessions
+import user_purge
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'  # Change this to a secure key
 app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'static', 'uploads')
+app.config['DATABASE'] = os.environ.get('AGRILINK_DATABASE', 'agrilink.db')
+app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('AGRILINK_DB_POOL_SIZE', 8))
+app.config['RESERVATION_TTL'] = int(os.environ.get('AGRILINK_RESERVATION_TTL', inventory.RESERVATION_TTL))
+app.config['RESERVATION_SWEEP_INTERVAL'] = inventory.SWEEP_INTERVAL
+app.config['PAYCHANGU_WEBHOOK_SECRET'] = os.environ.get('PAYCHANGU_WEBHOOK_SECRET')
+app.config['PUSH_FANOUT'] = os.environ.get('AGRILINK_PUSH_FANOUT', 'local')
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('AGRILINK_SLOW_QUERY_MS', query_log.SLOW_QUERY_MS))
+app.config['METRICS_TOKEN'] = os.environ.get('AGRILINK_METRICS_TOKEN')
+app.config['METRICS_DIR'] = os.environ.get('AGRILINK_METRICS_DIR')
+app.config['PASSWORD_WORKERS'] = int(os.environ.get('AGRILINK_PASSWORD_WORKERS', passwords.PASSWORD_WORKERS))
+app.config['RATE_LIMIT_STORE'] = os.environ.get('AGRILINK_RATE_LIMIT_STORE', 'memory')
+app.config['SESSION_BACKEND'] = os.environ.get('AGRILINK_SESSION_BACKEND', 'sqlite')
 
 # --- Email and Password Reset Configuration ---
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', '1') == '1'
 app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME', 'your-email@gmail.com') # Use your email
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD', 'your-gmail-app-password') # Use your App Password
 app.config['MAIL_DEFAULT_SENDER'] = ('AgriLink Malawi', app.config['MAIL_USERNAME'])
 
 # Initialize extensions
 mail = Mail(app)
+
+
+def init_extensions(app):
+    """Migrate the database and start the background workers."""
+    db.init_app(app)
+    query_log.init_app(app)
+    metrics.init_app(app)
+    inventory.start_sweeper(app)
+    outbox.init_app(app)
+    payments.init_app(app)
+    uploads.init_app(app)
+    crop_import.init_app(app)
+    passwords.init_app(app)
+    ratelimit.init_app(app)
+    sessions.init_app(app)
+    user_purge.init_app(app)
+    user_cache.init_app(app)
+    page_cache.init_app(app)
+    push.init_app(app)
+
+
+# The password and image process pools use spawn, whose workers re-import the
+# main module as __mp_main__. When that is this file (python app.py) they
+# must not migrate the database or start a second set of background threads.
+if __name__ != '__mp_main__':
+    init_extensions(app)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'auth.auth' # Use the blueprint name
 
+ADMIN_PER_PAGE = 50
+
 # Register Blueprints
 app.register_blueprint(main_bp)
 app.register_blueprint(auth_bp)
 app.register_blueprint(farmer_bp)
 app.register_blueprint(buyer_bp)
 app.register_blueprint(messaging_bp)
+app.register_blueprint(api_bp)
 
 @login_manager.user_loader
 def load_user(user_id):
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
-    if user:
-        return User(user['id'], user['email'], user['name'], user['role'])
-    return None
-
-def get_db_connection():
-    conn = sqlite3.connect('agrilink.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    return app.extensions['user_cache'].load(get_db_connection(), user_id)
 
 @app.route('/admin/reports')
 @login_required
 def admin_reports():
-    conn = get_db_connection()
-    c = conn.cursor()
-
-    # Get statistics
-    c.execute("SELECT COUNT(*) FROM users")
-    total_users = c.fetchone()[0]
-
-    c.execute("SELECT COUNT(*) FROM crops")
-    total_crops = c.fetchone()[0]
-
-    c.execute("SELECT COUNT(*) FROM demands")
-    total_demands = c.fetchone()[0]
-
-    c.execute("SELECT COUNT(*) FROM messages")
-    total_messages = c.fetchone()[0]
-
-    # Active farmers (with crops)
-    c.execute("SELECT COUNT(DISTINCT farmer_id) FROM crops")
-    active_farmers = c.fetchone()[0]
-
-    # Active buyers (with demands)
-    c.execute("SELECT COUNT(DISTINCT buyer_id) FROM demands")
-    active_buyers = c.fetchone()[0]
-
-    conn.close()
-
+    counters, trends = stats.snapshot(get_db_connection())
+    order_statuses = sorted((name.split(':', 1)[1], value) for name, value in counters.items()
+                            if name.startswith('orders:') and value)
     return render_template('admin_reports.html',
-                         total_users=total_users,
-                         total_crops=total_crops,
-                         total_demands=total_demands,
-                         total_messages=total_messages,
-                         active_farmers=active_farmers,
-                         active_buyers=active_buyers)
+                         total_users=counters.get('users', 0),
+                         total_crops=counters.get('crops', 0),
+                         total_demands=counters.get('demands', 0),
+                         total_messages=counters.get('messages', 0),
+                         active_farmers=counters.get('active_farmers', 0),
+                         active_buyers=counters.get('active_buyers', 0),
+                         order_statuses=order_statuses,
+                         trends=trends)
 
 @app.route('/admin/dashboard')
 @login_required
 def admin_dashboard():
     if current_user.role != 'admin':
-        return redirect(url_for('homepage'))
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM users WHERE role='farmer'")
-    farmers_count_result = c.fetchone()
-    farmers_count = farmers_count_result[0] if farmers_count_result else 0
-    c.execute("SELECT COUNT(*) FROM users WHERE role='buyer'")
-    buyers_count_result = c.fetchone()
-    buyers_count = buyers_count_result[0] if buyers_count_result else 0
-    c.execute("SELECT COUNT(*) FROM orders")
-    total_transactions_result = c.fetchone()
-    total_transactions = total_transactions_result[0] if total_transactions_result else 0
-    conn.close()
-    return render_template('admin dashboard.html', farmers_count=farmers_count, buyers_count=buyers_count, total_transactions=total_transactions)
+        return redirect(url_for('main.homepage'))
+    counters, _ = stats.snapshot(get_db_connection())
+    return render_template('admin dashboard.html',
+                           farmers_count=counters.get('users:farmer', 0),
+                           buyers_count=counters.get('users:buyer', 0),
+                           total_transactions=counters.get('orders', 0))
 
 @app.route('/purchase/<int:crop_id>', methods=['POST'])
 @login_required
 def purchase_crop(crop_id):
     if current_user.role != 'buyer':
         flash('Only buyers can purchase crops.', 'danger')
-        return redirect(url_for('homepage'))
+        return redirect(url_for('main.homepage'))
 
     conn = get_db_connection()
     crop = conn.execute('SELECT * FROM crops WHERE id = ?', (crop_id,)).fetchone()
 
     if not crop:
         flash('Crop not found.', 'danger')
-        conn.close()
         return redirect(url_for('buyer.dashboard'))
 
     # Use .get() to avoid BadRequest errors and provide clearer feedback
@@ -140,21 +160,16 @@ def purchase_crop(crop_id):
             flash('Quantity must be a positive number.', 'danger')
             return redirect(url_for('buyer.dashboard'))
 
-        # Calculate total price
-        total_price = quantity * crop['price']
-        if delivery_option == 'delivery':
-            total_price += 5000  # Add estimated delivery fee
-
-        print(f"DEBUG: Incoming request form data: {request.form}")
-        print(f"DEBUG: Calculated total_price: {total_price}")
+        app.logger.debug('Purchase request for crop %s: %s', crop_id, request.form.to_dict())
 
-        # Insert order into the database first
-        cursor = conn.execute("""
-            INSERT INTO orders (buyer_id, crop_id, quantity, total_price, delivery_option, payment_number, order_status)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (current_user.id, crop_id, quantity, total_price, delivery_option, None, 'pending'))
-        order_id = cursor.lastrowid
-        conn.commit()
+        # Reserve the stock and create the pending order in one transaction
+        try:
+            order_id, total_price = inventory.reserve(conn, crop_id, current_user.id, quantity, delivery_option,
+                                                      app.config['RESERVATION_TTL'])
+        except inventory.InsufficientStock as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('buyer.view_crop', crop_id=crop_id))
+        app.logger.debug('Order %s reserved, total price %s', order_id, total_price)
 
         # Prepare data for the PayChangu Popup
         payment_data = {
@@ -183,8 +198,6 @@ def purchase_crop(crop_id):
         flash(f"An error occurred: Missing form field {e}. Please check the form and try again.", 'danger')
     except Exception as e:
         flash(f'An unexpected error occurred: {e}', 'danger')
-    finally:
-        conn.close()
 
     return redirect(url_for('buyer.dashboard'))
 
@@ -192,21 +205,23 @@ def purchase_crop(crop_id):
 @login_required
 def admin_farmers():
     if current_user.role != 'admin':
-        return redirect(url_for('homepage'))
+        return redirect(url_for('main.homepage'))
     conn = get_db_connection()
-    farmers = conn.execute("SELECT id, name, email FROM users WHERE role = 'farmer'").fetchall()
-    conn.close()
-    return render_template('admin_farmers.html', farmers=farmers)
+    farmers_page = fetch_page(conn, "SELECT id, name, email FROM users", ["role = 'farmer'", "deleted_at IS NULL"], [],
+                              [("id", "id")], request.args, ADMIN_PER_PAGE)
+    farmers_page.total = approximate_count(conn, "SELECT COUNT(*) FROM users WHERE role = 'farmer' AND deleted_at IS NULL")
+    return render_template('admin_farmers.html', farmers=farmers_page.items, pager=farmers_page)
 
 @app.route('/admin/buyers')
 @login_required
 def admin_buyers():
     if current_user.role != 'admin':
-        return redirect(url_for('homepage'))
+        return redirect(url_for('main.homepage'))
     conn = get_db_connection()
-    buyers = conn.execute("SELECT id, name, email FROM users WHERE role = 'buyer'").fetchall()
-    conn.close()
-    return render_template('admin_buyers.html', buyers=buyers)
+    buyers_page = fetch_page(conn, "SELECT id, name, email FROM users", ["role = 'buyer'", "deleted_at IS NULL"], [],
+                             [("id", "id")], request.args, ADMIN_PER_PAGE)
+    buyers_page.total = approximate_count(conn, "SELECT COUNT(*) FROM users WHERE role = 'buyer' AND deleted_at IS NULL")
+    return render_template('admin_buyers.html', buyers=buyers_page.items, pager=buyers_page)
 
 @app.route('/admin/all_orders')
 @login_required
@@ -217,7 +232,7 @@ def admin_all_orders():
         return redirect(url_for('main.homepage'))
 
     conn = get_db_connection()
-    orders = conn.execute("""
+    orders_page = fetch_page(conn, """
         SELECT 
             o.id, o.order_date, o.total_price, o.order_status,
             c.crop_name,
@@ -227,10 +242,32 @@ def admin_all_orders():
         JOIN crops c ON o.crop_id = c.id
         JOIN users b ON o.buyer_id = b.id
         JOIN users f ON c.farmer_id = f.id
-        ORDER BY o.order_date DESC
-    """).fetchall()
-    conn.close()
-    return render_template('admin_all_orders.html', orders=orders)
+    """, [], [], [("o.order_date", "order_date"), ("o.id", "id")], request.args, ADMIN_PER_PAGE)
+    orders_page.total = approximate_count(conn, "SELECT COUNT(*) FROM orders")
+    return render_template('admin_all_orders.html', orders=orders_page.items, pager=orders_page)
+
+@app.route('/admin/all_orders/export')
+@login_required
+def admin_export_orders():
+    """Streams every order matching the date range and status filters as CSV or NDJSON."""
+    if current_user.role != 'admin':
+        flash('You do not have permission to access this page.', 'danger')
+        return redirect(url_for('main.homepage'))
+    try:
+        conditions, params = exports.filters(request.args, 'o.order_date', 'o.order_status')
+        return exports.stream(f"""
+            SELECT o.id, o.order_date, o.order_status, c.crop_name, o.quantity, o.total_price,
+                   o.delivery_option, o.buyer_id, b.name AS buyer_name, c.farmer_id, f.name AS farmer_name
+            FROM orders o
+            JOIN crops c ON o.crop_id = c.id
+            JOIN users b ON o.buyer_id = b.id
+            JOIN users f ON c.farmer_id = f.id
+            {exports.where(conditions)}
+            ORDER BY o.order_date, o.id
+        """, params, request.args.get('format', 'csv'), 'orders')
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('admin_all_orders'))
 
 @app.route('/admin/delete_user/<int:user_id>', methods=['POST'])
 @login_required
@@ -242,23 +279,17 @@ def admin_delete_user(user_id):
 
     conn = get_db_connection()
     try:
-        # To maintain data integrity, we should delete related records first.
-        # This is a basic implementation. For production, consider soft deletes or more robust cascading.
-        conn.execute("DELETE FROM reviews WHERE reviewer_id = ? OR reviewed_user_id = ?", (user_id, user_id))
-        conn.execute("DELETE FROM messages WHERE sender_id = ? OR receiver_id = ?", (user_id, user_id))
-        conn.execute("DELETE FROM orders WHERE buyer_id = ?", (user_id,))
-        conn.execute("DELETE FROM crops WHERE farmer_id = ?", (user_id,))
-        conn.execute("DELETE FROM demands WHERE buyer_id = ?", (user_id,))
-        
-        # Finally, delete the user
-        conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        # Soft delete: the user is signed out and hidden now; user_purge removes
+        # their data in small batches in the background.
+        conn.execute("UPDATE users SET deleted_at = CURRENT_TIMESTAMP WHERE id = ? AND deleted_at IS NULL", (user_id,))
+        sessions.revoke_user(conn, user_id)
         conn.commit()
-        flash(f'User ID {user_id} and all their associated data have been deleted.', 'success')
+        user_cache.invalidate(conn, user_id)
+        user_purge.wake()
+        flash(f'User ID {user_id} has been deleted; their associated data is being removed.', 'success')
     except Exception as e:
         conn.rollback()
         flash(f'An error occurred while deleting the user: {e}', 'danger')
-    finally:
-        conn.close()
 
     # Redirect back to the page the admin came from
     return redirect(request.referrer or url_for('admin_dashboard'))
@@ -268,18 +299,39 @@ def admin_delete_user(user_id):
 def admin_messages():
     """Allows admin to view all messages on the platform."""
     if current_user.role != 'admin':
-        return redirect(url_for('homepage'))
+        return redirect(url_for('main.homepage'))
     
     conn = get_db_connection()
-    messages = conn.execute("""
-        SELECT m.id, m.message, m.sent_at, s.name as sender_name, r.name as receiver_name 
+    messages_page = fetch_page(conn, """
+        SELECT m.id, m.message, m.subject, m.sent_at, m.sender_contact,
+               COALESCE(s.name, m.sender_name) as sender_name, r.name as receiver_name
         FROM messages m
-        JOIN users s ON m.sender_id = s.id
-        JOIN users r ON m.receiver_id = r.id
-        ORDER BY m.sent_at DESC
-    """).fetchall()
-    conn.close()
-    return render_template('admin_messages.html', messages=messages)
+        LEFT JOIN users s ON m.sender_id = s.id
+        LEFT JOIN users r ON m.receiver_id = r.id
+    """, [], [], [("m.sent_at", "sent_at"), ("m.id", "id")], request.args, ADMIN_PER_PAGE)
+    messages_page.total = approximate_count(conn, "SELECT COUNT(*) FROM messages")
+    return render_template('admin_messages.html', messages=messages_page.items, pager=messages_page)
+
+@app.route('/admin/messages/export')
+@login_required
+def admin_export_messages():
+    """Streams every message in the date range as CSV or NDJSON."""
+    if current_user.role != 'admin':
+        return redirect(url_for('main.homepage'))
+    try:
+        conditions, params = exports.filters(request.args, 'm.sent_at')
+        return exports.stream(f"""
+            SELECT m.id, m.sent_at, m.conversation_id, m.sender_id, COALESCE(s.name, m.sender_name) AS sender_name,
+                   m.sender_contact, m.receiver_id, r.name AS receiver_name, m.subject, m.message
+            FROM messages m
+            LEFT JOIN users s ON m.sender_id = s.id
+            LEFT JOIN users r ON m.receiver_id = r.id
+            {exports.where(conditions)}
+            ORDER BY m.sent_at, m.id
+        """, params, request.args.get('format', 'csv'), 'messages')
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('admin_messages'))
 
 @app.route('/admin/settings')
 def admin_settings():
@@ -304,40 +356,39 @@ def payment_confirmation():
 
 @app.route('/payment/webhook', methods=['POST'])
 def payment_webhook():
-    """Handle PayChangu payment callback"""
-    try:
-        callback_data = request.get_json()
-        print(f"DEBUG: Received webhook data: {callback_data}")
-
-        # Extract transaction reference and status
-        tx_ref = callback_data.get('data', {}).get('tx_ref')
-        status = callback_data.get('status')
-
-        if not tx_ref:
-            print("Webhook error: tx_ref not found in payload")
-            return {'status': 'error', 'message': 'tx_ref not found'}, 400
-
-        # Extract order_id from tx_ref (e.g., 'agri_order_123')
-        try:
-            order_id = int(tx_ref.split('_')[-1])
-        except (ValueError, IndexError):
-            print(f"Webhook error: Could not parse order_id from tx_ref: {tx_ref}")
-            return {'status': 'error', 'message': 'Invalid tx_ref format'}, 400
+    """Handle PayChangu payment callback.
 
-        # Verify the callback (in production, you should verify the signature)
-        if status == 'success':
-            conn = get_db_connection()
-            # Update order status to paid
-            conn.execute("UPDATE orders SET order_status = 'paid' WHERE id = ?", (order_id,))
-            conn.commit()
-            conn.close()
-            print(f"SUCCESS: Order {order_id} status updated to 'paid'.")
+    Callbacks are deduplicated by provider transaction id and group-committed
+    by payments.GroupCommitter, so provider retries and bursts are safe.
+    """
+    if not payments.verify_signature(app.config['PAYCHANGU_WEBHOOK_SECRET'], request.get_data(),
+                                     request.headers.get('Signature')):
+        app.logger.warning('Payment webhook rejected: bad signature')
+        return {'status': 'error', 'message': 'Invalid signature'}, 401
 
-        return {'status': 'success'}, 200
+    try:
+        event = payments.parse_event(request.get_json(silent=True))
+    except payments.InvalidEvent as e:
+        app.logger.warning('Payment webhook rejected: %s', e)
+        return {'status': 'error', 'message': str(e)}, 400
 
-    except Exception as e:
-        print(f"Payment webhook processing error: {e}")
-        return {'status': 'error'}, 400
+    try:
+        outcome = app.extensions['payment_webhooks'].submit(event)
+    except Exception:
+        # Let the provider retry; the event log makes the retry idempotent.
+        app.logger.exception('Payment webhook processing error for %s', event['tx_ref'])
+        return {'status': 'error'}, 503
+
+    app.logger.info('Payment webhook %s for order %s: %s', event['transaction_id'], event['order_id'], outcome)
+    if outcome == payments.APPLIED:
+        order = get_db_connection().execute(
+            "SELECT o.buyer_id, o.order_status, c.farmer_id FROM orders o JOIN crops c ON o.crop_id = c.id WHERE o.id = ?",
+            (event['order_id'],)).fetchone()
+        if order:
+            update = {'order_id': event['order_id'], 'status': order['order_status']}
+            push.notify(order['buyer_id'], 'order_status', update)
+            push.notify(order['farmer_id'], 'order_status', update)
+    return {'status': 'success', 'outcome': outcome}, 200
 
 @app.route('/about-us', methods=['GET', 'POST'])
 def about_us():
@@ -360,7 +411,6 @@ def about_us():
                 VALUES (?, ?, ?, ?, ?)
             """, (admin_receiver_id, sender_name, sender_contact, 'Contact Form Submission', message_text))
             conn.commit()
-            conn.close()
             flash('Thank you for your message! We will get back to you soon.', 'success')
         except Exception as e:
             flash(f'An error occurred: {e}', 'danger')
@@ -0,0 +1,260 @@
+"""Deterministic synthetic data at production scale.
+
+Creates a fresh database and bulk-loads users, crops, demands, orders,
+messages and reviews with ``executemany`` in large transactions. Activity is
+skewed the way a marketplace is: a few farmers own most listings, maize and
+the big districts dominate, popular listings get most orders, and recent
+days are busier than old ones. The same seed always produces the same rows
+(timestamps are relative to the day it runs).
+
+Every generated user's password is ``password``; emails look like
+``farmer17@example.com`` / ``buyer42@example.com``. The admin is
+``admin@agrilink.com`` / ``adminpassword`` as in init_db.py.
+
+Counters, conversation threads and match lists are rebuilt once at the end
+rather than row by row.
+
+Usage: python benchmarks/generate_data.py [loadtest.db] [--users 1000000 --crops 5000000 ...]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+import conversations  # noqa: E402
+import matching  # noqa: E402
+import stats  # noqa: E402
+from db import connect  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+PASSWORD = 'password'
+FARMER_SHARE = 0.4
+HISTORY_DAYS = 365
+
+CROPS = [('Maize', 30), ('Groundnuts', 10), ('Soybeans', 9), ('Rice', 7), ('Beans', 7), ('Tobacco', 6),
+         ('Irish Potatoes', 5), ('Sweet Potatoes', 5), ('Cassava', 5), ('Pigeon Peas', 4), ('Tomatoes', 4),
+         ('Onions', 3), ('Cabbage', 3), ('Bananas', 3), ('Cotton', 2), ('Tea', 2), ('Coffee', 2), ('Sorghum', 2),
+         ('Millet', 2), ('Sugarcane', 2), ('Sunflower', 2), ('Macadamia', 1), ('Paprika', 1), ('Mangoes', 1)]
+LOCATIONS = [('Lilongwe', 18), ('Blantyre', 14), ('Mzimba', 8), ('Zomba', 7), ('Kasungu', 6), ('Mangochi', 5),
+             ('Dedza', 5), ('Mchinji', 4), ('Dowa', 4), ('Salima', 3), ('Ntcheu', 3), ('Thyolo', 3), ('Mulanje', 3),
+             ('Machinga', 3), ('Karonga', 2), ('Nkhotakota', 2), ('Balaka', 2), ('Chikwawa', 2), ('Rumphi', 2),
+             ('Ntchisi', 1), ('Chiradzulu', 1), ('Phalombe', 1), ('Mwanza', 1), ('Neno', 1), ('Nsanje', 1),
+             ('Chitipa', 1), ('Likoma', 1)]
+QUALITIES = [('Grade A', 4), ('Grade B', 3), ('Premium', 2), ('Organic', 1), ('Fresh', 2), ('', 2)]
+ORDER_STATUSES = [('Delivered', 55), ('paid', 15), ('Shipped', 10), ('pending', 10), ('Cancelled', 7), ('expired', 3)]
+KG = [50, 100, 200, 250, 500, 1000, 2000, 5000]
+
+
+def weighted(pairs):
+    values, weights = zip(*pairs)
+    return list(values), list(weights)
+
+
+class Generator:
+
+    def __init__(self, conn, seed, batch):
+        self.conn = conn
+        self.rng = random.Random(seed)
+        self.batch = batch
+        self.now = datetime.now(timezone.utc).replace(microsecond=0, tzinfo=None)
+        self.farmers = array('i')
+        self.buyers = array('i')
+        self.crop_farmer = array('i')
+        self.crop_price = array('d')
+        self.crop_names, self.crop_weights = weighted(CROPS)
+        self.locations, self.location_weights = weighted(LOCATIONS)
+        self.qualities, self.quality_weights = weighted(QUALITIES)
+        self.statuses, self.status_weights = weighted(ORDER_STATUSES)
+
+    def skewed(self, items, power=2.5):
+        """Pick from ``items``, heavily favouring the front of the list."""
+        return items[int(len(items) * self.rng.random() ** power)]
+
+    def timestamp(self):
+        """A time in the last HISTORY_DAYS, busier towards today."""
+        age = timedelta(seconds=int(HISTORY_DAYS * 86400 * self.rng.random() ** 2))
+        return (self.now - age).strftime('%Y-%m-%d %H:%M:%S')
+
+    def choice(self, values, weights):
+        return self.rng.choices(values, weights)[0]
+
+    def load(self, label, total, sql, make_row):
+        """Insert ``total`` rows from ``make_row(i)``, one transaction per batch."""
+        started = time.perf_counter()
+        for start in range(0, total, self.batch):
+            rows = [make_row(i) for i in range(start, min(start + self.batch, total))]
+            self.conn.execute('BEGIN')
+            self.conn.executemany(sql, rows)
+            self.conn.commit()
+        elapsed = time.perf_counter() - started
+        print(f"{label:<9} {total:>9} rows in {elapsed:7.1f}s ({total / max(elapsed, 1e-9):,.0f}/s)")
+
+    def users(self, total):
+        password = generate_password_hash(PASSWORD)
+        first_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM users").fetchone()[0]
+        roles = ['farmer' if self.rng.random() < FARMER_SHARE else 'buyer' for _ in range(total)]
+        for i, role in enumerate(roles):
+            (self.farmers if role == 'farmer' else self.buyers).append(first_id + i)
+
+        def row(i):
+            role = roles[i]
+            return (f'{role.title()} {first_id + i}', f'{role}{first_id + i}@example.com', password, role,
+                    f'+2659{first_id + i:08d}', self.timestamp())
+        self.load('users', total,
+                  'INSERT INTO users (name, email, password, role, phone_number, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                  row)
+
+    def crops(self, total):
+        first_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM crops").fetchone()[0]
+        assert first_id == 1, 'generate into a fresh database'
+
+        def row(i):
+            farmer_id = self.skewed(self.farmers)
+            kg = self.rng.choice(KG)
+            price = float(self.rng.randint(40, 900))
+            self.crop_farmer.append(farmer_id)
+            self.crop_price.append(price)
+            return (farmer_id, self.choice(self.crop_names, self.crop_weights), f'{kg}kg', kg, 'kg', price,
+                    self.choice(self.qualities, self.quality_weights) or None, self.rng.choice('ABC'),
+                    self.timestamp()[:10], self.choice(self.locations, self.location_weights), self.timestamp())
+        self.load('crops', total,
+                  'INSERT INTO crops (farmer_id, crop_name, quantity, quantity_value, quantity_unit, price, quality, '
+                  'crop_grade, harvest_date, location, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                  row)
+
+    def demands(self, total):
+        def row(i):
+            kg = self.rng.choice(KG)
+            return (self.skewed(self.buyers), self.choice(self.crop_names, self.crop_weights), f'{kg}kg', kg, 'kg',
+                    self.choice(self.locations, self.location_weights),
+                    self.choice(self.qualities, self.quality_weights) or None,
+                    'Looking for a reliable supplier.', self.timestamp())
+        self.load('demands', total,
+                  'INSERT INTO demands (buyer_id, crop_name, quantity, quantity_value, quantity_unit, location, quality, '
+                  'message, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                  row)
+
+    def orders(self, total):
+        self.delivered = array('i')
+        crop_ids = range(len(self.crop_farmer), 0, -1)  # newest listings get the most orders
+
+        def row(i):
+            crop_id = self.skewed(crop_ids, 3)
+            quantity = float(self.rng.choice([5, 10, 20, 50, 100]))
+            status = self.choice(self.statuses, self.status_weights)
+            if status == 'Delivered':
+                self.delivered.append(i + 1)
+            return (self.skewed(self.buyers), crop_id, quantity, quantity * self.crop_price[crop_id - 1],
+                    self.rng.choice(['pickup', 'delivery']), f'09{self.rng.randint(10000000, 99999999)}',
+                    status, self.timestamp())
+        self.load('orders', total,
+                  'INSERT INTO orders (buyer_id, crop_id, quantity, total_price, delivery_option, payment_number, '
+                  'order_status, order_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                  row)
+
+    def messages(self, total):
+        def row(i):
+            crop_id = self.skewed(range(1, len(self.crop_farmer) + 1))
+            buyer_id, farmer_id = self.skewed(self.buyers), self.crop_farmer[crop_id - 1]
+            sender, receiver = (buyer_id, farmer_id) if self.rng.random() < 0.6 else (farmer_id, buyer_id)
+            return (sender, receiver, crop_id, f'User {sender}', 'About your listing',
+                    'Is this still available? What is your best price for a larger order?', self.timestamp())
+        self.load('messages', total,
+                  'INSERT INTO messages (sender_id, receiver_id, crop_id, sender_name, subject, message, sent_at) '
+                  'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                  row)
+
+    def reviews(self, total):
+        picked = self.rng.sample(range(len(self.delivered)), min(total, len(self.delivered)))
+        ratings = [5, 4, 3, 2, 1]
+        # Order details are looked up in the database rather than kept in memory.
+        self.conn.execute('CREATE TEMP TABLE review_orders (order_id INTEGER PRIMARY KEY)')
+        self.conn.executemany('INSERT INTO review_orders VALUES (?)', ((self.delivered[i],) for i in picked))
+        rows = self.conn.execute("""
+            SELECT o.id, o.buyer_id, c.farmer_id FROM review_orders r
+            JOIN orders o ON o.id = r.order_id JOIN crops c ON c.id = o.crop_id
+        """).fetchall()
+        self.conn.execute('DROP TABLE review_orders')
+
+        def row(i):
+            order_id, buyer_id, farmer_id = rows[i]
+            return (order_id, buyer_id, farmer_id, self.rng.choices(ratings, [50, 25, 12, 6, 7])[0],
+                    'Good quality, delivered on time.', self.timestamp())
+        self.load('reviews', len(rows),
+                  'INSERT INTO reviews (order_id, reviewer_id, reviewed_user_id, rating, comment, created_at) '
+                  'VALUES (?, ?, ?, ?, ?, ?)',
+                  row)
+
+
+def derived(conn, with_matching):
+    """Rebuild everything the triggers and save paths would have maintained row by row."""
+    steps = [('counters', stats.rebuild), ('threads', conversations.rebuild)]
+    if with_matching:
+        steps.append(('matches', matching.rebuild))
+    for label, step in steps:
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        step(conn)
+        conn.commit()
+        print(f"{label:<9} rebuilt in {time.perf_counter() - started:7.1f}s")
+    started = time.perf_counter()
+    conn.execute("INSERT INTO crops_fts (crops_fts) VALUES ('optimize')")
+    conn.execute("INSERT INTO demands_fts (demands_fts) VALUES ('optimize')")
+    conn.execute('ANALYZE')
+    conn.commit()
+    print(f"{'analyze':<9} done in {time.perf_counter() - started:7.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('database', nargs='?', default='loadtest.db')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--crops', type=int, default=100000)
+    parser.add_argument('--demands', type=int, default=100000)
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--reviews', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch', type=int, default=50000, help='rows per transaction')
+    parser.add_argument('--no-matching', action='store_true', help='skip the match list rebuild (slow above ~1M rows)')
+    parser.add_argument('--force', action='store_true', help='replace an existing database')
+    args = parser.parse_args()
+
+    if os.path.exists(args.database):
+        if not args.force:
+            sys.exit(f'{args.database} exists; pass --force to replace it.')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.database + suffix):
+                os.remove(args.database + suffix)
+
+    conn = connect(args.database)
+    conn.isolation_level = None  # explicit BEGIN/COMMIT per batch
+    migrate(conn)
+    conn.execute("INSERT INTO users (name, email, password, role) VALUES (?, ?, ?, ?)",
+                 ('Admin User', 'admin@agrilink.com', generate_password_hash('adminpassword'), 'admin'))
+    # Durability is pointless while bulk-loading a throwaway database.
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -262144')
+
+    started = time.perf_counter()
+    generator = Generator(conn, args.seed, args.batch)
+    generator.users(args.users)
+    generator.crops(args.crops)
+    generator.demands(args.demands)
+    generator.orders(args.orders)
+    generator.messages(args.messages)
+    generator.reviews(args.reviews)
+    derived(conn, not args.no_matching)
+    conn.close()
+    print(f"{args.database} ready in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
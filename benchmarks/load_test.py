@@ -0,0 +1,236 @@
+"""Load test that drives the real routes against a generated database.
+
+Each worker thread logs in as its own buyer and farmer from a database made
+by generate_data.py, then loops over a weighted mix of requests: the
+homepage, both dashboards, search, a listing page, a purchase and the
+payment webhook for the order it just placed. Afterwards it reports
+throughput and p50/p95/p99 latency per endpoint.
+
+Two transports:
+
+* ``--mode client`` (default) calls the app in-process through Flask's test
+  client; measures the application and database without any network.
+* ``--mode server`` serves the app from a threaded local WSGI server and
+  talks HTTP to it, adding request parsing and socket overhead.
+
+Usage: python benchmarks/load_test.py loadtest.db [--threads 8] [--duration 30] [--mode client|server]
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_data import CROPS, PASSWORD  # noqa: E402
+
+# endpoint -> relative weight in the request mix
+MIX = {
+    'homepage': 10,
+    'buyer_dashboard': 20,
+    'search': 15,
+    'farmer_dashboard': 15,
+    'view_crop': 20,
+    'messages': 5,
+    'purchase': 8,
+    'webhook': 7,
+}
+TX_REF = re.compile(rb'agri_order_(\d+)')
+
+
+class ClientSession:
+    """One logged-in user talking to the app through the test client."""
+
+    def __init__(self, app, base_url=None):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None, json_body=None, headers=None):
+        response = self.client.open(path, method=method, data=data, json=json_body, headers=headers)
+        return response.status_code, response.get_data()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpSession:
+    """One logged-in user talking HTTP to a local server."""
+
+    def __init__(self, app, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect)
+
+    def request(self, method, path, data=None, json_body=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif isinstance(data, bytes):
+            body = data
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode()
+        request = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with self.opener.open(request, timeout=60) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+class Worker:
+
+    def __init__(self, app, session_class, base_url, buyer_email, farmer_email, crop_count, seed):
+        self.app = app
+        self.rng = random.Random(seed)
+        self.buyer = session_class(app, base_url)
+        self.farmer = session_class(app, base_url)
+        self.anonymous = session_class(app, base_url)
+        self.buyer.request('POST', '/auth', data={'email': buyer_email, 'password': PASSWORD})
+        self.farmer.request('POST', '/auth', data={'email': farmer_email, 'password': PASSWORD})
+        self.crop_count = crop_count
+        self.orders = []
+        self.samples = {name: [] for name in MIX}
+        self.errors = {name: 0 for name in MIX}
+
+    def crop_id(self):
+        # Browsing follows the same skew as the data: newest listings are hottest.
+        return self.crop_count - int(self.crop_count * self.rng.random() ** 2)
+
+    def homepage(self):
+        return self.anonymous.request('GET', '/')
+
+    def buyer_dashboard(self):
+        return self.buyer.request('GET', '/buyer/dashboard')
+
+    def search(self):
+        query = urllib.parse.quote(self.rng.choice(CROPS)[0].split()[0].lower())
+        return self.buyer.request('GET', f'/buyer/dashboard?search_query={query}')
+
+    def farmer_dashboard(self):
+        return self.farmer.request('GET', '/farmer/dashboard')
+
+    def view_crop(self):
+        return self.buyer.request('GET', f'/buyer/crop/{self.crop_id()}')
+
+    def messages(self):
+        return self.buyer.request('GET', '/messaging/')
+
+    def purchase(self):
+        status, body = self.buyer.request('POST', f'/purchase/{self.crop_id()}', data={
+            'quantity': str(self.rng.choice([1, 2, 5])), 'deliveryOption': 'pickup', 'network': 'airtel'})
+        match = TX_REF.search(body)
+        if match:
+            self.orders.append(int(match.group(1)))
+        return status, body
+
+    def webhook(self):
+        if not self.orders:
+            return self.purchase()
+        order_id = self.orders.pop()
+        payload = json.dumps({'status': 'success', 'data': {'tx_ref': f'agri_order_{order_id}',
+                                                            'reference': f'LOAD-{order_id}'}}).encode()
+        headers = {'Content-Type': 'application/json'}
+        secret = self.app.config.get('PAYCHANGU_WEBHOOK_SECRET')
+        if secret:
+            headers['Signature'] = hmac.new(secret.encode(), payload, hashlib.sha256).hexdigest()
+        return self.anonymous.request('POST', '/payment/webhook', data=payload, headers=headers)
+
+    def run(self, deadline):
+        names, weights = list(MIX), list(MIX.values())
+        while time.perf_counter() < deadline:
+            name = self.rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                status, _ = getattr(self, name)()
+            except Exception:
+                status = 599
+            self.samples[name].append((time.perf_counter() - started) * 1000)
+            if status >= 500:
+                self.errors[name] += 1
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def report(workers, elapsed):
+    print(f"{'endpoint':<18} {'requests':>8} {'errors':>6} {'req/s':>8} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    total = errors = 0
+    for name in MIX:
+        samples = sorted(s for w in workers for s in w.samples[name])
+        failed = sum(w.errors[name] for w in workers)
+        total, errors = total + len(samples), errors + failed
+        if not samples:
+            continue
+        print(f"{name:<18} {len(samples):>8} {failed:>6} {len(samples) / elapsed:>8.1f} "
+              f"{statistics.mean(samples):>6.1f}ms {percentile(samples, .5):>6.1f}ms "
+              f"{percentile(samples, .95):>6.1f}ms {percentile(samples, .99):>6.1f}ms")
+    print(f"{'total':<18} {total:>8} {errors:>6} {total / elapsed:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('database', help='a database made by generate_data.py')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--mode', choices=['client', 'server'], default='client')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ['AGRILINK_DATABASE'] = os.path.abspath(args.database)
+    from app import app
+    from db import connect
+    app.config['MAIL_SUPPRESS_SEND'] = True
+
+    conn = connect(args.database)
+    rng = random.Random(args.seed)
+    buyers = [r[0] for r in conn.execute("SELECT email FROM users WHERE role = 'buyer' AND email LIKE '%@example.com'")]
+    farmers = [r[0] for r in conn.execute("SELECT email FROM users WHERE role = 'farmer' AND email LIKE '%@example.com'")]
+    crop_count = conn.execute('SELECT MAX(id) FROM crops').fetchone()[0]
+    conn.close()
+    if not buyers or not farmers or not crop_count:
+        sys.exit('No generated users or crops found; run benchmarks/generate_data.py first.')
+
+    base_url = None
+    session_class = ClientSession
+    if args.mode == 'server':
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)  # no per-request access log
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+        session_class = HttpSession
+
+    workers = [Worker(app, session_class, base_url, rng.choice(buyers), rng.choice(farmers), crop_count, args.seed + i)
+               for i in range(args.threads)]
+    print(f"{args.threads} workers, {args.mode} mode, {args.duration:g}s against {args.database}")
+
+    deadline = time.perf_counter() + args.duration
+    started = time.perf_counter()
+    threads = [threading.Thread(target=w.run, args=(deadline,)) for w in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    report(workers, elapsed)
+
+
+if __name__ == '__main__':
+    main()
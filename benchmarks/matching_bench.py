@@ -0,0 +1,143 @@
+"""Benchmark for matching.py at marketplace scale.
+
+Fills a fresh database with synthetic crops and demands (default 100k of
+each, spread over 30 crop names and 28 districts), then measures:
+
+* a full ``matching.rebuild()`` (the migration backfill),
+* incremental ``index_crop()`` / ``index_demand()`` on save, as the routes call them,
+* the dashboard reads ``matches_for_farmer()`` / ``matches_for_buyer()``,
+* and, for comparison, the request-time join the precomputed lists replace.
+
+Usage: python benchmarks/matching_bench.py [crops] [demands] [samples]
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import matching  # noqa: E402
+from db import connect  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+FARMERS = 5000
+BUYERS = 5000
+NAMES = ['Maize', 'Corn', 'Rice', 'Groundnuts', 'Peanuts', 'Soybeans', 'Soya', 'Beans', 'Irish Potatoes',
+         'Sweet Potatoes', 'Cassava', 'Tobacco', 'Tea', 'Coffee', 'Cotton', 'Wheat', 'Sorghum', 'Millet',
+         'Pigeon Peas', 'Cowpeas', 'Tomatoes', 'Onions', 'Cabbage', 'Bananas', 'Mangoes', 'Pineapples',
+         'Sugarcane', 'Sunflower', 'Macadamia', 'Paprika']
+LOCATIONS = ['Balaka', 'Blantyre', 'Chikwawa', 'Chiradzulu', 'Chitipa', 'Dedza', 'Dowa', 'Karonga', 'Kasungu',
+             'Likoma', 'Lilongwe', 'Machinga', 'Mangochi', 'Mchinji', 'Mulanje', 'Mwanza', 'Mzimba', 'Neno',
+             'Nkhotakota', 'Nsanje', 'Ntcheu', 'Ntchisi', 'Phalombe', 'Rumphi', 'Salima', 'Thyolo', 'Zomba']
+QUALITIES = ['Grade A', 'Grade B', 'Premium', 'Organic', 'Fresh', None]
+
+
+def crop_row(rng):
+    kg = rng.choice([50, 100, 250, 500, 1000, 2500])
+    return (rng.randint(1, FARMERS), rng.choice(NAMES), f'{kg}kg', kg, 'kg', rng.randint(50, 800),
+            rng.choice(QUALITIES), rng.choice(LOCATIONS))
+
+
+def demand_row(rng):
+    kg = rng.choice([100, 500, 1000, 5000])
+    return (FARMERS + rng.randint(1, BUYERS), rng.choice(NAMES), f'{kg}kg', kg, 'kg',
+            rng.choice(LOCATIONS), rng.choice(QUALITIES))
+
+
+def insert_crop(conn, row):
+    return conn.execute('INSERT INTO crops (farmer_id, crop_name, quantity, quantity_value, quantity_unit, price, quality, location) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', row).lastrowid
+
+
+def insert_demand(conn, row):
+    return conn.execute('INSERT INTO demands (buyer_id, crop_name, quantity, quantity_value, quantity_unit, location, quality) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)', row).lastrowid
+
+
+def setup(database, crops, demands, rng):
+    conn = connect(database)
+    migrate(conn)
+    conn.executemany("INSERT INTO users (name, email, password, role) VALUES (?, ?, 'x', ?)",
+                     [(f'Farmer {i}', f'f{i}@example.com', 'farmer') for i in range(1, FARMERS + 1)] +
+                     [(f'Buyer {i}', f'b{i}@example.com', 'buyer') for i in range(1, BUYERS + 1)])
+    for _ in range(crops):
+        insert_crop(conn, crop_row(rng))
+    for _ in range(demands):
+        insert_demand(conn, demand_row(rng))
+    conn.commit()
+    return conn
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return (time.perf_counter() - started) * 1000, result
+
+
+def report(label, samples):
+    samples = sorted(samples)
+    p = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]  # noqa: E731
+    print(f"{label:<34} n={len(samples):<5} mean {statistics.mean(samples):7.2f}ms  "
+          f"p50 {p(0.50):7.2f}ms  p95 {p(0.95):7.2f}ms  p99 {p(0.99):7.2f}ms")
+
+
+def main():
+    args = [int(a) for a in sys.argv[1:4]]
+    crops, demands, samples = args + [100000, 100000, 500][len(args):]
+    rng = random.Random(42)
+    database = os.path.join(tempfile.mkdtemp(), 'matching.db')
+
+    started = time.perf_counter()
+    conn = setup(database, crops, demands, rng)
+    print(f"{crops} crops and {demands} demands inserted in {time.perf_counter() - started:.1f}s")
+
+    conn.execute('BEGIN IMMEDIATE')
+    elapsed, indexed = timed(matching.rebuild, conn)
+    conn.commit()
+    lists = conn.execute('SELECT (SELECT COUNT(*) FROM crop_matches), (SELECT COUNT(*) FROM demand_matches)').fetchone()
+    print(f"rebuild: {indexed} rows in {elapsed / 1000:.1f}s, {lists[0]} crop and {lists[1]} demand match entries")
+
+    # Saving a listing or demand: insert + index + commit, as in the routes.
+    insert_times, crop_times, demand_times = [], [], []
+    for _ in range(samples):
+        row = crop_row(rng)
+        elapsed_insert, crop_id = timed(insert_crop, conn, row)
+        elapsed, _ = timed(matching.index_crop, conn, crop_id)
+        conn.commit()
+        insert_times.append(elapsed_insert)
+        crop_times.append(elapsed)
+        demand_id = insert_demand(conn, demand_row(rng))
+        elapsed, _ = timed(matching.index_demand, conn, demand_id)
+        conn.commit()
+        demand_times.append(elapsed)
+    report('insert crop (no matching)', insert_times)
+    report('index_crop', crop_times)
+    report('index_demand', demand_times)
+
+    farmer_times = [timed(matching.matches_for_farmer, conn, rng.randint(1, FARMERS))[0] for _ in range(samples)]
+    buyer_times = [timed(matching.matches_for_buyer, conn, FARMERS + rng.randint(1, BUYERS))[0] for _ in range(samples)]
+    report('farmer dashboard matches', farmer_times)
+    report('buyer dashboard matches', buyer_times)
+
+    # What the dashboard would cost without the precomputed lists.
+    cross_join = """
+        SELECT d.id, MAX(1 + 0.5 * (d.location = c.location) + 0.25 * (d.quality = c.quality)) AS score
+        FROM crops c JOIN demands d ON d.match_name = c.match_name
+        WHERE c.farmer_id = ? GROUP BY d.id ORDER BY score DESC, d.id DESC LIMIT 6
+    """
+    join_times = [timed(lambda farmer_id: conn.execute(cross_join, (farmer_id,)).fetchall(), rng.randint(1, FARMERS))[0]
+                  for _ in range(max(samples // 20, 5))]
+    report('farmer dashboard, request-time join', join_times)
+
+    worst = conn.execute('SELECT MAX(n) FROM (SELECT COUNT(*) AS n FROM crop_matches GROUP BY crop_id '
+                         'UNION ALL SELECT COUNT(*) FROM demand_matches GROUP BY demand_id)').fetchone()[0]
+    assert worst <= matching.TOP_K, f'a match list grew to {worst} entries'
+    conn.close()
+    print(f'OK: every match list holds at most {matching.TOP_K} entries')
+
+
+if __name__ == '__main__':
+    main()
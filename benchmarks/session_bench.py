@@ -0,0 +1,92 @@
+"""Benchmark cookie sessions against the server-side session store.
+
+Signs a buyer in under each backend, then reports the size of the session
+cookie the browser sends back on every request, the time to open and save
+the session alone (unchanged, and with a flash message written), and the
+time for a whole page request that reads the session (the homepage).
+
+Usage: python benchmarks/session_bench.py [requests]
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def report(label, samples):
+    samples = sorted(samples)
+    p = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]  # noqa: E731
+    print(f"  {label:<30} n={len(samples):<5} mean {statistics.mean(samples):7.3f}ms  "
+          f"p50 {p(0.50):7.3f}ms  p95 {p(0.95):7.3f}ms")
+
+
+def timed_session(app, cookie, modify, requests):
+    from flask import request
+
+    interface = app.session_interface
+    samples = []
+    for _ in range(requests):
+        with app.test_request_context('/', headers={'Cookie': cookie}):
+            response = app.response_class()
+            started = time.perf_counter()
+            session = interface.open_session(app, request)
+            session.get('_user_id')
+            if modify:
+                session['_flashes'] = [('info', 'Saved.')]
+            interface.save_session(app, session, response)
+            samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def run(app, label, interface, requests):
+    app.session_interface = interface
+    print(label)
+    client = app.test_client()
+    client.post('/auth', data={'email': 'bench@example.com', 'password': 'bench-password'})
+    cookie = client.get_cookie(app.config['SESSION_COOKIE_NAME'])
+    assert cookie is not None, 'sign-in failed'
+    header = f"{cookie.key}={cookie.value}"
+    print(f"  session cookie: {len(header)} bytes")
+
+    report('open + save, unchanged', timed_session(app, header, False, requests))
+    report('open + save, flash written', timed_session(app, header, True, requests))
+    page_times = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = client.get('/')
+        page_times.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200
+    report('GET / (whole request)', page_times)
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    work = tempfile.mkdtemp()
+    os.environ['AGRILINK_DATABASE'] = os.path.join(work, 'sessions.db')
+    os.chdir(work)
+    from flask.sessions import SecureCookieSessionInterface
+    from werkzeug.security import generate_password_hash
+
+    from app import app
+    from db import connect
+
+    conn = connect(app.config['DATABASE'])
+    conn.execute("INSERT INTO users (name, email, password, role, profile_pic) VALUES (?, ?, ?, 'buyer', ?)",
+                 ('Benchmark Buyer With A Fairly Long Display Name', 'bench@example.com',
+                  generate_password_hash('bench-password'), 'c0ffee' * 5 + 'ab.jpg'))
+    conn.commit()
+    conn.close()
+
+    server_side = app.extensions.get('sessions')
+    assert server_side is not None, 'set AGRILINK_SESSION_BACKEND=sqlite (the default)'
+    run(app, 'cookie sessions (signed cookie)', SecureCookieSessionInterface(), requests)
+    run(app, 'server-side sessions (SQLite + LRU)', server_side, requests)
+    print(f"  session LRU: {server_side.hits} hits, {server_side.misses} misses")
+
+
+if __name__ == '__main__':
+    main()
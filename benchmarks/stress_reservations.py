@@ -0,0 +1,107 @@
+"""Stress test for inventory.reserve(): many concurrent buyers, one listing.
+
+Spawns several processes, each with a few threads and its own connections,
+that all try to buy from the same crop at once. Afterwards it checks that
+the stock never went negative, that the remaining stock plus every reserved
+order adds up to the starting stock, and that sweeping expired reservations
+returns their stock.
+
+Usage: python benchmarks/stress_reservations.py [processes] [threads] [attempts]
+"""
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inventory  # noqa: E402
+from db import connect  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+START_STOCK = 1000.0
+
+
+def setup(database):
+    conn = connect(database)
+    migrate(conn)
+    conn.execute("INSERT INTO users (name, email, password, role) VALUES ('Farmer', 'f@example.com', 'x', 'farmer')")
+    conn.execute("INSERT INTO users (name, email, password, role) VALUES ('Buyer', 'b@example.com', 'x', 'buyer')")
+    conn.execute("INSERT INTO crops (farmer_id, crop_name, quantity, quantity_value, quantity_unit, price) "
+                 "VALUES (1, 'Maize', '1000kg', ?, 'kg', 150)", (START_STOCK,))
+    conn.commit()
+    conn.close()
+
+
+def buyer(database, attempts, seed, results):
+    rng = random.Random(seed)
+    conn = connect(database)
+    ok = rejected = 0
+    for _ in range(attempts):
+        try:
+            inventory.reserve(conn, 1, 2, rng.choice([1, 2.5, 5, 10, 25]), 'pickup', ttl=rng.choice([-1, 3600]))
+            ok += 1
+        except inventory.InsufficientStock:
+            rejected += 1
+    conn.close()
+    results.append((ok, rejected))
+
+
+def worker(database, threads, attempts, seed, queue):
+    results = []
+    pool = [threading.Thread(target=buyer, args=(database, attempts, seed * 100 + i, results)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    queue.put(results)
+
+
+def check(conn, label):
+    stock = conn.execute("SELECT quantity_value FROM crops WHERE id = 1").fetchone()[0]
+    held = conn.execute("SELECT COALESCE(SUM(quantity), 0) FROM orders "
+                        "WHERE order_status NOT IN ('expired', 'cancelled')").fetchone()[0]
+    print(f"{label}: stock left {stock:g}, held by orders {held:g}, total {stock + held:g}")
+    assert stock >= 0, 'stock went negative'
+    assert abs(stock + held - START_STOCK) < 1e-6, 'stock and orders do not add up'
+
+
+def main():
+    args = [int(a) for a in sys.argv[1:4]]
+    processes, threads, attempts = args + [4, 4, 200][len(args):]
+    database = os.path.join(tempfile.mkdtemp(), 'stress.db')
+    setup(database)
+
+    queue = multiprocessing.Queue()
+    started = time.perf_counter()
+    procs = [multiprocessing.Process(target=worker, args=(database, threads, attempts, p, queue))
+             for p in range(processes)]
+    for p in procs:
+        p.start()
+    results = [r for _ in procs for r in queue.get()]
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - started
+
+    ok = sum(r[0] for r in results)
+    rejected = sum(r[1] for r in results)
+    print(f"{processes * threads} concurrent buyers, {ok + rejected} attempts in {elapsed:.2f}s "
+          f"({(ok + rejected) / elapsed:.0f}/s): {ok} reserved, {rejected} rejected")
+
+    conn = sqlite3.connect(database)
+    check(conn, 'after purchases')
+    released = inventory.release_expired(conn)
+    print(f"sweeper released {released} expired reservations")
+    check(conn, 'after sweep')
+    assert conn.execute("SELECT COUNT(*) FROM orders WHERE order_status = 'pending' "
+                        "AND reserved_until <= datetime('now')").fetchone()[0] == 0
+    conn.close()
+    print('OK: no oversell')
+
+
+if __name__ == '__main__':
+    main()
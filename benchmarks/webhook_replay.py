@@ -0,0 +1,88 @@
+"""Replay benchmark for the PayChangu webhook.
+
+Creates a batch of pending orders, then fires thousands of callbacks at
+/payment/webhook from several threads: every success callback is repeated,
+failed callbacks are mixed in, and the whole stream is shuffled so events
+arrive out of order. Checks that every order ends up paid exactly once and
+that each distinct event is stored once, then reports throughput and how
+many commits the group committer needed.
+
+Usage: python benchmarks/webhook_replay.py [orders] [replays] [threads]
+"""
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def main():
+    args = [int(a) for a in sys.argv[1:4]]
+    orders, replays, threads = args + [500, 5, 8][len(args):]
+
+    work = tempfile.mkdtemp()
+    subprocess.run([sys.executable, os.path.join(ROOT, 'init_db.py')], cwd=work, check=True, capture_output=True)
+    os.environ['AGRILINK_DATABASE'] = os.path.join(work, 'agrilink.db')
+
+    from app import app
+    import inventory
+
+    conn = sqlite3.connect(os.environ['AGRILINK_DATABASE'])
+    conn.execute("INSERT INTO users (name, email, password, role) VALUES ('Buyer', 'b@example.com', 'x', 'buyer')")
+    conn.execute("INSERT INTO crops (farmer_id, crop_name, quantity, quantity_value, quantity_unit, price) "
+                 "VALUES (1, 'Maize', 'lots', ?, 'kg', 150)", (orders * 10.0,))
+    conn.commit()
+    order_ids = [inventory.reserve(conn, 1, 2, 10, 'pickup')[0] for _ in range(orders)]
+
+    callbacks = []
+    for order_id in order_ids:
+        success = {'status': 'success', 'data': {'tx_ref': f'agri_order_{order_id}',
+                                                 'reference': f'PC-{order_id}', 'amount': 1500}}
+        failed = {'status': 'failed', 'data': {'tx_ref': f'agri_order_{order_id}',
+                                               'reference': f'PC-{order_id}-failed'}}
+        callbacks += [success] * replays + [failed] * 2
+    random.Random(42).shuffle(callbacks)
+
+    outcomes = {}
+    lock = threading.Lock()
+
+    def fire(chunk):
+        client = app.test_client()
+        for payload in chunk:
+            response = client.post('/payment/webhook', json=payload)
+            outcome = response.get_json().get('outcome', response.status_code)
+            with lock:
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    chunks = [callbacks[i::threads] for i in range(threads)]
+    pool = [threading.Thread(target=fire, args=(chunk,)) for chunk in chunks]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    committer = app.extensions['payment_webhooks']
+    print(f"{len(callbacks)} callbacks from {threads} threads in {elapsed:.2f}s "
+          f"({len(callbacks) / elapsed:.0f}/s), {committer.batches} commits "
+          f"(avg {committer.events / max(committer.batches, 1):.1f} events/commit)")
+    print('outcomes:', outcomes)
+
+    paid = conn.execute("SELECT COUNT(*) FROM orders WHERE order_status = 'paid'").fetchone()[0]
+    events = conn.execute("SELECT COUNT(*) FROM payment_events").fetchone()[0]
+    applied = conn.execute("SELECT COUNT(*) FROM payment_events WHERE outcome = 'applied'").fetchone()[0]
+    assert paid == orders, f'{paid} of {orders} orders paid'
+    assert events == orders * 2, f'{events} events stored, expected {orders * 2}'
+    assert applied == orders, f'{applied} payments applied, expected {orders}'
+    print(f"OK: {paid} orders paid once each, {events} distinct events stored")
+
+
+if __name__ == '__main__':
+    main()
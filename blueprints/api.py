@@ -0,0 +1,311 @@
+"""Read-only JSON API for the mobile clients, version 1.
+
+Every list takes ``fields=`` (a comma-separated subset of the resource's
+fields; only those columns are selected), ``limit=`` (default 20, max 100)
+and the same opaque ``after=`` / ``before=`` cursors as the HTML pages. The
+response is ``{"data": [...], "links": {"next": ..., "prev": ...}}``.
+
+Responses carry a weak ETag built from the ``data_versions`` of the tables
+they read (see page_cache.py), so a repeat request with ``If-None-Match`` is
+answered 304 after one cached version lookup, before any query runs. Bodies
+are compressed with brotli when the client accepts it and the module is
+installed, gzip otherwise.
+"""
+import functools
+import gzip
+import hashlib
+import json
+
+from flask import Blueprint, current_app, make_response, request, url_for
+from flask_login import current_user
+
+from db import get_db_connection
+import search
+from pagination import fetch_page
+from uploads import accepts_webp, image_url
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+MIN_COMPRESS_SIZE = 512  # bytes; smaller bodies are not worth the CPU
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# field -> SQL expression, per resource; every field is returned unless ``fields=`` picks some.
+CROP_FIELDS = {
+    'id': 'c.id', 'crop_name': 'c.crop_name', 'quantity': 'c.quantity', 'quantity_value': 'c.quantity_value',
+    'quantity_unit': 'c.quantity_unit', 'price': 'c.price', 'quality': 'c.quality', 'crop_grade': 'c.crop_grade',
+    'harvest_date': 'c.harvest_date', 'location': 'c.location', 'image': 'c.image', 'created_at': 'c.created_at',
+    'farmer_id': 'c.farmer_id', 'farmer_name': 'u.name', 'farmer_picture': 'u.profile_pic',
+    'farmer_rating': 'c.farmer_rating',
+}
+DEMAND_FIELDS = {
+    'id': 'd.id', 'crop_name': 'd.crop_name', 'quantity': 'd.quantity', 'quantity_value': 'd.quantity_value',
+    'quantity_unit': 'd.quantity_unit', 'location': 'd.location', 'quality': 'd.quality', 'message': 'd.message',
+    'image': 'd.image', 'created_at': 'd.created_at', 'buyer_id': 'd.buyer_id', 'buyer_name': 'u.name',
+}
+ORDER_FIELDS = {
+    'id': 'o.id', 'order_date': 'o.order_date', 'order_status': 'o.order_status', 'crop_id': 'o.crop_id',
+    'crop_name': 'c.crop_name', 'quantity': 'o.quantity', 'total_price': 'o.total_price',
+    'delivery_option': 'o.delivery_option', 'buyer_id': 'o.buyer_id', 'buyer_name': 'b.name',
+    'farmer_id': 'c.farmer_id', 'farmer_name': 'f.name',
+}
+USER_FIELDS = {
+    'id': 'u.id', 'name': 'u.name', 'role': 'u.role', 'profile_pic': 'u.profile_pic', 'created_at': 'u.created_at',
+    'rating': 'u.rating_sum * 1.0 / NULLIF(u.rating_count, 0)', 'review_count': 'u.rating_count',
+}
+IMAGE_FIELDS = {'image', 'farmer_picture', 'profile_pic'}
+
+
+class BadRequest(ValueError):
+    pass
+
+
+@api_bp.errorhandler(BadRequest)
+def bad_request(e):
+    return {'error': str(e)}, 400
+
+
+@api_bp.before_request
+def require_login():
+    if not current_user.is_authenticated:
+        return {'error': 'Log in first.'}, 401
+
+
+def _etag(names):
+    conn = get_db_connection()
+    cache = current_app.extensions['page_cache']
+    versions = [cache.version(conn, name)[0] for name in names]
+    raw = repr((versions, request.full_path, current_user.id, accepts_webp()))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def conditional(*names):
+    """Answer 304 when none of data versions ``names`` moved since the client's copy."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = _etag(names)
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+@api_bp.after_request
+def compress(response):
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.content_length is None or response.content_length < MIN_COMPRESS_SIZE):
+        return response
+    encodings = request.accept_encodings
+    if brotli is not None and encodings['br']:
+        body, encoding = brotli.compress(response.get_data(), quality=BROTLI_QUALITY), 'br'
+    elif encodings['gzip']:
+        body, encoding = gzip.compress(response.get_data(), GZIP_LEVEL), 'gzip'
+    else:
+        return response
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def _fields(available, sort_columns=()):
+    """Requested field names, and the SELECT list for them plus any sort columns."""
+    requested = request.args.get('fields')
+    names = [name.strip() for name in requested.split(',') if name.strip()] if requested else list(available)
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise BadRequest(f"Unknown field(s) {', '.join(unknown)}; choose from {', '.join(available)}.")
+    selected = list(dict.fromkeys(names + [c for c in sort_columns if c in available]))
+    columns = [f'{available[name]} AS {name}' for name in selected]
+    return names, columns
+
+
+def _limit():
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    if not 1 <= limit <= MAX_LIMIT:
+        raise BadRequest(f'limit must be between 1 and {MAX_LIMIT}.')
+    return limit
+
+
+def _item(row, names):
+    item = {name: row[name] for name in names}
+    for name in IMAGE_FIELDS.intersection(names):
+        item[name] = image_url(item[name], 'md') or None
+    return item
+
+
+def _page(page, names):
+    args = {key: value for key, value in request.args.items() if key not in ('after', 'before')}
+    endpoint = request.endpoint
+    return json.dumps({
+        'data': [_item(row, names) for row in page.items],
+        'links': {
+            'next': url_for(endpoint, after=page.next_cursor, **args) if page.has_next else None,
+            'prev': url_for(endpoint, before=page.prev_cursor, **args) if page.has_prev else None,
+        },
+    }, separators=(',', ':')), 200, {'Content-Type': 'application/json'}
+
+
+def _one(query, params, names):
+    row = get_db_connection().execute(query, params).fetchone()
+    if row is None:
+        return {'error': 'Not found.'}, 404
+    return {'data': _item(row, names)}
+
+
+@api_bp.route('/crops')
+@conditional('crops')
+def crops():
+    """Listings, newest first. Filters as on the buyer dashboard: q, location, crop_name, farmer_id,
+    min_quantity (kg) and sort=price_low|price_high|quantity|rating."""
+    conn = get_db_connection()
+    sort = request.args.get('sort', '')
+    sort_keys, descending = [("c.id", "id")], True
+    conditions, params = [], []
+    if sort == 'price_low':
+        sort_keys, descending = [("c.price", "price"), ("c.id", "id")], False
+    elif sort == 'price_high':
+        sort_keys = [("c.price", "price"), ("c.id", "id")]
+    elif sort == 'quantity':
+        conditions.append("c.quantity_unit = 'kg'")
+        sort_keys = [("c.quantity_value", "quantity_value"), ("c.id", "id")]
+    elif sort == 'rating':
+        sort_keys = [("c.farmer_rating", "farmer_rating"), ("c.id", "id")]
+    elif sort:
+        raise BadRequest('sort must be price_low, price_high, quantity or rating.')
+
+    names, columns = _fields(CROP_FIELDS, [column for _, column in sort_keys])
+    from_clause = " FROM crops c JOIN users u ON c.farmer_id = u.id"
+    match = search.crops_match(conn, request.args.get('q', ''))
+    if match:
+        rank = search.rank_expression('crops_fts', search.CROPS_WEIGHTS)
+        columns.append(f"{rank} AS search_rank")
+        from_clause += " JOIN crops_fts ON crops_fts.rowid = c.id"
+        conditions.append("crops_fts MATCH ?")
+        params.append(match)
+        if not sort:
+            sort_keys = [(rank, "search_rank"), ("c.id", "id")]
+    for arg, condition in (('location', "c.location = ?"), ('crop_name', "c.crop_name = ?")):
+        if request.args.get(arg):
+            conditions.append(condition)
+            params.append(request.args[arg])
+    if request.args.get('farmer_id', type=int):
+        conditions.append("c.farmer_id = ?")
+        params.append(request.args.get('farmer_id', type=int))
+    if request.args.get('min_quantity', type=float):
+        conditions.append("c.quantity_unit = 'kg' AND c.quantity_value >= ?")
+        params.append(request.args.get('min_quantity', type=float))
+
+    page = fetch_page(conn, "SELECT " + ", ".join(columns) + from_clause, conditions, params,
+                      sort_keys, request.args, _limit(), descending)
+    return _page(page, names)
+
+
+@api_bp.route('/crops/<int:crop_id>')
+@conditional('crops')
+def crop(crop_id):
+    names, columns = _fields(CROP_FIELDS)
+    return _one(f"SELECT {', '.join(columns)} FROM crops c JOIN users u ON c.farmer_id = u.id WHERE c.id = ?",
+                (crop_id,), names)
+
+
+@api_bp.route('/demands')
+@conditional('demands', 'users')
+def demands():
+    """Buyer demands, newest first. Filters as on the farmer dashboard: q, location, buyer_id."""
+    conn = get_db_connection()
+    sort_keys = [("d.id", "id")]
+    names, columns = _fields(DEMAND_FIELDS, ['id'])
+    from_clause = " FROM demands d JOIN users u ON d.buyer_id = u.id"
+    conditions, params = [], []
+    match = search.demands_match(conn, request.args.get('q', ''))
+    if match:
+        rank = search.rank_expression('demands_fts', search.DEMANDS_WEIGHTS)
+        columns.append(f"{rank} AS search_rank")
+        from_clause += " JOIN demands_fts ON demands_fts.rowid = d.id"
+        conditions.append("demands_fts MATCH ?")
+        params.append(match)
+        sort_keys = [(rank, "search_rank"), ("d.id", "id")]
+    if request.args.get('location'):
+        conditions.append("d.location = ?")
+        params.append(request.args['location'])
+    if request.args.get('buyer_id', type=int):
+        conditions.append("d.buyer_id = ?")
+        params.append(request.args.get('buyer_id', type=int))
+
+    page = fetch_page(conn, "SELECT " + ", ".join(columns) + from_clause, conditions, params,
+                      sort_keys, request.args, _limit())
+    return _page(page, names)
+
+
+@api_bp.route('/demands/<int:demand_id>')
+@conditional('demands', 'users')
+def demand(demand_id):
+    names, columns = _fields(DEMAND_FIELDS)
+    return _one(f"SELECT {', '.join(columns)} FROM demands d JOIN users u ON d.buyer_id = u.id WHERE d.id = ?",
+                (demand_id,), names)
+
+
+def _order_scope():
+    """Orders the current user may see: their purchases, their sales, or all of them for an admin."""
+    if current_user.role == 'admin':
+        return [], []
+    if current_user.role == 'farmer':
+        return ["c.farmer_id = ?"], [current_user.id]
+    return ["o.buyer_id = ?"], [current_user.id]
+
+
+_ORDERS_FROM = """
+    FROM orders o
+    JOIN crops c ON o.crop_id = c.id
+    JOIN users b ON o.buyer_id = b.id
+    JOIN users f ON c.farmer_id = f.id
+"""
+
+
+@api_bp.route('/orders')
+@conditional('orders', 'crops', 'users')
+def orders():
+    """The user's orders (as buyer) or sales (as farmer), newest first; status= filters."""
+    sort_keys = [("o.order_date", "order_date"), ("o.id", "id")]
+    names, columns = _fields(ORDER_FIELDS, [column for _, column in sort_keys])
+    conditions, params = _order_scope()
+    if request.args.get('status'):
+        conditions.append("LOWER(o.order_status) = LOWER(?)")
+        params.append(request.args['status'])
+    page = fetch_page(get_db_connection(), "SELECT " + ", ".join(columns) + _ORDERS_FROM, conditions, params,
+                      sort_keys, request.args, _limit())
+    return _page(page, names)
+
+
+@api_bp.route('/orders/<int:order_id>')
+@conditional('orders', 'crops', 'users')
+def order(order_id):
+    names, columns = _fields(ORDER_FIELDS)
+    conditions, params = _order_scope()
+    where = " AND ".join(["o.id = ?"] + conditions)
+    return _one(f"SELECT {', '.join(columns)} {_ORDERS_FROM} WHERE {where}", [order_id] + params, names)
+
+
+@api_bp.route('/users/<int:user_id>')
+@conditional('users')
+def user(user_id):
+    """Public profile: name, role, picture and review summary."""
+    names, columns = _fields(USER_FIELDS)
+    return _one(f"SELECT {', '.join(columns)} FROM users u WHERE u.id = ? AND u.deleted_at IS NULL", (user_id,), names)
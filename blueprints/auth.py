@@ -1,39 +1,50 @@
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash
 from flask_login import login_user, logout_user
-from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired
 from flask_mail import Message
-import sqlite3
+from db import get_db_connection
+import outbox
+import passwords
+import ratelimit
+import sessions
+import user_cache
 
 auth_bp = Blueprint('auth', __name__)
 
-def get_db_connection():
-    conn = sqlite3.connect('agrilink.db')
-    conn.row_factory = sqlite3.Row
-    return conn
-
 @auth_bp.record_once
 def on_load(state):
     auth_bp.s = URLSafeTimedSerializer(state.app.secret_key)
-    auth_bp.mail = state.app.extensions['mail']
     from models import User # Import from the new models file
     auth_bp.User = User
 
+def _throttled(retry_after, template='auth.html', **context):
+    flash('Too many attempts. Please wait a few minutes and try again.', 'danger')
+    return render_template(template, **context), 429, {'Retry-After': str(int(retry_after) + 1)}
+
+def _busy(template='auth.html', **context):
+    flash('We are handling a lot of sign-ins right now. Please try again in a moment.', 'warning')
+    return render_template(template, **context), 503, {'Retry-After': '5'}
+
 @auth_bp.route('/auth', methods=['GET', 'POST'])
 def auth():
     if request.method == 'POST':
+        conn = get_db_connection()
+        retry_after = ratelimit.hit(conn, 'auth_ip', request.remote_addr)
+        if retry_after:
+            return _throttled(retry_after)
         if 'name' in request.form:  # Registration
             name = request.form['name']
             email = request.form['email']
             password = request.form['password']
             role = request.form['role']
-            conn = get_db_connection()
             existing_user = conn.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()
             if existing_user:
                 flash('Email already registered')
-                conn.close()
                 return render_template('auth.html')
-            hashed_password = generate_password_hash(password)
+            try:
+                hashed_password = passwords.hash_password(password)
+            except passwords.Busy:
+                return _busy(form_data=request.form)
 
             if role == 'farmer':
                 phone_number = request.form.get('phone_number')
@@ -48,17 +59,31 @@ def auth():
                 conn.execute('INSERT INTO users (name, email, password, role) VALUES (?, ?, ?, ?)', (name, email, hashed_password, role))
 
             conn.commit()
-            conn.close()
             flash('Registration successful! Please login.')
             return render_template('auth.html')
         else:  # Login
             email = request.form['email']
             password = request.form['password']
-            conn = get_db_connection()
-            user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
-            conn.close()
-            if user and check_password_hash(user['password'], password):
+            # Taken up front so parallel guesses each need a token; refunded below if the password is right.
+            retry_after = ratelimit.hit(conn, 'login_email', email.strip().lower())
+            if retry_after:
+                return _throttled(retry_after)
+            user = conn.execute('SELECT * FROM users WHERE email = ? AND deleted_at IS NULL', (email,)).fetchone()
+            try:
+                valid = passwords.verify(user['password'] if user else None, password)
+            except passwords.Busy:
+                return _busy()
+            if valid:
+                ratelimit.refund(conn, 'login_email', email.strip().lower())
+                if passwords.needs_rehash(user['password']):
+                    try:
+                        conn.execute('UPDATE users SET password = ? WHERE id = ?',
+                                     (passwords.hash_password(password), user['id']))
+                        conn.commit()
+                    except passwords.Busy:
+                        pass  # next login will try again
                 user_obj = auth_bp.User(user['id'], user['email'], user['name'], user['role'])
+                sessions.regenerate()
                 login_user(user_obj)
                 session['logged_in'] = True
                 session['role'] = user['role']
@@ -84,14 +109,13 @@ def forgot_password():
     if request.method == 'POST':
         email = request.form['email']
         conn = get_db_connection()
-        user = conn.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()
-        conn.close()
+        user = conn.execute('SELECT id FROM users WHERE email = ? AND deleted_at IS NULL', (email,)).fetchone()
         if user:
             token = auth_bp.s.dumps(email, salt='password-reset-salt')
             reset_url = url_for('auth.reset_with_token', token=token, _external=True)
             msg = Message('Password Reset Request for AgriLink Malawi', recipients=[email])
             msg.body = f"Hello,\n\nYou requested a password reset. Please click the link below to set a new password. This link will expire in 1 hour.\n\n{reset_url}\n\nIf you did not request this, please ignore this email.\n\nThanks,\nThe AgriLink Malawi Team"
-            auth_bp.mail.send(msg)
+            outbox.enqueue(conn, msg)
         flash('If an account with that email exists, password reset instructions have been sent.', 'info')
         return redirect(url_for('auth.auth'))
     return render_template('forgot_password.html')
@@ -112,11 +136,21 @@ def reset_with_token(token):
         if password != confirm_password:
             flash('Passwords do not match.', 'danger')
             return render_template('reset_password.html', token=token)
-        hashed_password = generate_password_hash(password)
         conn = get_db_connection()
+        retry_after = ratelimit.hit(conn, 'auth_ip', request.remote_addr)
+        if retry_after:
+            return _throttled(retry_after, 'reset_password.html', token=token)
+        try:
+            hashed_password = passwords.hash_password(password)
+        except passwords.Busy:
+            return _busy('reset_password.html', token=token)
         conn.execute('UPDATE users SET password = ? WHERE email = ?', (hashed_password, email))
+        user = conn.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()
+        if user:
+            sessions.revoke_user(conn, user['id'])
         conn.commit()
-        conn.close()
+        if user:
+            user_cache.invalidate(conn, user['id'])
         flash('Your password has been updated successfully! Please login.', 'success')
         return redirect(url_for('auth.auth'))
     return render_template('reset_password.html', token=token)
\ No newline at end of file
@@ -1,68 +1,87 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
 from flask_login import login_required, current_user
-import sqlite3
+from db import get_db_connection
+import search
+from pagination import fetch_page, approximate_count
+from quantities import parse_quantity
+import uploads
+import page_cache
+import matching
 
 buyer_bp = Blueprint('buyer', __name__, url_prefix='/buyer')
 
-def get_db_connection():
-    conn = sqlite3.connect('agrilink.db')
-    conn.row_factory = sqlite3.Row
-    return conn
-
 @buyer_bp.route('/dashboard')
 @login_required
 def dashboard():
     if current_user.role != 'buyer':
         return redirect(url_for('main.homepage'))
     
-    page = request.args.get('page', 1, type=int)
     PER_PAGE = 6
-    offset = (page - 1) * PER_PAGE
     search_query = request.args.get('search_query', '')
     location = request.args.get('location', '')
     crop_category = request.args.get('crop_category', '')
+    min_quantity = request.args.get('min_quantity', type=float)
+    sort = request.args.get('sort', '')
 
     conn = get_db_connection()
 
     # Get unique crop names for categories
     crop_categories = conn.execute("SELECT DISTINCT crop_name FROM crops ORDER BY crop_name").fetchall()
 
-    select_query = "SELECT c.*, u.name as farmer_name, u.profile_pic FROM crops c JOIN users u ON c.farmer_id = u.id"
+    select_columns = "c.*, u.name as farmer_name, u.profile_pic"
+    from_clause = " FROM crops c JOIN users u ON c.farmer_id = u.id"
     count_query = "SELECT COUNT(c.id) FROM crops c"
+    sort_keys = [("c.id", "id")]
+    descending = True
     conditions = ["c.farmer_id != ?"]
     params = [current_user.id]
 
-    if search_query:
-        conditions.append("c.crop_name LIKE ?")
-        params.append(f"%{search_query}%")
+    if sort == 'price_low':
+        sort_keys, descending = [("c.price", "price"), ("c.id", "id")], False
+    elif sort == 'price_high':
+        sort_keys = [("c.price", "price"), ("c.id", "id")]
+    elif sort == 'quantity':
+        # Volume is only comparable within one unit, so rank the kg listings.
+        conditions.append("c.quantity_unit = 'kg'")
+        sort_keys = [("c.quantity_value", "quantity_value"), ("c.id", "id")]
+    elif sort == 'rating':
+        sort_keys = [("c.farmer_rating", "farmer_rating"), ("c.id", "id")]
+
+    match = search.crops_match(conn, search_query)
+    if match:
+        rank = search.rank_expression('crops_fts', search.CROPS_WEIGHTS)
+        select_columns += f", {rank} as search_rank"
+        fts_join = " JOIN crops_fts ON crops_fts.rowid = c.id"
+        from_clause += fts_join
+        count_query += fts_join
+        conditions.append("crops_fts MATCH ?")
+        params.append(match)
+        if not sort:
+            sort_keys = [(rank, "search_rank"), ("c.id", "id")]
     if location:
         conditions.append("c.location = ?")
         params.append(location)
     if crop_category:
         conditions.append("c.crop_name = ?")
         params.append(crop_category)
+    if min_quantity:
+        conditions.append("c.quantity_unit = 'kg' AND c.quantity_value >= ?")
+        params.append(min_quantity)
 
-    if conditions:
-        where_clause = " WHERE " + " AND ".join(conditions)
-        select_query += where_clause
-        count_query += where_clause
-
-    total_crops = conn.execute(count_query, tuple(params)).fetchone()[0]
-    total_pages = (total_crops + PER_PAGE - 1) // PER_PAGE
-
-    select_query += " ORDER BY c.id DESC LIMIT ? OFFSET ?"
-    params.extend([PER_PAGE, offset])
-    crops = conn.execute(select_query, tuple(params)).fetchall()
+    select_query = "SELECT " + select_columns + from_clause
+    count_query += " WHERE " + " AND ".join(conditions)
+    crops_page = fetch_page(conn, select_query, conditions, params, sort_keys, request.args, PER_PAGE, descending)
+    crops_page.total = approximate_count(conn, count_query, params)
 
     my_demands = conn.execute('SELECT * FROM demands WHERE buyer_id = ? ORDER BY id DESC', (current_user.id,)).fetchall()
-    conn.close()
+    matched_crops = matching.matches_for_buyer(conn, current_user.id)
 
     return render_template('buyer dashboard.html',
-                           crops=crops, my_demands=my_demands,
+                           crops=crops_page.items, pager=crops_page, my_demands=my_demands, matched_crops=matched_crops,
                            user=current_user.name,
                            search_query=search_query, location=location, crop_category=crop_category,
-                           crop_categories=crop_categories,
-                           page=page, total_pages=total_pages)
+                           min_quantity=min_quantity, sort=sort,
+                           crop_categories=crop_categories)
 
 @buyer_bp.route('/add_demand', methods=['GET', 'POST'])
 @login_required
@@ -74,11 +93,13 @@ def add_demand():
         quality = request.form.get('quality')
         message = request.form.get('message')
 
+        quantity_value, quantity_unit = parse_quantity(quantity)
+
         conn = get_db_connection()
-        conn.execute('INSERT INTO demands (buyer_id, crop_name, quantity, location, quality, message) VALUES (?, ?, ?, ?, ?, ?)',
-                     (current_user.id, crop_name, quantity, location, quality, message))
+        cursor = conn.execute('INSERT INTO demands (buyer_id, crop_name, quantity, quantity_value, quantity_unit, location, quality, message) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (current_user.id, crop_name, quantity, quantity_value, quantity_unit, location, quality, message))
+        matching.index_demand(conn, cursor.lastrowid)
         conn.commit()
-        conn.close()
         flash('Your demand has been posted successfully!', 'success')
         return redirect(url_for('buyer.view_my_demands'))
 
@@ -89,11 +110,11 @@ def add_demand():
 def view_my_demands():
     conn = get_db_connection()
     my_demands = conn.execute("SELECT d.*, u.name as buyer_name FROM demands d JOIN users u ON d.buyer_id = u.id WHERE d.buyer_id = ?", (current_user.id,)).fetchall()
-    conn.close()
     return render_template('data_page_wrapper.html', title="My Demands", items=my_demands, list_type='demands', is_owner_view=True)
 
 @buyer_bp.route('/crop/<int:crop_id>')
 @login_required
+@page_cache.cached('crops', role='buyer')
 def view_crop(crop_id):
     """Displays details for a single crop."""
     if current_user.role != 'buyer':
@@ -101,7 +122,6 @@ def view_crop(crop_id):
 
     conn = get_db_connection()
     crop = conn.execute("SELECT c.*, u.name as farmer_name, u.profile_pic FROM crops c JOIN users u ON c.farmer_id = u.id WHERE c.id = ?", (crop_id,)).fetchone()
-    conn.close()
 
     if not crop:
         flash('Crop not found.', 'danger')
@@ -117,7 +137,6 @@ def edit_demand(demand_id):
 
     if not demand:
         flash('Demand not found or you do not have permission to edit it.', 'danger')
-        conn.close()
         return redirect(url_for('buyer.view_my_demands'))
 
     if request.method == 'POST':
@@ -131,29 +150,25 @@ def edit_demand(demand_id):
         filename = current_image
 
         if 'delete_image' in request.form and current_image:
-            try:
-                os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], current_image))
-            except OSError:
-                pass
             filename = None
 
         if image and image.filename != '':
-            if current_image:
-                try:
-                    os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], current_image))
-                except OSError:
-                    pass
-            filename = secure_filename(image.filename)
-            image.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
-
-        conn.execute("UPDATE demands SET crop_name = ?, quantity = ?, location = ?, quality = ?, message = ?, image = ? WHERE id = ?",
-                     (crop_name, quantity, location, quality, message, filename, demand_id))
+            try:
+                filename = uploads.save_image(image, current_app.config['UPLOAD_FOLDER'])
+            except uploads.InvalidImage as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('buyer.edit_demand', demand_id=demand_id))
+
+        quantity_value, quantity_unit = parse_quantity(quantity)
+        conn.execute("UPDATE demands SET crop_name = ?, quantity = ?, quantity_value = ?, quantity_unit = ?, location = ?, quality = ?, message = ?, image = ? WHERE id = ?",
+                     (crop_name, quantity, quantity_value, quantity_unit, location, quality, message, filename, demand_id))
+        matching.index_demand(conn, demand_id)
         conn.commit()
-        conn.close()
+        if current_image and current_image != filename:
+            uploads.discard(conn, current_app.config['UPLOAD_FOLDER'], current_image)
         flash('Demand updated successfully!', 'success')
         return redirect(url_for('buyer.view_my_demands'))
 
-    conn.close()
     return render_template('data_edit_form.html', form_type='demand', data=demand)
 
 @buyer_bp.route('/delete_demand/<int:demand_id>', methods=['POST'])
@@ -162,7 +177,6 @@ def delete_demand(demand_id):
     conn = get_db_connection()
     conn.execute('DELETE FROM demands WHERE id = ? AND buyer_id = ?', (demand_id, current_user.id))
     conn.commit()
-    conn.close()
     flash('Demand deleted successfully.', 'success')
     return redirect(url_for('buyer.view_my_demands'))
 
@@ -171,7 +185,7 @@ def delete_demand(demand_id):
 def view_my_orders():
     conn = get_db_connection()
     # Corrected the query to select r.created_at instead of the non-existent r.review_date
-    orders = conn.execute("""
+    orders_page = fetch_page(conn, """
         SELECT 
             o.id, o.quantity, o.total_price, o.order_status, o.order_date, 
             c.crop_name, 
@@ -181,11 +195,9 @@ def view_my_orders():
         FROM orders o 
         JOIN crops c ON o.crop_id = c.id 
         JOIN users u ON c.farmer_id = u.id 
-        LEFT JOIN reviews r ON o.id = r.order_id AND r.reviewer_id = o.buyer_id 
-        WHERE o.buyer_id = ? ORDER BY o.order_date DESC
-    """, (current_user.id,)).fetchall()
-    conn.close()
-    return render_template('order_history.html', orders=orders)
+        LEFT JOIN reviews r ON o.id = r.order_id AND r.reviewer_id = o.buyer_id
+    """, ["o.buyer_id = ?"], [current_user.id], [("o.order_date", "order_date"), ("o.id", "id")], request.args, 25)
+    return render_template('order_history.html', orders=orders_page.items, pager=orders_page)
 
 @buyer_bp.route('/leave_review/<int:order_id>', methods=['GET', 'POST'])
 @login_required
@@ -195,17 +207,23 @@ def leave_review(order_id):
 
     if not order:
         flash('Order not found or you do not have permission to review it.', 'danger')
-        conn.close()
         return redirect(url_for('buyer.view_my_orders'))
 
     if request.method == 'POST':
-        rating = request.form.get('rating')
+        rating = request.form.get('rating', type=int)
         comment = request.form.get('comment')
-        conn.execute("INSERT INTO reviews (order_id, reviewer_id, reviewed_user_id, rating, comment) VALUES (?, ?, ?, ?, ?)", (order_id, current_user.id, order['farmer_id'], rating, comment))
+        if rating not in range(1, 6):
+            flash('Please choose a rating from 1 to 5 stars.', 'danger')
+            return render_template('leave_review.html', order=order)
+        # The farmer's rating totals are updated by triggers on reviews.
+        cursor = conn.execute("INSERT INTO reviews (order_id, reviewer_id, reviewed_user_id, rating, comment) VALUES (?, ?, ?, ?, ?) "
+                              "ON CONFLICT (order_id, reviewer_id) DO NOTHING",
+                              (order_id, current_user.id, order['farmer_id'], rating, comment))
         conn.commit()
-        conn.close()
-        flash('Thank you for your review!', 'success')
+        if cursor.rowcount:
+            flash('Thank you for your review!', 'success')
+        else:
+            flash('You have already reviewed this order.', 'info')
         return redirect(url_for('buyer.view_my_orders'))
 
-    conn.close()
     return render_template('leave_review.html', order=order)
\ No newline at end of file
@@ -1,21 +1,25 @@
+import os
+import sqlite3
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required, current_user
 from flask_mail import Message
-from werkzeug.utils import secure_filename
-import sqlite3
-import os
+from db import get_db_connection
+import search
+from pagination import fetch_page, approximate_count
+from quantities import parse_quantity
+import inventory
+import outbox
+import uploads
+import push
+import matching
+import exports
+import crop_import
 
 farmer_bp = Blueprint('farmer', __name__, url_prefix='/farmer')
 
-def get_db_connection():
-    conn = sqlite3.connect('agrilink.db')
-    conn.row_factory = sqlite3.Row
-    return conn
-
 @farmer_bp.record_once
 def on_load(state):
     farmer_bp.app_config = state.app.config
-    farmer_bp.mail = state.app.extensions['mail']
 
 @farmer_bp.route('/dashboard')
 @login_required
@@ -23,39 +27,43 @@ def dashboard():
     if current_user.role != 'farmer':
         return redirect(url_for('main.homepage'))
 
-    page = request.args.get('page', 1, type=int)
     PER_PAGE = 6
-    offset = (page - 1) * PER_PAGE
     search_query = request.args.get('search_query', '')
     location = request.args.get('location', '')
 
     conn = get_db_connection()
-    demands_select_query = "SELECT d.*, u.name as buyer_name, u.profile_pic FROM demands d JOIN users u ON d.buyer_id = u.id"
+    demands_select_columns = "d.*, u.name as buyer_name, u.profile_pic"
+    demands_from_clause = " FROM demands d JOIN users u ON d.buyer_id = u.id"
     demands_count_query = "SELECT COUNT(d.id) FROM demands d"
+    demands_sort_keys = [("d.id", "id")]
     demands_conditions = []
     demands_params = []
 
-    if search_query:
-        demands_conditions.append("d.crop_name LIKE ?")
-        demands_params.append(f"%{search_query}%")
+    match = search.demands_match(conn, search_query)
+    if match:
+        rank = search.rank_expression('demands_fts', search.DEMANDS_WEIGHTS)
+        demands_select_columns += f", {rank} as search_rank"
+        fts_join = " JOIN demands_fts ON demands_fts.rowid = d.id"
+        demands_from_clause += fts_join
+        demands_count_query += fts_join
+        demands_conditions.append("demands_fts MATCH ?")
+        demands_params.append(match)
+        demands_sort_keys = [(rank, "search_rank"), ("d.id", "id")]
     if location:
         demands_conditions.append("d.location = ?")
         demands_params.append(location)
 
+    demands_select_query = "SELECT " + demands_select_columns + demands_from_clause
     if demands_conditions:
-        where_clause = " WHERE " + " AND ".join(demands_conditions)
-        demands_select_query += where_clause
-        demands_count_query += where_clause
-
-    total_demands = conn.execute(demands_count_query, tuple(demands_params)).fetchone()[0]
-    total_pages = (total_demands + PER_PAGE - 1) // PER_PAGE
+        demands_count_query += " WHERE " + " AND ".join(demands_conditions)
 
-    demands_select_query += " ORDER BY d.id DESC LIMIT ? OFFSET ?"
-    demands_params.extend([PER_PAGE, offset])
-    demands = conn.execute(demands_select_query, tuple(demands_params)).fetchall()
-    conn.close()
+    demands_page = fetch_page(conn, demands_select_query, demands_conditions, demands_params,
+                              demands_sort_keys, request.args, PER_PAGE)
+    demands_page.total = approximate_count(conn, demands_count_query, demands_params)
+    matched_demands = matching.matches_for_farmer(conn, current_user.id)
 
-    return render_template('farmer dashboard.html', demands=demands, search_query=search_query, location=location, page=page, total_pages=total_pages)
+    return render_template('farmer dashboard.html', demands=demands_page.items, pager=demands_page, search_query=search_query, location=location,
+                           matched_demands=matched_demands)
 
 @farmer_bp.route('/add_crop', methods=['GET', 'POST'])
 @login_required
@@ -72,26 +80,69 @@ def add_crop():
 
         filename = None
         if image and image.filename != '':
-            filename = secure_filename(image.filename)
-            image.save(os.path.join(farmer_bp.app_config['UPLOAD_FOLDER'], filename))
+            try:
+                filename = uploads.save_image(image, farmer_bp.app_config['UPLOAD_FOLDER'])
+            except uploads.InvalidImage as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('farmer.add_crop'))
+
+        quantity_value, quantity_unit = parse_quantity(quantity)
 
         conn = get_db_connection()
-        conn.execute('INSERT INTO crops (farmer_id, crop_name, quantity, price, quality, crop_grade, harvest_date, location, image) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                     (current_user.id, crop_name, quantity, price, quality, crop_grade, harvest_date, location, filename))
+        cursor = conn.execute('INSERT INTO crops (farmer_id, crop_name, quantity, quantity_value, quantity_unit, price, quality, crop_grade, harvest_date, location, image) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (current_user.id, crop_name, quantity, quantity_value, quantity_unit, price, quality, crop_grade, harvest_date, location, filename))
+        matching.index_crop(conn, cursor.lastrowid)
         conn.commit()
-        conn.close()
         flash('Crop registered successfully!', 'success')
         return redirect(url_for('farmer.view_my_listings'))
 
     return render_template('add_form.html', form_type='crop')
 
+@farmer_bp.route('/import_crops', methods=['GET', 'POST'])
+@login_required
+def import_crops():
+    """Upload a CSV or Excel sheet of lots; one listing is created per valid row."""
+    if current_user.role != 'farmer':
+        return redirect(url_for('main.homepage'))
+    result = None
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        extension = os.path.splitext(upload.filename)[1].lower() if upload and upload.filename else ''
+        if extension not in crop_import.READERS:
+            flash('Please choose a .csv or .xlsx file.', 'danger')
+            return redirect(url_for('farmer.import_crops'))
+        try:
+            rows = crop_import.READERS[extension](upload.stream)
+        except (ValueError, OSError) as e:
+            flash(f'Could not read {upload.filename}: {e}', 'danger')
+            return redirect(url_for('farmer.import_crops'))
+        result = crop_import.import_rows(get_db_connection(), current_user.id, rows)
+        if result.imported:
+            flash(f'{result.imported} crop listings imported.', 'success')
+    return render_template('import_crops.html', result=result, columns=crop_import.COLUMNS,
+                           xlsx_supported=crop_import.openpyxl is not None)
+
+@farmer_bp.route('/api/crops/import', methods=['POST'])
+@login_required
+def import_crops_api():
+    """JSON bulk import: a list of crop objects, or {"crops": [...]}. Reports errors per row."""
+    if current_user.role != 'farmer':
+        return {'status': 'error', 'message': 'Only farmers can import listings.'}, 403
+    try:
+        rows = crop_import.read_json(request.get_json(silent=True))
+    except ValueError as e:
+        return {'status': 'error', 'message': str(e)}, 400
+    result = crop_import.import_rows(get_db_connection(), current_user.id, rows)
+    return {'status': 'ok', **result.to_dict()}
+
 @farmer_bp.route('/my_listings')
 @login_required
 def view_my_listings():
     conn = get_db_connection()
-    my_crops = conn.execute("SELECT c.*, u.name as farmer_name, u.profile_pic FROM crops c JOIN users u ON c.farmer_id = u.id WHERE c.farmer_id = ?", (current_user.id,)).fetchall()
-    conn.close()
-    return render_template('data_page_wrapper.html', title="My Crop Listings", items=my_crops, list_type='crops', is_owner_view=True)
+    listings_page = fetch_page(conn, "SELECT c.*, u.name as farmer_name, u.profile_pic FROM crops c JOIN users u ON c.farmer_id = u.id",
+                               ["c.farmer_id = ?"], [current_user.id], [("c.id", "id")], request.args, 12)
+    return render_template('data_page_wrapper.html', title="My Crop Listings", items=listings_page.items, pager=listings_page,
+                           pager_endpoint='farmer.view_my_listings', list_type='crops', is_owner_view=True)
 
 @farmer_bp.route('/edit_crop/<int:crop_id>', methods=['GET', 'POST'])
 @login_required
@@ -101,7 +152,6 @@ def edit_crop(crop_id):
 
     if not crop:
         flash('Crop not found or you do not have permission to edit it.', 'danger')
-        conn.close()
         return redirect(url_for('farmer.view_my_listings'))
 
     if request.method == 'POST':
@@ -115,35 +165,48 @@ def edit_crop(crop_id):
         filename = current_image
 
         if 'delete_image' in request.form and current_image:
-            os.remove(os.path.join(farmer_bp.app_config['UPLOAD_FOLDER'], current_image))
             filename = None
 
         if image and image.filename != '':
-            if current_image:
-                try:
-                    os.remove(os.path.join(farmer_bp.app_config['UPLOAD_FOLDER'], current_image))
-                except OSError:
-                    pass
-            filename = secure_filename(image.filename)
-            image.save(os.path.join(farmer_bp.app_config['UPLOAD_FOLDER'], filename))
-
-        conn.execute("UPDATE crops SET crop_name = ?, quantity = ?, price = ?, quality = ?, harvest_date = ?, image = ? WHERE id = ?",
-                     (crop_name, quantity, price, quality, harvest_date, filename, crop_id))
+            try:
+                filename = uploads.save_image(image, farmer_bp.app_config['UPLOAD_FOLDER'])
+            except uploads.InvalidImage as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('farmer.edit_crop', crop_id=crop_id))
+
+        # Stock reserved since the form was loaded must not come back with the save.
+        loaded_value = request.form.get('loaded_quantity_value', crop['quantity_value'], type=float)
+        try:
+            inventory.edit_stock(conn, crop_id, loaded_value, quantity)
+        except inventory.StockChanged as e:
+            conn.rollback()
+            if filename != current_image:
+                uploads.discard(conn, farmer_bp.app_config['UPLOAD_FOLDER'], filename)
+            flash(str(e), 'warning')
+            return redirect(url_for('farmer.edit_crop', crop_id=crop_id))
+        conn.execute("UPDATE crops SET crop_name = ?, price = ?, quality = ?, harvest_date = ?, image = ? WHERE id = ?",
+                     (crop_name, price, quality, harvest_date, filename, crop_id))
+        matching.index_crop(conn, crop_id)
         conn.commit()
-        conn.close()
+        if current_image and current_image != filename:
+            uploads.discard(conn, farmer_bp.app_config['UPLOAD_FOLDER'], current_image)
         flash('Crop listing updated successfully!', 'success')
         return redirect(url_for('farmer.view_my_listings'))
 
-    conn.close()
     return render_template('data_edit_form.html', form_type='crop', data=crop)
 
 @farmer_bp.route('/delete_crop/<int:crop_id>', methods=['POST'])
 @login_required
 def delete_crop(crop_id):
     conn = get_db_connection()
-    conn.execute('DELETE FROM crops WHERE id = ? AND farmer_id = ?', (crop_id, current_user.id))
+    try:
+        conn.execute('DELETE FROM crops WHERE id = ? AND farmer_id = ?', (crop_id, current_user.id))
+    except sqlite3.IntegrityError:
+        # orders.crop_id is ON DELETE RESTRICT: buyers' order history keeps its listing.
+        conn.rollback()
+        flash('This listing has orders and cannot be deleted. Set its quantity to 0 to stop new orders.', 'warning')
+        return redirect(url_for('farmer.view_my_listings'))
     conn.commit()
-    conn.close()
     flash('Crop listing deleted successfully.', 'success')
     return redirect(url_for('farmer.view_my_listings'))
 
@@ -151,9 +214,26 @@ def delete_crop(crop_id):
 @login_required
 def my_sales():
     conn = get_db_connection()
-    orders = conn.execute("SELECT o.id, o.quantity, o.total_price, o.order_status, o.order_date, c.crop_name, u.name as buyer_name FROM orders o JOIN crops c ON o.crop_id = c.id JOIN users u ON o.buyer_id = u.id WHERE c.farmer_id = ? ORDER BY o.order_date DESC", (current_user.id,)).fetchall()
-    conn.close()
-    return render_template('farmer_sales.html', orders=orders)
+    orders_page = fetch_page(conn, "SELECT o.id, o.quantity, o.total_price, o.order_status, o.order_date, c.crop_name, u.name as buyer_name FROM orders o JOIN crops c ON o.crop_id = c.id JOIN users u ON o.buyer_id = u.id",
+                             ["c.farmer_id = ?"], [current_user.id], [("o.order_date", "order_date"), ("o.id", "id")], request.args, 25)
+    return render_template('farmer_sales.html', orders=orders_page.items, pager=orders_page)
+
+@farmer_bp.route('/my_sales/export')
+@login_required
+def export_sales():
+    conditions, params = ["c.farmer_id = ?"], [current_user.id]
+    try:
+        extra_conditions, extra_params = exports.filters(request.args, 'o.order_date', 'o.order_status')
+        return exports.stream(f"""
+            SELECT o.id, o.order_date, o.order_status, c.crop_name, o.quantity, o.total_price, o.delivery_option,
+                   u.name AS buyer_name
+            FROM orders o JOIN crops c ON o.crop_id = c.id JOIN users u ON o.buyer_id = u.id
+            {exports.where(conditions + extra_conditions)}
+            ORDER BY o.order_date, o.id
+        """, params + extra_params, request.args.get('format', 'csv'), 'sales')
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('farmer.my_sales'))
 
 @farmer_bp.route('/update_order_status/<int:order_id>', methods=['POST'])
 @login_required
@@ -164,20 +244,27 @@ def update_order_status(order_id):
         return redirect(url_for('farmer.my_sales'))
 
     conn = get_db_connection()
-    order_details = conn.execute("SELECT o.id, c.crop_name, u.email as buyer_email, u.name as buyer_name FROM orders o JOIN users u ON o.buyer_id = u.id JOIN crops c ON o.crop_id = c.id WHERE o.id = ? AND c.farmer_id = ?", (order_id, current_user.id)).fetchone()
+    order_details = conn.execute("SELECT o.id, o.order_status, o.buyer_id, c.crop_name, u.email as buyer_email, u.name as buyer_name FROM orders o JOIN users u ON o.buyer_id = u.id JOIN crops c ON o.crop_id = c.id WHERE o.id = ? AND c.farmer_id = ?", (order_id, current_user.id)).fetchone()
 
     if not order_details:
         flash('Order not found or you do not have permission to update it.', 'danger')
-        conn.close()
         return redirect(url_for('farmer.my_sales'))
 
-    conn.execute("UPDATE orders SET order_status = ? WHERE id = ? AND crop_id IN (SELECT id FROM crops WHERE farmer_id = ?)", (new_status, order_id, current_user.id))
-    conn.commit()
-    conn.close()
+    if order_details['order_status'].lower() in inventory.RELEASED_STATUSES:
+        flash(f"Order #{order_id} is already {order_details['order_status']} and its stock has been returned.", 'warning')
+        return redirect(url_for('farmer.my_sales'))
+
+    if new_status.lower() == 'cancelled':
+        # Cancelling gives the reserved quantity back to the listing
+        inventory.release(conn, order_id, new_status)
+    else:
+        conn.execute("UPDATE orders SET order_status = ? WHERE id = ? AND crop_id IN (SELECT id FROM crops WHERE farmer_id = ?)", (new_status, order_id, current_user.id))
+        conn.commit()
 
     msg = Message(f"Update on your AgriLink Order #{order_id}", recipients=[order_details['buyer_email']])
     msg.body = f"Hello {order_details['buyer_name']},\n\nThe status of your order for '{order_details['crop_name']}' has been updated to: {new_status}.\n\nYou can view your full order history here: {url_for('buyer.view_my_orders', _external=True)}\n\nThank you for using AgriLink Malawi!"
-    farmer_bp.mail.send(msg)
+    outbox.enqueue(conn, msg)
+    push.notify(order_details['buyer_id'], 'order_status', {'order_id': order_id, 'status': new_status})
 
     flash(f'Order #{order_id} status has been updated to {new_status}.', 'success')
     return redirect(url_for('farmer.my_sales'))
\ No newline at end of file
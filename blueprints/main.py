@@ -1,19 +1,19 @@
 from flask import Blueprint, render_template, request, session, flash, redirect, url_for, current_app
 from flask_login import login_required, current_user
-from werkzeug.security import generate_password_hash
-from werkzeug.utils import secure_filename
-import sqlite3
-import os
+from db import get_db_connection
+import passwords
+import sessions
+import uploads
+import user_cache
+import page_cache
+import push
+from pagination import fetch_page
 
 main_bp = Blueprint('main', __name__)
 
-def get_db_connection():
-    conn = sqlite3.connect('agrilink.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+REVIEWS_PER_PAGE = 10
 
-@main_bp.route('/')
-def homepage():
+def _render_featured_crops():
     conn = get_db_connection()
     featured_crops = conn.execute("""
         SELECT c.*, u.name as farmer_name
@@ -21,8 +21,19 @@ def homepage():
         ORDER BY c.id DESC
         LIMIT 3
     """).fetchall()
-    conn.close()
-    return render_template('homepage.html', featured_crops=featured_crops)
+    return render_template('featured_crops.html', featured_crops=featured_crops)
+
+@main_bp.route('/')
+@page_cache.cached('crops')
+def homepage():
+    featured = page_cache.fragment(('featured_crops',), 'crops', _render_featured_crops)
+    return render_template('homepage.html', featured=featured)
+
+@main_bp.route('/events')
+@login_required
+def event_stream():
+    """Server-Sent Events stream of the current user's notifications."""
+    return current_app.extensions['push'].stream(current_user.id)
 
 @main_bp.route('/profile', methods=['GET', 'POST'])
 @login_required
@@ -39,6 +50,13 @@ def view_user_profile(user_id):
         name = request.form['name']
         email = request.form['email']
         password = request.form['password']
+        hashed_password = None
+        if password:
+            try:
+                hashed_password = passwords.hash_password(password)
+            except passwords.Busy:
+                flash('The server is busy; your profile was not changed. Please try again in a moment.', 'warning')
+                return redirect(url_for('main.view_user_profile', user_id=user_id))
 
         # Update farmer-specific fields
         if current_user.role == 'farmer':
@@ -50,31 +68,46 @@ def view_user_profile(user_id):
         conn.execute('UPDATE users SET name = ?, email = ? WHERE id = ?', (name, email, user_id))
         session['name'] = name
 
-        if password:
-            hashed_password = generate_password_hash(password)
+        if hashed_password:
             conn.execute('UPDATE users SET password = ? WHERE id = ?', (hashed_password, user_id))
+            # Signed in elsewhere with the old password? Not any more.
+            sessions.revoke_user(conn, user_id, keep_current=True)
 
+        old_pic = None
         if 'profile_pic' in request.files:
             file = request.files['profile_pic']
             if file.filename != '':
-                filename = secure_filename(file.filename)
-                save_path = os.path.join(app_config['UPLOAD_FOLDER'], filename)
-                file.save(save_path)
-                conn.execute('UPDATE users SET profile_pic = ? WHERE id = ?', (filename, user_id))
-                session['profile_pic'] = filename
+                try:
+                    filename = uploads.save_image(file, app_config['UPLOAD_FOLDER'])
+                except uploads.InvalidImage as e:
+                    flash(str(e), 'danger')
+                else:
+                    old_pic = conn.execute('SELECT profile_pic FROM users WHERE id = ?', (user_id,)).fetchone()[0]
+                    conn.execute('UPDATE users SET profile_pic = ? WHERE id = ?', (filename, user_id))
+                    session['profile_pic'] = filename
 
+        sessions.update_user(conn, user_id, name=session['name'], profile_pic=session.get('profile_pic'))
         conn.commit()
+        user_cache.invalidate(conn, user_id)
+        if old_pic and old_pic != session.get('profile_pic'):
+            uploads.discard(conn, app_config['UPLOAD_FOLDER'], old_pic)
         flash('Profile updated successfully!', 'success')
         return redirect(url_for('main.view_user_profile', user_id=user_id))
 
-    user_data = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    reviews = conn.execute("SELECT r.rating, r.comment, r.created_at as review_date, u.name as reviewer_name FROM reviews r JOIN users u ON r.reviewer_id = u.id WHERE r.reviewed_user_id = ? ORDER BY r.created_at DESC", (user_id,)).fetchall()
-    avg_rating_data = conn.execute('SELECT AVG(rating) as avg_rating FROM reviews WHERE reviewed_user_id = ?', (user_id,)).fetchone()
-    avg_rating = avg_rating_data['avg_rating'] if avg_rating_data['avg_rating'] else 0
-    conn.close()
+    user_data = conn.execute('SELECT * FROM users WHERE id = ? AND deleted_at IS NULL', (user_id,)).fetchone()
 
     if not user_data:
         flash('User not found.', 'danger')
         return redirect(url_for('main.homepage'))
 
-    return render_template('user_profile.html', user=user_data, reviews=reviews, avg_rating=avg_rating)
\ No newline at end of file
+    # Count, sum and histogram are kept on the user row by triggers on reviews.
+    avg_rating = user_data['rating_sum'] / user_data['rating_count'] if user_data['rating_count'] else 0
+    histogram = [(star, user_data[f'rating_{star}']) for star in range(5, 0, -1)]
+    reviews_page = fetch_page(conn, """
+        SELECT r.id, r.rating, r.comment, r.created_at, r.created_at as review_date, u.name as reviewer_name
+        FROM reviews r JOIN users u ON r.reviewer_id = u.id
+    """, ["r.reviewed_user_id = ?"], [user_id], [("r.created_at", "created_at"), ("r.id", "id")],
+        request.args, REVIEWS_PER_PAGE)
+
+    return render_template('user_profile.html', user=user_data, reviews=reviews_page.items, pager=reviews_page,
+                           avg_rating=avg_rating, histogram=histogram)
\ No newline at end of file
@@ -1,27 +1,91 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session
-from flask_login import login_required
+from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask_login import login_required, current_user
+from db import get_db_connection
+from pagination import fetch_page
+import conversations
+import push
 
 messaging_bp = Blueprint('messaging', __name__, url_prefix='/messaging')
 
+INBOX_PER_PAGE = 20
+THREAD_PER_PAGE = 30
+
+def _notify_receiver(receiver_id, conversation_id, message):
+    push.notify(receiver_id, 'new_message', {
+        'conversation_id': conversation_id,
+        'sender_name': current_user.name,
+        'preview': message[:80],
+    })
+
 @messaging_bp.route('/')
 @login_required
 def view_messages():
-    # This is a placeholder. In a real app, you would fetch conversations from the database.
-    return render_template('messages.html')
+    conn = get_db_connection()
+    inbox = fetch_page(conn, """
+        SELECT cm.conversation_id, cm.unread, cm.last_message_id, c.subject,
+               u.id AS other_id, u.name AS other_name, u.profile_pic AS other_pic,
+               m.message AS last_message, m.sent_at AS last_sent_at, m.sender_id AS last_sender_id,
+               cr.crop_name, d.crop_name AS demand_crop_name
+        FROM conversation_members cm
+        JOIN conversations c ON c.id = cm.conversation_id
+        JOIN messages m ON m.id = cm.last_message_id
+        LEFT JOIN users u ON u.id = CASE WHEN c.user_low = cm.user_id THEN c.user_high ELSE c.user_low END
+        LEFT JOIN crops cr ON cr.id = c.crop_id
+        LEFT JOIN demands d ON d.id = c.demand_id
+    """, ["cm.user_id = ?"], [current_user.id], [("cm.last_message_id", "last_message_id")], request.args, INBOX_PER_PAGE)
+    return render_template('messages.html', conversations=inbox.items, pager=inbox,
+                           unread_total=conversations.unread_total(conn, current_user.id))
+
+@messaging_bp.route('/conversation/<int:conversation_id>', methods=['GET', 'POST'])
+@login_required
+def view_conversation(conversation_id):
+    conn = get_db_connection()
+    conversation = conversations.membership(conn, conversation_id, current_user.id)
+    if not conversation:
+        flash('Conversation not found.', 'danger')
+        return redirect(url_for('messaging.view_messages'))
+
+    if request.method == 'POST':
+        message = request.form.get('message', '').strip()
+        if not message:
+            flash('Please write a message.', 'danger')
+        else:
+            try:
+                conversations.send(conn, current_user.id, conversation['other_id'], message, conversation_id=conversation_id)
+            except conversations.MessagingError as e:
+                flash(str(e), 'danger')
+            else:
+                _notify_receiver(conversation['other_id'], conversation_id, message)
+        return redirect(url_for('messaging.view_conversation', conversation_id=conversation_id))
+
+    # Newest messages first; "after" pages back through older ones.
+    thread = fetch_page(conn, "SELECT m.id, m.sender_id, m.subject, m.message, m.sent_at FROM messages m",
+                        ["m.conversation_id = ?"], [conversation_id], [("m.id", "id")], request.args, THREAD_PER_PAGE)
+    if conversation['unread'] and not request.args.get('after'):
+        conversations.mark_read(conn, conversation_id, current_user.id)
+    return render_template('conversation.html', conversation=conversation,
+                           messages=list(reversed(thread.items)), pager=thread)
 
 @messaging_bp.route('/send/<int:receiver_id>', methods=['GET', 'POST'])
 @login_required
 def send_message(receiver_id):
-    crop_id = request.args.get('crop_id')
-    demand_id = request.args.get('demand_id')
+    crop_id = request.args.get('crop_id', type=int)
+    demand_id = request.args.get('demand_id', type=int)
 
     if request.method == 'POST':
-        # In a real app, you would save the message to the database here.
+        message = request.form.get('message', '').strip()
+        subject = request.form.get('subject', '').strip() or None
+        if not message:
+            flash('Please write a message.', 'danger')
+            return redirect(url_for('messaging.send_message', receiver_id=receiver_id, crop_id=crop_id, demand_id=demand_id))
+        conn = get_db_connection()
+        try:
+            conversation_id = conversations.send(conn, current_user.id, receiver_id, message, subject, crop_id, demand_id)
+        except conversations.MessagingError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('messaging.view_messages'))
+        _notify_receiver(receiver_id, conversation_id, message)
         flash('Message sent successfully!', 'success')
-        if session.get('role') == 'farmer':
-            return redirect(url_for('farmer.dashboard'))
-        elif session.get('role') == 'buyer':
-            return redirect(url_for('buyer.dashboard'))
-        return redirect(url_for('main.homepage'))
+        return redirect(url_for('messaging.view_conversation', conversation_id=conversation_id))
 
-    return render_template('send_message.html', receiver_id=receiver_id, crop_id=crop_id, demand_id=demand_id)
\ No newline at end of file
+    return render_template('send_message.html', receiver_id=receiver_id, crop_id=crop_id, demand_id=demand_id)
@@ -0,0 +1,146 @@
+"""Conversations between two users, optionally about a crop or a demand.
+
+Every message between users belongs to a conversation identified by its two
+participants plus the crop/demand it is about. Each participant has a
+``conversation_members`` row carrying the id of the conversation's latest
+message and their unread count; triggers on ``messages`` keep those, and the
+per-user total in ``users.unread_messages``, up to date as messages are
+written or deleted. An inbox page is then a range scan on
+``(user_id, last_message_id)`` and a thread page one on
+``messages (conversation_id, id)``, whatever the mailbox size.
+
+Contact-form messages (no sender account) stay outside conversations.
+"""
+
+
+class MessagingError(Exception):
+    pass
+
+
+def _participants(user_a, user_b):
+    return min(user_a, user_b), max(user_a, user_b)
+
+
+def get_or_create(conn, user_a, user_b, crop_id=None, demand_id=None, subject=None):
+    """Return the id of the conversation between two users about a crop/demand."""
+    low, high = _participants(user_a, user_b)
+    row = conn.execute("""
+        SELECT id FROM conversations
+        WHERE user_low = ? AND user_high = ? AND IFNULL(crop_id, 0) = IFNULL(?, 0) AND IFNULL(demand_id, 0) = IFNULL(?, 0)
+    """, (low, high, crop_id, demand_id)).fetchone()
+    if row:
+        return row[0]
+    cursor = conn.execute('INSERT INTO conversations (user_low, user_high, crop_id, demand_id, subject) VALUES (?, ?, ?, ?, ?)',
+                          (low, high, crop_id, demand_id, subject))
+    conn.executemany('INSERT INTO conversation_members (conversation_id, user_id) VALUES (?, ?)',
+                     [(cursor.lastrowid, low), (cursor.lastrowid, high)])
+    return cursor.lastrowid
+
+
+def send(conn, sender_id, receiver_id, message, subject=None, crop_id=None, demand_id=None, conversation_id=None):
+    """Store a message from one user to another and commit. Returns the conversation id."""
+    if sender_id == receiver_id:
+        raise MessagingError('You cannot send a message to yourself.')
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        receiver = conn.execute('SELECT name FROM users WHERE id = ? AND deleted_at IS NULL', (receiver_id,)).fetchone()
+        if receiver is None:
+            raise MessagingError('That user no longer exists.')
+        if conversation_id is None:
+            conversation_id = get_or_create(conn, sender_id, receiver_id, crop_id, demand_id, subject)
+        else:
+            conversation = conn.execute('SELECT crop_id, demand_id FROM conversations WHERE id = ?',
+                                        (conversation_id,)).fetchone()
+            crop_id, demand_id = conversation
+        sender = conn.execute('SELECT name FROM users WHERE id = ?', (sender_id,)).fetchone()
+        conn.execute("""
+            INSERT INTO messages (conversation_id, sender_id, receiver_id, crop_id, demand_id, sender_name, subject, message)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (conversation_id, sender_id, receiver_id, crop_id, demand_id, sender[0] if sender else None, subject, message))
+        conn.commit()
+        return conversation_id
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def membership(conn, conversation_id, user_id):
+    """The conversation as seen by ``user_id``, or None if they are not part of it."""
+    return conn.execute("""
+        SELECT c.id, c.subject, c.crop_id, c.demand_id, cm.unread,
+               u.id AS other_id, u.name AS other_name, u.profile_pic AS other_pic,
+               cr.crop_name, d.crop_name AS demand_crop_name
+        FROM conversation_members cm
+        JOIN conversations c ON c.id = cm.conversation_id
+        LEFT JOIN users u ON u.id = CASE WHEN c.user_low = cm.user_id THEN c.user_high ELSE c.user_low END
+        LEFT JOIN crops cr ON cr.id = c.crop_id
+        LEFT JOIN demands d ON d.id = c.demand_id
+        WHERE cm.conversation_id = ? AND cm.user_id = ?
+    """, (conversation_id, user_id)).fetchone()
+
+
+def mark_read(conn, conversation_id, user_id):
+    """Clear ``user_id``'s unread count for a conversation and commit."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute('SELECT unread FROM conversation_members WHERE conversation_id = ? AND user_id = ?',
+                           (conversation_id, user_id)).fetchone()
+        if row and row[0]:
+            conn.execute('UPDATE users SET unread_messages = MAX(unread_messages - ?, 0) WHERE id = ?', (row[0], user_id))
+            conn.execute("""
+                UPDATE conversation_members SET unread = 0, last_read_message_id = last_message_id
+                WHERE conversation_id = ? AND user_id = ?
+            """, (conversation_id, user_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def unread_total(conn, user_id):
+    row = conn.execute('SELECT unread_messages FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def rebuild(conn):
+    """Group existing messages into conversations and recompute every counter.
+
+    Used as the migration backfill; safe to re-run. Existing messages count
+    as unread. Runs inside the caller's transaction.
+    """
+    conn.execute("""
+        INSERT INTO conversations (user_low, user_high, crop_id, demand_id, subject, created_at)
+        SELECT MIN(sender_id, receiver_id), MAX(sender_id, receiver_id), crop_id, demand_id, MIN(subject), MIN(sent_at)
+        FROM messages
+        WHERE sender_id IS NOT NULL AND conversation_id IS NULL AND sender_id != receiver_id
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT DO NOTHING
+    """)
+    conn.execute("""
+        UPDATE messages SET conversation_id = (
+            SELECT c.id FROM conversations c
+            WHERE c.user_low = MIN(messages.sender_id, messages.receiver_id)
+              AND c.user_high = MAX(messages.sender_id, messages.receiver_id)
+              AND IFNULL(c.crop_id, 0) = IFNULL(messages.crop_id, 0)
+              AND IFNULL(c.demand_id, 0) = IFNULL(messages.demand_id, 0))
+        WHERE sender_id IS NOT NULL AND conversation_id IS NULL AND sender_id != receiver_id
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO conversation_members (conversation_id, user_id)
+        SELECT id, user_low FROM conversations UNION ALL SELECT id, user_high FROM conversations
+    """)
+    conn.execute("""
+        UPDATE conversation_members SET last_message_id =
+            (SELECT MAX(id) FROM messages m WHERE m.conversation_id = conversation_members.conversation_id)
+    """)
+    conn.execute("""
+        UPDATE conversation_members SET unread =
+            (SELECT COUNT(*) FROM messages m
+             WHERE m.conversation_id = conversation_members.conversation_id
+               AND m.receiver_id = conversation_members.user_id
+               AND m.id > conversation_members.last_read_message_id)
+    """)
+    conn.execute("""
+        UPDATE users SET unread_messages =
+            (SELECT IFNULL(SUM(unread), 0) FROM conversation_members cm WHERE cm.user_id = users.id)
+    """)
@@ -0,0 +1,387 @@
+"""Bulk crop listing import for cooperatives.
+
+``import_rows()`` takes numbered row dicts from ``read_csv()``,
+``read_xlsx()`` or ``read_json()``, validates them one at a time and inserts
+the valid ones in transactions of ``BATCH_SIZE`` listings, so a file of tens
+of thousands of lots is never held in memory and each commit covers a
+thousand rows. Invalid rows are skipped and reported by row number.
+
+Work that would hold up the upload is queued in ``crop_import_queue``:
+scoring each new listing for matching.py, and fetching its ``image_url``
+(which uploads.py then thumbnails). A background worker drains the queue.
+Imported listings are searchable straight away; their matches and photos
+follow shortly after.
+
+openpyxl is optional: without it only CSV and JSON can be imported.
+"""
+import csv
+import datetime
+import io
+import ipaddress
+import math
+import socket
+import sqlite3
+import threading
+import urllib.parse
+
+import requests
+from werkzeug.datastructures import FileStorage
+
+try:
+    import openpyxl
+except ImportError:  # Excel uploads are refused
+    openpyxl = None
+
+import matching
+import uploads
+from db import connect
+from quantities import parse_quantity
+
+BATCH_SIZE = 1000
+MAX_ROWS = 100000
+MAX_REPORTED_ERRORS = 200  # per import; later errors are only counted
+MAX_TEXT = 200
+COLUMNS = ('crop_name', 'quantity', 'price', 'quality', 'crop_grade', 'harvest_date', 'location', 'image_url')
+REQUIRED = ('crop_name', 'quantity', 'price')
+
+WORKER_THREADS = 1
+WORKER_BATCH = 50  # listings scored per transaction, under 200 ms of write lock
+BATCH_PAUSE = 0.1  # seconds between transactions, so request writes get the lock
+IMAGE_BATCH = 10
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+MAX_REDIRECTS = 3
+FETCH_TIMEOUT = 15
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 300
+LEASE_SECONDS = 300
+IDLE_POLL = 30
+
+_wakeup = threading.Event()
+
+
+class RowError(ValueError):
+    pass
+
+
+class ImageFetchError(ValueError):
+    pass
+
+
+def _header(name):
+    """'Crop Name' / 'crop-name' -> 'crop_name'."""
+    return '_'.join(str(name or '').strip().lower().replace('-', ' ').split())
+
+
+def read_csv(stream):
+    """``(line number, row)`` pairs from a binary CSV stream with a header row."""
+    reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    header = [_header(name) for name in next(reader, [])]
+    for values in reader:
+        if any(value.strip() for value in values):
+            yield reader.line_num, dict(zip(header, values))
+
+
+def read_xlsx(stream):
+    """``(row number, row)`` pairs from the first sheet of an .xlsx workbook."""
+    if openpyxl is None:
+        raise ValueError('Excel import is not available on this server; please upload a CSV file.')
+    return _xlsx_rows(openpyxl.load_workbook(stream, read_only=True, data_only=True))
+
+
+def _xlsx_rows(workbook):
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = [_header(name) for name in next(rows, ())]
+        for number, values in enumerate(rows, start=2):
+            if any(value not in (None, '') for value in values):
+                yield number, dict(zip(header, values))
+    finally:
+        workbook.close()
+
+
+def read_json(payload):
+    """``(position, row)`` pairs from a JSON list of objects, or ``{"crops": [...]}``."""
+    if isinstance(payload, dict):
+        payload = payload.get('crops')
+    if not isinstance(payload, list):
+        raise ValueError('Expected a JSON list of crops or an object with a "crops" list.')
+    return enumerate(payload, start=1)
+
+
+READERS = {'.csv': read_csv, '.xlsx': read_xlsx}
+
+
+def _text(row, name):
+    value = row.get(name)
+    if value is None:
+        return None
+    value = str(value).strip()
+    if len(value) > MAX_TEXT:
+        raise RowError(f'{name} is longer than {MAX_TEXT} characters')
+    return value or None
+
+
+def _number_text(value):
+    # Spreadsheets hand back 500.0 for a cell showing 500.
+    return str(int(value)) if isinstance(value, float) and value.is_integer() else value
+
+
+def validate(row):
+    """``(crop columns, image_url)`` for one row, or RowError saying what is wrong."""
+    if not isinstance(row, dict):
+        raise RowError('row must be an object')
+    row = {_header(key): _number_text(value) for key, value in row.items()}
+    missing = [name for name in REQUIRED if not _text(row, name)]
+    if missing:
+        raise RowError(f"missing {', '.join(missing)}")
+
+    crop_name = _text(row, 'crop_name')
+    quantity = _text(row, 'quantity')
+    quantity_value, quantity_unit = parse_quantity(quantity)
+    if not quantity_value or quantity_value <= 0:
+        raise RowError(f"quantity '{quantity}' should be an amount such as '500 kg' or '2 tonnes'")
+    try:
+        price = float(str(row['price']).replace(',', ''))
+    except ValueError:
+        raise RowError(f"price '{row['price']}' is not a number")
+    if not math.isfinite(price) or price <= 0:
+        raise RowError('price must be more than zero')
+
+    harvest_date = row.get('harvest_date')
+    if isinstance(harvest_date, (datetime.date, datetime.datetime)):
+        harvest_date = harvest_date.strftime('%Y-%m-%d')
+    elif harvest_date not in (None, ''):
+        try:
+            harvest_date = datetime.date.fromisoformat(str(harvest_date).strip()[:10]).isoformat()
+        except ValueError:
+            raise RowError(f"harvest_date '{harvest_date}' should look like 2025-06-30")
+    else:
+        harvest_date = None
+
+    image_url = _text(row, 'image_url')
+    if image_url and urllib.parse.urlsplit(image_url).scheme not in ('http', 'https'):
+        raise RowError('image_url must be an http(s) address')
+
+    return (crop_name, quantity, quantity_value, quantity_unit, price, _text(row, 'quality'),
+            _text(row, 'crop_grade'), harvest_date, _text(row, 'location'),
+            matching.normalize_name(crop_name)), image_url
+
+
+class ImportResult:
+
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, row, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row, 'error': message})
+
+    def to_dict(self):
+        return {'rows': self.rows, 'imported': self.imported, 'failed': self.error_count, 'errors': self.errors}
+
+
+def _insert(conn, farmer_id, batch):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        queued = []
+        for columns, image_url in batch:
+            cursor = conn.execute("""
+                INSERT INTO crops (crop_name, quantity, quantity_value, quantity_unit, price, quality, crop_grade,
+                                   harvest_date, location, match_name, farmer_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, columns + (farmer_id,))
+            queued.append((cursor.lastrowid, image_url))
+        conn.executemany('INSERT INTO crop_import_queue (crop_id, image_url) VALUES (?, ?)', queued)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(batch)
+
+
+def import_rows(conn, farmer_id, rows, batch_size=BATCH_SIZE, max_rows=MAX_ROWS):
+    """Validate and insert numbered ``rows`` for ``farmer_id``. Returns an ImportResult.
+
+    Each batch commits on its own: if the file turns out to be unreadable part
+    way through, the rows before that point stay imported and the error is
+    reported against the row where reading stopped.
+    """
+    result = ImportResult()
+    batch = []
+    number = 0
+    try:
+        for number, row in rows:
+            if result.rows >= max_rows:
+                result.add_error(number, f'only {max_rows} rows can be imported at once; the rest were skipped')
+                break
+            result.rows += 1
+            try:
+                batch.append(validate(row))
+            except RowError as e:
+                result.add_error(number, str(e))
+                continue
+            if len(batch) >= batch_size:
+                result.imported += _insert(conn, farmer_id, batch)
+                batch = []
+    except (csv.Error, UnicodeDecodeError, ValueError, OSError) as e:
+        # openpyxl reports damaged workbooks as ValueError or zipfile errors (OSError subclasses).
+        result.add_error(number + 1, f'could not read the file: {e}')
+    if batch:
+        result.imported += _insert(conn, farmer_id, batch)
+    if result.imported:
+        _wakeup.set()
+    return result
+
+
+def _check_host(url):
+    """Refuse URLs that resolve to loopback, private or link-local addresses."""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageFetchError('not an http(s) URL')
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(parts.hostname, None)}
+    except socket.gaierror as e:
+        raise ImageFetchError(f'cannot resolve {parts.hostname}: {e}')
+    if not all(ipaddress.ip_address(address.split('%')[0]).is_global for address in addresses):
+        raise ImageFetchError(f'{parts.hostname} is not a public address')
+
+
+def fetch_image(url, upload_folder):
+    """Download ``url`` and store it like an upload. Returns the stored filename."""
+    for _ in range(MAX_REDIRECTS + 1):
+        _check_host(url)
+        response = requests.get(url, stream=True, timeout=FETCH_TIMEOUT, allow_redirects=False)
+        if not response.is_redirect:
+            break
+        url = urllib.parse.urljoin(url, response.headers['Location'])
+        response.close()
+    else:
+        raise ImageFetchError('too many redirects')
+    with response:
+        response.raise_for_status()
+        body = io.BytesIO()
+        for chunk in response.iter_content(uploads.CHUNK_SIZE):
+            body.write(chunk)
+            if body.tell() > MAX_IMAGE_BYTES:
+                raise ImageFetchError(f'image is larger than {MAX_IMAGE_BYTES // (1024 * 1024)} MB')
+    body.seek(0)
+    return uploads.save_image(FileStorage(body), upload_folder)
+
+
+def index_batch(conn, limit=WORKER_BATCH):
+    """Score the next imported listings for matching. Returns how many were scored."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        crop_ids = [row[0] for row in conn.execute(
+            'SELECT crop_id FROM crop_import_queue WHERE indexed = 0 ORDER BY crop_id LIMIT ?', (limit,))]
+        for crop_id in crop_ids:
+            matching.index_crop(conn, crop_id)
+        params = [(crop_id,) for crop_id in crop_ids]
+        conn.executemany('DELETE FROM crop_import_queue WHERE crop_id = ? AND image_url IS NULL', params)
+        conn.executemany('UPDATE crop_import_queue SET indexed = 1 WHERE crop_id = ?', params)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(crop_ids)
+
+
+def _claim_images(conn, limit):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rows = conn.execute("""
+            SELECT crop_id, image_url, attempts FROM crop_import_queue
+            WHERE indexed = 1 AND image_url IS NOT NULL AND attempts < ?
+              AND next_attempt_at <= datetime('now') AND (locked_until IS NULL OR locked_until <= datetime('now'))
+            ORDER BY next_attempt_at
+            LIMIT ?
+        """, (MAX_ATTEMPTS, limit)).fetchall()
+        conn.executemany("UPDATE crop_import_queue SET locked_until = datetime('now', ?) WHERE crop_id = ?",
+                         [(f'+{LEASE_SECONDS} seconds', row['crop_id']) for row in rows])
+        conn.commit()
+        return rows
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def fetch_batch(conn, upload_folder, limit=IMAGE_BATCH):
+    """Fetch the images of the next imported listings. Returns how many were attempted."""
+    rows = _claim_images(conn, limit)
+    for row in rows:
+        try:
+            filename = fetch_image(row['image_url'], upload_folder)
+        except (requests.RequestException, ImageFetchError, uploads.InvalidImage, OSError) as e:
+            conn.execute("""
+                UPDATE crop_import_queue SET attempts = attempts + 1, last_error = ?, locked_until = NULL,
+                    next_attempt_at = datetime('now', ?)
+                WHERE crop_id = ?
+            """, (str(e)[:500], f'+{RETRY_DELAY} seconds', row['crop_id']))
+            conn.commit()
+            continue
+        updated = conn.execute('UPDATE crops SET image = ? WHERE id = ? AND image IS NULL',
+                               (filename, row['crop_id'])).rowcount
+        conn.execute('DELETE FROM crop_import_queue WHERE crop_id = ?', (row['crop_id'],))
+        conn.commit()
+        if not updated:
+            uploads.discard(conn, upload_folder, filename)
+    return len(rows)
+
+
+def pending(conn):
+    return conn.execute('SELECT COUNT(*) FROM crop_import_queue WHERE indexed = 0 OR attempts < ?',
+                        (MAX_ATTEMPTS,)).fetchone()[0]
+
+
+class ImportWorker:
+    """Background threads finishing imported listings for one Flask app."""
+
+    def __init__(self, app, threads=WORKER_THREADS):
+        self.app = app
+        self.threads = threads
+        self._stop = threading.Event()
+        self._workers = []
+
+    def start(self):
+        for i in range(self.threads):
+            worker = threading.Thread(target=self._run, name=f'crop-import-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        self._stop.set()
+        _wakeup.set()
+
+    def run_once(self, conn):
+        indexed = index_batch(conn)
+        fetched = fetch_batch(conn, self.app.config['UPLOAD_FOLDER']) if not indexed else 0
+        return indexed + fetched
+
+    def _run(self):
+        conn = connect(self.app.config['DATABASE'])
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    done = self.run_once(conn)
+                except sqlite3.Error:
+                    self.app.logger.exception('Crop import worker failed')
+                    done = 0
+                if done:
+                    self._stop.wait(BATCH_PAUSE)
+                else:
+                    _wakeup.wait(IDLE_POLL)
+                    _wakeup.clear()
+        conn.close()
+
+
+def init_app(app):
+    app.config.setdefault('CROP_IMPORT_THREADS', WORKER_THREADS)
+    worker = ImportWorker(app, app.config['CROP_IMPORT_THREADS'])
+    app.extensions['crop_import'] = worker
+    if app.config['CROP_IMPORT_THREADS']:
+        worker.start()
+    return worker
@@ -0,0 +1,136 @@
+"""Shared SQLite connection layer.
+
+Every request borrows a single connection from a small per-process pool the
+first time it calls ``get_db_connection()`` and hands it back when the app
+context is torn down, so routes no longer pay connect + page-cache warmup on
+every hit. Connections are configured once, when they are first opened.
+"""
+import os
+import queue
+import sqlite3
+import threading
+
+from flask import current_app, g
+
+from migrations import migrate
+from query_log import InstrumentedConnection
+
+DEFAULT_DATABASE = 'agrilink.db'
+
+# Applied once per physical connection.
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',     # ~16 MB of page cache per connection
+    'PRAGMA mmap_size = 268435456',   # 256 MB memory-mapped I/O
+    'PRAGMA busy_timeout = 5000',     # wait up to 5s for a competing writer
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA foreign_keys = ON',      # enforce the ON DELETE rules, see migrations.FOREIGN_KEY_ACTIONS
+)
+
+
+def connect(database=DEFAULT_DATABASE):
+    """Open a new, fully configured connection (for scripts and workers)."""
+    conn = sqlite3.connect(database, timeout=5, check_same_thread=False, factory=InstrumentedConnection)
+    conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """A LIFO pool of idle connections owned by one worker process.
+
+    LIFO keeps the most recently used (and therefore warmest) connection in
+    play. The pool remembers the pid that created it and starts over after a
+    fork, so pre-forking servers never share a connection between workers.
+    """
+
+    def __init__(self, database, max_idle=8):
+        self.database = database
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue(maxsize=self.max_idle)
+        self.created = 0
+        self.in_use = 0
+
+    def acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Inherited connections must not be touched in the child.
+                self._reset()
+            self.in_use += 1
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            conn = connect(self.database)
+        except Exception:
+            with self._lock:
+                self.in_use -= 1
+            raise
+        with self._lock:
+            self.created += 1
+        return conn
+
+    def release(self, conn):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self.in_use -= 1
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+    def stats(self):
+        return {
+            'created': self.created,
+            'in_use': self.in_use,
+            'idle': self._idle.qsize(),
+            'max_idle': self.max_idle,
+        }
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def init_app(app):
+    app.config.setdefault('DATABASE', DEFAULT_DATABASE)
+    app.config.setdefault('DATABASE_POOL_SIZE', 8)
+    app.config.setdefault('DATABASE_AUTO_MIGRATE', True)
+    if app.config['DATABASE_AUTO_MIGRATE']:
+        conn = connect(app.config['DATABASE'])
+        try:
+            migrate(conn)
+        finally:
+            conn.close()
+    app.extensions['db_pool'] = ConnectionPool(app.config['DATABASE'],
+                                               app.config['DATABASE_POOL_SIZE'])
+    app.teardown_appcontext(close_db_connection)
+
+
+def get_db_connection():
+    """Return the connection bound to the current app context."""
+    if 'db' not in g:
+        g.db = current_app.extensions['db_pool'].acquire()
+        g.db.query_log = g.get('query_log')
+    return g.db
+
+
+def close_db_connection(exc=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        conn.query_log = None
+        current_app.extensions['db_pool'].release(conn)
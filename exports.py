@@ -0,0 +1,105 @@
+"""Streaming CSV and NDJSON exports.
+
+An export runs on its own connection, opened when the response starts
+streaming and closed when it finishes or the client goes away. SQLite steps
+the cursor as rows are written out, so memory stays at one batch of rows
+whatever the date range, and a long download never holds one of the pool's
+connections.
+"""
+import csv
+import datetime
+import io
+import json
+
+from flask import Response, current_app
+
+from db import connect
+
+BATCH_SIZE = 500
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+# Spreadsheets treat cells starting with these as formulas.
+_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _parse_date(value, name):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"'{name}' must be a date like 2025-01-31.")
+
+
+def filters(args, date_column, status_column=None):
+    """WHERE conditions and parameters from ``from``/``to`` dates and a comma-separated ``status``.
+
+    Both dates are inclusive. Raises ValueError with a message for the user.
+    """
+    conditions, params = [], []
+    start, end = args.get('from'), args.get('to')
+    if start:
+        conditions.append(f'{date_column} >= ?')
+        params.append(_parse_date(start, 'from').isoformat())
+    if end:
+        conditions.append(f'{date_column} < ?')
+        params.append((_parse_date(end, 'to') + datetime.timedelta(days=1)).isoformat())
+    if start and end and start > end:
+        raise ValueError("'from' must not be after 'to'.")
+    statuses = [s.strip().lower() for s in args.get('status', '').split(',') if s.strip()]
+    if statuses and status_column:
+        conditions.append(f"LOWER({status_column}) IN ({', '.join('?' * len(statuses))})")
+        params.extend(statuses)
+    return conditions, params
+
+
+def _csv_cell(value):
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _csv(columns, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_csv_cell(v) for v in row] for row in rows)
+        yield buffer.getvalue()
+
+
+def _ndjson(columns, batches):
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(columns, row)), default=str) + '\n' for row in rows)
+
+
+def stream(query, params, fmt, filename):
+    """Response streaming the rows of ``query`` as ``fmt`` ('csv' or 'ndjson')."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format '{fmt}'.")
+    mimetype, extension = FORMATS[fmt]
+    encode = _csv if fmt == 'csv' else _ndjson
+    database = current_app.config['DATABASE']
+
+    def generate():
+        conn = connect(database)
+        try:
+            cursor = conn.execute(query, params)
+            columns = [d[0] for d in cursor.description]
+            batches = iter(lambda: cursor.fetchmany(BATCH_SIZE), [])
+            yield from encode(columns, batches)
+        finally:
+            conn.close()
+
+    return Response(generate(), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}.{extension}"',
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+def where(conditions):
+    return f"WHERE {' AND '.join(conditions)}" if conditions else ''
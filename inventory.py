@@ -0,0 +1,186 @@
+"""Stock reservations for crop purchases.
+
+``reserve()`` takes the database write lock (``BEGIN IMMEDIATE``), decrements
+the crop's ``quantity_value`` only if enough stock is left and creates the
+pending order in the same transaction, so concurrent buyers can never oversell
+a listing. The order holds its stock until ``reserved_until``; if PayChangu
+never confirms payment by then, the sweeper marks it expired and puts the
+stock back.
+
+``edit_stock()`` applies a farmer's edit of the quantity without giving back
+stock that was reserved while the edit form was open.
+
+Usage: python inventory.py [path/to/agrilink.db]   (run one sweep)
+"""
+import sqlite3
+import sys
+import threading
+import time
+
+from db import connect
+from quantities import format_quantity, parse_quantity
+
+DELIVERY_FEE = 5000  # MWK, estimated
+RESERVATION_TTL = 30 * 60  # seconds
+SWEEP_INTERVAL = 60  # seconds
+SWEEP_BATCH = 200
+
+# Statuses whose stock has already been returned to the listing.
+RELEASED_STATUSES = ('expired', 'cancelled')
+
+
+class InsufficientStock(Exception):
+    pass
+
+
+class StockChanged(Exception):
+    pass
+
+
+def _restock_text(conn, crop_id, delta):
+    """Apply ``delta`` to a crop's stock and keep the display text in step."""
+    crop = conn.execute('SELECT quantity_value, quantity_unit FROM crops WHERE id = ?', (crop_id,)).fetchone()
+    if crop is None or crop[0] is None:
+        return
+    remaining = crop[0] + delta
+    conn.execute('UPDATE crops SET quantity_value = ?, quantity = ? WHERE id = ?',
+                 (remaining, format_quantity(remaining, crop[1]), crop_id))
+
+
+def reserve(conn, crop_id, buyer_id, quantity, delivery_option, ttl=RESERVATION_TTL):
+    """Reserve ``quantity`` of a crop and create its pending order.
+
+    Returns ``(order_id, total_price)``; raises InsufficientStock when the
+    listing does not have that much left.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        crop = conn.execute('SELECT price, quantity_value, quantity_unit FROM crops WHERE id = ?',
+                            (crop_id,)).fetchone()
+        if crop is None:
+            raise InsufficientStock('This crop is no longer listed.')
+        price, available, unit = crop
+        if available is None:
+            raise InsufficientStock('This listing has no purchasable quantity. Please contact the farmer.')
+
+        remaining = available - quantity
+        updated = conn.execute(
+            'UPDATE crops SET quantity_value = ?, quantity = ? WHERE id = ? AND quantity_value >= ?',
+            (remaining, format_quantity(remaining, unit), crop_id, quantity))
+        if updated.rowcount == 0:
+            raise InsufficientStock(f'Only {format_quantity(available, unit)} is still available.')
+
+        total_price = quantity * price
+        if delivery_option == 'delivery':
+            total_price += DELIVERY_FEE
+
+        cursor = conn.execute("""
+            INSERT INTO orders (buyer_id, crop_id, quantity, total_price, delivery_option, payment_number, order_status, reserved_until)
+            VALUES (?, ?, ?, ?, ?, ?, 'pending', datetime('now', ?))
+        """, (buyer_id, crop_id, quantity, total_price, delivery_option, None, f'{int(ttl):+d} seconds'))
+        conn.commit()
+        return cursor.lastrowid, total_price
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def edit_stock(conn, crop_id, loaded_value, quantity):
+    """Set a listing's quantity to the farmer's ``quantity`` text, in the caller's transaction.
+
+    ``loaded_value`` is the ``quantity_value`` the edit form was loaded with.
+    In the same unit only the farmer's change (new minus loaded) is applied,
+    so orders placed meanwhile keep their stock. Otherwise the new quantity
+    replaces the old one only if the stock is still ``loaded_value``;
+    StockChanged is raised if it moved.
+    """
+    value, unit = parse_quantity(quantity)
+    crop = conn.execute('SELECT quantity_unit FROM crops WHERE id = ?', (crop_id,)).fetchone()
+    if value is not None and loaded_value is not None and crop is not None and unit == crop[0]:
+        if value != loaded_value:
+            # The UPDATE takes the write lock, so the text is rewritten from the value it left.
+            conn.execute('UPDATE crops SET quantity_value = MAX(quantity_value + ?, 0) WHERE id = ?',
+                         (value - loaded_value, crop_id))
+            _restock_text(conn, crop_id, 0)
+        return
+    updated = conn.execute('UPDATE crops SET quantity = ?, quantity_value = ?, quantity_unit = ? '
+                           'WHERE id = ? AND quantity_value IS ?', (quantity, value, unit, crop_id, loaded_value))
+    if updated.rowcount == 0:
+        raise StockChanged('Some of this listing was ordered while you were editing it. '
+                           'Please check the quantity and save again.')
+
+
+def release(conn, order_id, new_status, only_if_expired=False):
+    """Close an unpaid order with ``new_status`` and return its stock.
+
+    Safe to call concurrently and repeatedly: stock is only returned by the
+    caller that actually moved the order out of an open status. Returns True
+    if this call released the reservation.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        condition = "id = ? AND LOWER(order_status) NOT IN (?, ?)"
+        params = [order_id, *RELEASED_STATUSES]
+        if only_if_expired:
+            condition += " AND order_status = 'pending' AND reserved_until <= datetime('now')"
+        order = conn.execute(f"SELECT crop_id, quantity FROM orders WHERE {condition}", params).fetchone()
+        if order is None:
+            conn.rollback()
+            return False
+        conn.execute(f"UPDATE orders SET order_status = ?, reserved_until = NULL WHERE {condition}",
+                     [new_status] + params)
+        _restock_text(conn, order[0], order[1])
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def release_expired(conn, batch=SWEEP_BATCH):
+    """Expire every pending order whose reservation has lapsed. Returns the count."""
+    released = 0
+    while True:
+        expired = conn.execute("""
+            SELECT id FROM orders
+            WHERE order_status = 'pending' AND reserved_until <= datetime('now')
+            LIMIT ?
+        """, (batch,)).fetchall()
+        if conn.in_transaction:
+            conn.rollback()
+        for (order_id,) in expired:
+            released += release(conn, order_id, 'expired', only_if_expired=True)
+        if len(expired) < batch:
+            return released
+
+
+def start_sweeper(app):
+    """Run release_expired() every RESERVATION_SWEEP_INTERVAL seconds in a daemon thread."""
+    database = app.config['DATABASE']
+    interval = app.config.get('RESERVATION_SWEEP_INTERVAL', SWEEP_INTERVAL)
+
+    def sweep_forever():
+        while True:
+            time.sleep(interval)
+            try:
+                conn = connect(database)
+                try:
+                    count = release_expired(conn)
+                finally:
+                    conn.close()
+                if count:
+                    app.logger.info('Released %d expired stock reservations', count)
+            except sqlite3.Error:
+                app.logger.exception('Reservation sweep failed')
+
+    thread = threading.Thread(target=sweep_forever, name='reservation-sweeper', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else 'agrilink.db'
+    conn = sqlite3.connect(database, timeout=5)
+    count = release_expired(conn)
+    conn.close()
+    print(f"Released {count} expired reservations.")
@@ -0,0 +1,288 @@
+"""Match buyers' demands to farmers' crop listings.
+
+Each crop and demand gets a normalized ``match_name`` (lower-case, singular,
+common synonyms folded: 'Corn' -> 'maize', 'Beans' -> 'bean'). When a listing
+or demand is saved, ``index_crop()`` / ``index_demand()`` score it against
+recent rows on the other side with the same name and keep two ranked lists:
+
+* ``crop_matches``: the best ``TOP_K`` demands for each crop (farmer view)
+* ``demand_matches``: the best ``TOP_K`` crops for each demand (buyer view)
+
+A new row also enters the other side's lists where it beats their current
+worst entry. Dashboards then read a few index entries by farmer or buyer id
+instead of joining crops against demands at request time.
+
+Usage: python matching.py [path/to/agrilink.db]   (rebuild every list)
+"""
+import functools
+import heapq
+import re
+import sqlite3
+import sys
+
+TOP_K = 20
+# Rows scored per save: the most recent same-name rows in the same location,
+# then the most recent same-name rows anywhere.
+LOCAL_CANDIDATES = 100
+CANDIDATES = 50
+_CHUNK = 500
+
+# Score weights; every candidate already shares the crop name.
+BASE_SCORE = 1.0
+LOCATION_WEIGHT = 0.5
+QUALITY_WEIGHT = 0.25
+QUANTITY_WEIGHT = 0.5
+
+SYNONYMS = {
+    'corn': 'maize', 'mealie': 'maize', 'chimanga': 'maize',
+    'peanut': 'groundnut', 'g/nut': 'groundnut', 'nuts': 'groundnut',
+    'irish potato': 'potato', 'irish': 'potato',
+    'sweet potatoe': 'sweet potato',
+    'soybean': 'soya', 'soya bean': 'soya', 'soy': 'soya',
+    'pigeon pea': 'pigeon pea', 'nandolo': 'pigeon pea',
+}
+
+_SPACES = re.compile(r'\s+')
+_PUNCTUATION = re.compile(r'[^\w/ ]+')
+
+
+def normalize_name(name):
+    """'  Irish Potatoes ' -> 'potato'."""
+    if not name:
+        return None
+    name = _SPACES.sub(' ', _PUNCTUATION.sub(' ', name.lower())).strip()
+    if name.endswith('oes') and len(name) > 4:
+        name = name[:-2]
+    elif name.endswith('ies') and len(name) > 4:
+        name = name[:-3] + 'y'
+    elif name.endswith('s') and not name.endswith('ss') and len(name) > 3:
+        name = name[:-1]
+    return SYNONYMS.get(name, name) or None
+
+
+@functools.lru_cache(maxsize=4096)
+def _key(text):
+    return ' '.join(text.lower().split()) if text else None
+
+
+def _features(row):
+    """The parts of a crop or demand row that ``_score()`` compares."""
+    return _key(row['location']), _key(row['quality']), row['quantity_value'], row['quantity_unit']
+
+
+def _score(crop, demand):
+    location, quality, available, unit = crop
+    wanted_location, wanted_quality, wanted, wanted_unit = demand
+    total = BASE_SCORE
+    if location and location == wanted_location:
+        total += LOCATION_WEIGHT
+    if quality and quality == wanted_quality:
+        total += QUALITY_WEIGHT
+    if wanted and available and unit == wanted_unit:
+        total += QUANTITY_WEIGHT * min(available / wanted, 1.0)
+    return total
+
+
+def score(crop, demand):
+    """Score a crop/demand pair with the same match_name; higher is better."""
+    return _score(_features(crop), _features(demand))
+
+
+_CROP_COLUMNS = 'id, farmer_id, match_name, location, quality, quantity_value, quantity_unit'
+_DEMAND_COLUMNS = 'id, buyer_id, match_name, location, quality, quantity_value, quantity_unit'
+
+
+def _candidates(conn, table, columns, row):
+    seen = {}
+    queries = []
+    if row['location']:
+        queries.append((f"SELECT {columns} FROM {table} WHERE match_name = ? AND location = ? ORDER BY id DESC LIMIT ?",
+                        (row['match_name'], row['location'], LOCAL_CANDIDATES)))
+    queries.append((f"SELECT {columns} FROM {table} WHERE match_name = ? ORDER BY id DESC LIMIT ?",
+                    (row['match_name'], CANDIDATES)))
+    for query, params in queries:
+        for candidate in conn.execute(query, params):
+            seen.setdefault(candidate['id'], candidate)
+    return list(seen.values())
+
+
+def _floors(conn, table, owner_column, ids):
+    """Number of entries and worst score in each list named by ``ids``."""
+    floors = {}
+    for start in range(0, len(ids), _CHUNK):
+        chunk = ids[start:start + _CHUNK]
+        rows = conn.execute(
+            f"SELECT {owner_column}, COUNT(*), MIN(score) FROM {table} WHERE {owner_column} IN ({','.join('?' * len(chunk))}) GROUP BY {owner_column}",
+            chunk)
+        floors.update((owner, (count, worst)) for owner, count, worst in rows)
+    return floors
+
+
+def _trim(conn, table, owner_column, other_column, owner_id):
+    conn.execute(f"""
+        DELETE FROM {table} WHERE {owner_column} = ?1 AND {other_column} IN (
+            SELECT {other_column} FROM {table} WHERE {owner_column} = ?1
+            ORDER BY score DESC, {other_column} DESC LIMIT -1 OFFSET ?2)
+    """, (owner_id, TOP_K))
+
+
+def _index(conn, row, own, other):
+    """Shared body of index_crop/index_demand; ``own``/``other`` describe each side."""
+    conn.execute(f"DELETE FROM {own['table']} WHERE {own['id']} = ?", (row['id'],))
+    conn.execute(f"DELETE FROM {other['table']} WHERE {own['id']} = ?", (row['id'],))
+    if not row['match_name']:
+        return 0
+    candidates = _candidates(conn, other['source'], other['columns'], row)
+    features = _features(row)
+    scored = sorted(((own['score'](features, _features(candidate)), candidate) for candidate in candidates),
+                    key=lambda pair: (pair[0], pair[1]['id']), reverse=True)
+
+    # This row's own list.
+    conn.executemany(
+        f"INSERT INTO {own['table']} ({own['id']}, {other['id']}, {own['owner']}, score) VALUES (?, ?, ?, ?)",
+        [(row['id'], candidate['id'], row[own['owner']], value) for value, candidate in scored[:TOP_K]])
+
+    # Enter the lists of candidates it beats.
+    floors = _floors(conn, other['table'], other['id'], [candidate['id'] for _, candidate in scored])
+    entries = [(candidate['id'], row['id'], candidate[other['owner']], value) for value, candidate in scored
+               if floors.get(candidate['id'], (0, 0))[0] < TOP_K or value > floors[candidate['id']][1]]
+    conn.executemany(
+        f"INSERT OR REPLACE INTO {other['table']} ({other['id']}, {own['id']}, {other['owner']}, score) VALUES (?, ?, ?, ?)",
+        entries)
+    for other_id, *_ in entries:
+        if floors.get(other_id, (0, 0))[0] >= TOP_K:
+            _trim(conn, other['table'], other['id'], own['id'], other_id)
+    return len(scored)
+
+
+_CROP_SIDE = {'table': 'crop_matches', 'source': 'crops', 'id': 'crop_id', 'owner': 'farmer_id',
+              'columns': _CROP_COLUMNS, 'score': _score}
+_DEMAND_SIDE = {'table': 'demand_matches', 'source': 'demands', 'id': 'demand_id', 'owner': 'buyer_id',
+                'columns': _DEMAND_COLUMNS, 'score': lambda demand, crop: _score(crop, demand)}
+
+
+def index_crop(conn, crop_id):
+    """(Re)score one crop after it was inserted or edited. Runs in the caller's transaction."""
+    _set_match_name(conn, 'crops', crop_id)
+    row = conn.execute(f'SELECT {_CROP_COLUMNS} FROM crops WHERE id = ?', (crop_id,)).fetchone()
+    return _index(conn, row, _CROP_SIDE, _DEMAND_SIDE) if row else 0
+
+
+def index_demand(conn, demand_id):
+    """(Re)score one demand after it was inserted or edited. Runs in the caller's transaction."""
+    _set_match_name(conn, 'demands', demand_id)
+    row = conn.execute(f'SELECT {_DEMAND_COLUMNS} FROM demands WHERE id = ?', (demand_id,)).fetchone()
+    return _index(conn, row, _DEMAND_SIDE, _CROP_SIDE) if row else 0
+
+
+def _set_match_name(conn, table, row_id):
+    row = conn.execute(f'SELECT crop_name FROM {table} WHERE id = ?', (row_id,)).fetchone()
+    if row:
+        conn.execute(f'UPDATE {table} SET match_name = ?1 WHERE id = ?2 AND match_name IS NOT ?1',
+                     (normalize_name(row[0]), row_id))
+
+
+def _offer(lists, key, user_id, other_id, value):
+    """Keep ``other_id`` in the bounded top-K heap of ``key`` if it ranks."""
+    entry = lists.get(key)
+    if entry is None:
+        lists[key] = (user_id, [(value, other_id)], {other_id})
+        return
+    _, heap, members = entry
+    full = len(heap) >= TOP_K
+    if (full and (value, other_id) <= heap[0]) or other_id in members:
+        return
+    if full:
+        members.discard(heapq.heapreplace(heap, (value, other_id))[1])
+    else:
+        heapq.heappush(heap, (value, other_id))
+    members.add(other_id)
+
+
+def _recent(rows):
+    """Index rows (newest first) by match_name and by (match_name, location)."""
+    by_name, by_location = {}, {}
+    for row in rows:
+        by_name.setdefault(row[2], []).append(row)
+        if row[3]:
+            by_location.setdefault((row[2], row[3]), []).append(row)
+    return by_name, by_location
+
+
+def rebuild(conn):
+    """Recompute match_name and every match list from the current rows.
+
+    Each row is scored against the same candidates ``index_crop()`` /
+    ``index_demand()`` would pick, in memory, so a full rebuild of a large
+    database costs no queries per row. Runs inside the caller's transaction;
+    used as the migration backfill.
+    """
+    conn.execute('DELETE FROM crop_matches')
+    conn.execute('DELETE FROM demand_matches')
+    rows = {}
+    for table, columns in (('crops', _CROP_COLUMNS), ('demands', _DEMAND_COLUMNS)):
+        names = conn.execute(f'SELECT id, crop_name FROM {table}').fetchall()
+        conn.executemany(f'UPDATE {table} SET match_name = ?1 WHERE id = ?2 AND match_name IS NOT ?1',
+                         [(normalize_name(name), row_id) for row_id, name in names])
+        # (id, owner, match_name, location, features), newest first
+        rows[table] = [(row[0], row[1], row[2], row[3], (_key(row[3]), _key(row[4]), row[5], row[6]))
+                       for row in conn.execute(f'SELECT {columns} FROM {table} WHERE match_name IS NOT NULL ORDER BY id DESC')]
+
+    lists = {'crops': {}, 'demands': {}}
+    for own, other in (('crops', 'demands'), ('demands', 'crops')):
+        own_lists, other_lists = lists[own], lists[other]
+        by_name, by_location = _recent(rows[other])
+        for row_id, owner_id, name, location, features in rows[own]:
+            candidates = by_location.get((name, location), [])[:LOCAL_CANDIDATES] + by_name.get(name, [])[:CANDIDATES]
+            for other_id, other_owner, _, _, other_features in candidates:
+                if own == 'crops':
+                    value = _score(features, other_features)
+                else:
+                    value = _score(other_features, features)
+                _offer(own_lists, row_id, owner_id, other_id, value)
+                _offer(other_lists, other_id, other_owner, row_id, value)
+
+    for side, other in ((_CROP_SIDE, _DEMAND_SIDE), (_DEMAND_SIDE, _CROP_SIDE)):
+        conn.executemany(
+            f"INSERT INTO {side['table']} ({side['id']}, {other['id']}, {side['owner']}, score) VALUES (?, ?, ?, ?)",
+            ((owner_id, other_id, user_id, value)
+             for owner_id, (user_id, heap, _) in sorted(lists[side['source']].items()) for value, other_id in heap))
+    return len(rows['crops']) + len(rows['demands'])
+
+
+def matches_for_farmer(conn, farmer_id, limit=6):
+    """Open demands that best match any of ``farmer_id``'s listings."""
+    return conn.execute("""
+        SELECT d.*, u.name AS buyer_name, u.profile_pic, best.score AS match_score, c.crop_name AS matched_crop_name
+        FROM (SELECT demand_id, crop_id, MAX(score) AS score FROM crop_matches
+              WHERE farmer_id = ? GROUP BY demand_id ORDER BY score DESC LIMIT ?) best
+        JOIN demands d ON d.id = best.demand_id
+        JOIN crops c ON c.id = best.crop_id
+        JOIN users u ON u.id = d.buyer_id
+        ORDER BY best.score DESC, d.id DESC
+    """, (farmer_id, limit)).fetchall()
+
+
+def matches_for_buyer(conn, buyer_id, limit=6):
+    """In-stock listings that best match any of ``buyer_id``'s demands."""
+    return conn.execute("""
+        SELECT c.*, u.name AS farmer_name, u.profile_pic, best.score AS match_score, d.crop_name AS matched_demand_name
+        FROM (SELECT crop_id, demand_id, MAX(score) AS score FROM demand_matches dm
+              WHERE buyer_id = ? AND EXISTS (SELECT 1 FROM crops WHERE id = dm.crop_id
+                                             AND (quantity_value IS NULL OR quantity_value > 0))
+              GROUP BY crop_id ORDER BY score DESC LIMIT ?) best
+        JOIN crops c ON c.id = best.crop_id
+        JOIN demands d ON d.id = best.demand_id
+        JOIN users u ON u.id = c.farmer_id
+        ORDER BY best.score DESC, c.id DESC
+    """, (buyer_id, limit)).fetchall()
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else 'agrilink.db'
+    conn = sqlite3.connect(database)
+    conn.execute('BEGIN IMMEDIATE')
+    count = rebuild(conn)
+    conn.commit()
+    conn.close()
+    print(f"Re-indexed {count} crops and demands.")
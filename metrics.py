@@ -0,0 +1,347 @@
+"""Prometheus-style metrics at ``/metrics``.
+
+Counters and histograms are recorded into per-thread shards: each thread
+only ever writes its own dicts, so recording takes no lock, and a scrape sums
+the shards. The development server starts a thread per request, so the shard
+of a thread that has exited is folded into one retired shard and dropped.
+Request rate and latency per endpoint and per-request SQL come
+from ``before_request``/``after_request`` hooks; the mail outbox and the
+payment webhook committer record their own events with ``registry.inc()`` /
+``registry.observe()``. Pool, cache and push gauges are read from the
+extensions when scraped.
+
+With several worker processes set ``METRICS_DIR`` (``AGRILINK_METRICS_DIR``):
+each process then writes a snapshot there every ``FLUSH_INTERVAL`` seconds
+and whichever worker answers the scrape adds up every snapshot. Counters of
+workers that have exited are kept so totals never go backwards; their gauges
+are dropped once the snapshot is stale.
+"""
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+
+from flask import Response, current_app, g, request
+
+import outbox
+from db import get_db_connection
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FLUSH_INTERVAL = 5  # seconds, METRICS_DIR only
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+HELP = {
+    'agrilink_http_requests_total': ('counter', 'HTTP requests by endpoint, method and status.'),
+    'agrilink_http_request_duration_seconds': ('histogram', 'Time to produce a response, by endpoint.'),
+    'agrilink_db_queries_total': ('counter', 'SQL statements run while handling requests, by endpoint.'),
+    'agrilink_db_request_seconds': ('histogram', 'SQL time per request, by endpoint.'),
+    'agrilink_db_pool_connections': ('gauge', 'Pooled database connections by state.'),
+    'agrilink_db_pool_opened_total': ('counter', 'Database connections opened by the pool.'),
+    'agrilink_cache_hits_total': ('counter', 'Cache hits by cache.'),
+    'agrilink_cache_misses_total': ('counter', 'Cache misses by cache.'),
+    'agrilink_push_connections': ('gauge', 'Open Server-Sent Events streams.'),
+    'agrilink_mail_enqueued_total': ('counter', 'Messages added to the mail outbox.'),
+    'agrilink_mail_sent_total': ('counter', 'Messages delivered from the mail outbox.'),
+    'agrilink_mail_failed_total': ('counter', 'Failed delivery attempts, by whether a retry was scheduled.'),
+    'agrilink_mail_queue_depth': ('gauge', 'Outbox messages waiting to be sent.'),
+    'agrilink_payment_webhooks_total': ('counter', 'Payment webhook events by outcome.'),
+    'agrilink_payment_webhook_seconds': ('histogram', 'Time from receiving a webhook to its commit.'),
+    'agrilink_payment_webhook_queue_depth': ('gauge', 'Webhook events waiting for the group committer.'),
+    'agrilink_payment_webhook_last_received_seconds': ('gauge', 'Seconds since the last payment webhook event.'),
+    'agrilink_password_queue_depth': ('gauge', 'Password hashes running or waiting in the hashing pool.'),
+    'agrilink_password_hashes_rejected_total': ('counter', 'Password hashes refused because the pool queue was full.'),
+    'agrilink_rate_limited_total': ('counter', 'Attempts refused by a rate limit, by rule.'),
+}
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+class _Shard:
+    __slots__ = ('counters', 'histograms', 'thread')
+
+    def __init__(self, thread=None):
+        self.counters = {}
+        self.histograms = {}  # key -> [bucket counts..., +Inf count, sum]
+        self.thread = thread
+
+    def add(self, other):
+        """Add ``other``'s counts to this shard's (copying, as its thread may still be writing)."""
+        for key, value in other.counters.copy().items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, values in other.histograms.copy().items():
+            total = self.histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+
+
+class Registry:
+    """Process-wide counters and histograms, sharded per thread."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard()  # counts of threads that have exited
+
+    def _prune(self):
+        # Call with the lock held. A dead thread writes no more, so its counts can move.
+        live = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                live.append(shard)
+            else:
+                self._retired.add(shard)
+        self._shards = live
+
+    def _shard(self):
+        if self._pid != os.getpid():
+            # Counts inherited across a fork belong to the parent.
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard(threading.current_thread())
+            with self._lock:
+                self._prune()
+                self._shards.append(shard)
+            return shard
+
+    def inc(self, name, value=1, **labels):
+        counters = self._shard().counters
+        key = (name, _labels(labels))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        histograms = self._shard().histograms
+        key = (name, _labels(labels))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(self.buckets) + 2)
+        histogram[bisect.bisect_left(self.buckets, value)] += 1
+        histogram[-1] += value
+
+    def snapshot(self):
+        """Sum every shard: ``{'counters': {key: value}, 'histograms': {key: [...]}}``."""
+        total = _Shard()
+        with self._lock:
+            if self._pid == os.getpid():
+                self._prune()
+                total.add(self._retired)
+                shards = list(self._shards)
+            else:
+                shards = []
+        for shard in shards:
+            total.add(shard)
+        return {'counters': total.counters, 'histograms': total.histograms}
+
+
+registry = Registry()
+
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def _process_gauges(app):
+    """Per-process readings from the app's extensions; summed across workers."""
+    pool = app.extensions['db_pool'].stats()
+    gauges = {
+        ('agrilink_db_pool_connections', (('state', 'in_use'),)): pool['in_use'],
+        ('agrilink_db_pool_connections', (('state', 'idle'),)): pool['idle'],
+        ('agrilink_push_connections', ()): app.extensions['push'].broker.connection_count(),
+        ('agrilink_payment_webhook_queue_depth', ()): app.extensions['payment_webhooks'].queue_depth(),
+        ('agrilink_password_queue_depth', ()): app.extensions['passwords'].queue_depth(),
+    }
+    counters = {('agrilink_db_pool_opened_total', ()): pool['created']}
+    for name in ('user_cache', 'page_cache', 'sessions'):
+        cache = app.extensions.get(name)
+        if cache is None:
+            continue
+        counters[('agrilink_cache_hits_total', (('cache', name),))] = cache.hits
+        counters[('agrilink_cache_misses_total', (('cache', name),))] = cache.misses
+    return gauges, counters
+
+
+def _process_snapshot(app):
+    snapshot = registry.snapshot()
+    gauges, counters = _process_gauges(app)
+    snapshot['counters'].update(counters)
+    snapshot['gauges'] = gauges
+    return snapshot
+
+
+class SnapshotDirectory:
+    """Share per-process snapshots between workers through files in ``path``."""
+
+    def __init__(self, app, path, interval=FLUSH_INTERVAL):
+        self.app = app
+        self.path = path
+        self.interval = interval
+        self._thread = None
+        self._pid = None
+        os.makedirs(path, exist_ok=True)
+
+    def start(self):
+        """Begin flushing this process's snapshot; safe to call on every request."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except OSError:
+                self.app.logger.exception('Could not write metrics snapshot')
+
+    def flush(self):
+        snapshot = _process_snapshot(self.app)
+        data = {kind: [[name, list(labels), value] for (name, labels), value in values.items()]
+                for kind, values in snapshot.items()}
+        target = os.path.join(self.path, f'{os.getpid()}.json')
+        with open(target + '.tmp', 'w') as f:
+            json.dump({'written_at': time.time(), **data}, f)
+        os.replace(target + '.tmp', target)
+
+    def others(self):
+        """Snapshots written by every other process."""
+        own = f'{os.getpid()}.json'
+        stale_after = time.time() - self.interval * 3
+        for filename in os.listdir(self.path):
+            if not filename.endswith('.json') or filename == own:
+                continue
+            try:
+                with open(os.path.join(self.path, filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            snapshot = {kind: {(name, tuple(tuple(pair) for pair in labels)): value
+                               for name, labels, value in data.get(kind, [])}
+                        for kind in ('counters', 'histograms', 'gauges')}
+            if data.get('written_at', 0) < stale_after:
+                snapshot['gauges'] = {}
+            yield snapshot
+
+
+def _merge(snapshots):
+    merged = {'counters': {}, 'histograms': {}, 'gauges': {}}
+    for snapshot in snapshots:
+        for kind in ('counters', 'gauges'):
+            target = merged[kind]
+            for key, value in snapshot[kind].items():
+                target[key] = target.get(key, 0) + value
+        for key, values in snapshot['histograms'].items():
+            total = merged['histograms'].setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+    return merged
+
+
+def _global_gauges(conn):
+    """Readings of shared state (the database), taken once per scrape rather than per worker."""
+    gauges = {('agrilink_mail_queue_depth', ()): outbox.queue_depth(conn)}
+    age = conn.execute("SELECT strftime('%s', 'now') - strftime('%s', MAX(received_at)) FROM payment_events").fetchone()[0]
+    if age is not None:
+        gauges[('agrilink_payment_webhook_last_received_seconds', ())] = age
+    return gauges
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshot, buckets=LATENCY_BUCKETS):
+    """Prometheus text exposition format for a merged snapshot."""
+    series = {}
+    for kind in ('counters', 'gauges', 'histograms'):
+        for (name, labels), value in snapshot[kind].items():
+            series.setdefault(name, []).append((labels, value))
+    lines = []
+    for name in sorted(series):
+        metric_type, help_text = HELP.get(name, ('untyped', ''))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in sorted(series[name]):
+            if metric_type != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), value[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value[-1])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def start_request():
+    g.metrics_started = time.perf_counter()
+    directory = current_app.extensions.get('metrics_dir')
+    if directory is not None:
+        directory.start()
+
+
+def finish_request(response):
+    started = g.get('metrics_started')
+    if started is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    registry.inc('agrilink_http_requests_total', endpoint=endpoint, method=request.method,
+                 status=str(response.status_code))
+    registry.observe('agrilink_http_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+    log = g.get('query_log')
+    if log is not None and log.count:
+        registry.inc('agrilink_db_queries_total', log.count, endpoint=endpoint)
+        registry.observe('agrilink_db_request_seconds', log.elapsed, endpoint=endpoint)
+    return response
+
+
+def metrics_view():
+    app = current_app._get_current_object()
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('Unauthorized\n', 401, {'WWW-Authenticate': 'Bearer'})
+    snapshots = [_process_snapshot(app)]
+    directory = app.extensions.get('metrics_dir')
+    if directory is not None:
+        snapshots.extend(directory.others())
+    merged = _merge(snapshots)
+    merged['gauges'].update(_global_gauges(get_db_connection()))
+    return Response(render(merged), mimetype=CONTENT_TYPE.split(';')[0], content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    app.config.setdefault('METRICS_TOKEN', None)
+    app.config.setdefault('METRICS_DIR', None)
+    if app.config['METRICS_DIR']:
+        app.extensions['metrics_dir'] = SnapshotDirectory(app, app.config['METRICS_DIR'])
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,861 @@
+"""Versioned, in-place schema migrations.
+
+The schema version lives in ``PRAGMA user_version``. Each migration runs in
+its own ``BEGIN IMMEDIATE`` transaction together with the version bump, so an
+interrupted upgrade never leaves a half-applied step behind and a live
+database can be upgraded without losing data.
+
+A migration step is either a SQL string or a callable taking the connection,
+for backfills that need Python.
+
+Usage: python migrations.py [path/to/agrilink.db]
+"""
+import logging
+import re
+import sqlite3
+import sys
+
+import conversations
+import matching
+import quantities
+import stats
+
+logger = logging.getLogger('agrilink.migrations')
+
+BASELINE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        role TEXT NOT NULL,
+        profile_pic TEXT,
+        phone_number TEXT,
+        bank_name TEXT,
+        bank_account_number TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS crops (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        farmer_id INTEGER NOT NULL,
+        crop_name TEXT NOT NULL,
+        quantity TEXT NOT NULL,
+        price REAL NOT NULL,
+        quality TEXT,
+        crop_grade TEXT,
+        harvest_date TEXT,
+        location TEXT,
+        image TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (farmer_id) REFERENCES users (id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS demands (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        buyer_id INTEGER NOT NULL,
+        crop_name TEXT NOT NULL,
+        quantity TEXT NOT NULL,
+        location TEXT,
+        quality TEXT,
+        message TEXT,
+        image TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (buyer_id) REFERENCES users (id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        buyer_id INTEGER NOT NULL,
+        crop_id INTEGER NOT NULL,
+        quantity REAL NOT NULL,
+        total_price REAL NOT NULL,
+        delivery_option TEXT NOT NULL,
+        payment_number TEXT,
+        order_status TEXT DEFAULT 'pending',
+        order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (buyer_id) REFERENCES users (id),
+        FOREIGN KEY (crop_id) REFERENCES crops (id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER,
+        receiver_id INTEGER NOT NULL,
+        crop_id INTEGER,
+        demand_id INTEGER,
+        sender_name TEXT,
+        sender_contact TEXT,
+        subject TEXT,
+        message TEXT NOT NULL,
+        sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (sender_id) REFERENCES users (id),
+        FOREIGN KEY (receiver_id) REFERENCES users (id),
+        FOREIGN KEY (crop_id) REFERENCES crops (id),
+        FOREIGN KEY (demand_id) REFERENCES demands (id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS reviews (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id INTEGER NOT NULL,
+        reviewer_id INTEGER NOT NULL,
+        reviewed_user_id INTEGER NOT NULL,
+        rating INTEGER NOT NULL,
+        comment TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (order_id) REFERENCES orders (id),
+        FOREIGN KEY (reviewer_id) REFERENCES users (id),
+        FOREIGN KEY (reviewed_user_id) REFERENCES users (id)
+    )
+    ''',
+]
+
+# Each index is shaped after the WHERE/ORDER BY of the route that needs it.
+HOT_PATH_INDEXES = [
+    # farmer.view_my_listings, farmer.my_sales (join side), admin stats
+    'CREATE INDEX IF NOT EXISTS idx_crops_farmer ON crops (farmer_id, id)',
+    # buyer.dashboard category filter and the DISTINCT crop_name list
+    'CREATE INDEX IF NOT EXISTS idx_crops_name ON crops (crop_name, id)',
+    # buyer.dashboard location filter, newest first
+    'CREATE INDEX IF NOT EXISTS idx_crops_location ON crops (location, id)',
+    # buyer.dashboard "my demands", buyer.view_my_demands
+    'CREATE INDEX IF NOT EXISTS idx_demands_buyer ON demands (buyer_id, id)',
+    # farmer.dashboard location filter, newest first
+    'CREATE INDEX IF NOT EXISTS idx_demands_location ON demands (location, id)',
+    'CREATE INDEX IF NOT EXISTS idx_demands_name ON demands (crop_name, id)',
+    # buyer.view_my_orders
+    'CREATE INDEX IF NOT EXISTS idx_orders_buyer_date ON orders (buyer_id, order_date)',
+    # farmer.my_sales
+    'CREATE INDEX IF NOT EXISTS idx_orders_crop_date ON orders (crop_id, order_date)',
+    # admin_all_orders
+    'CREATE INDEX IF NOT EXISTS idx_orders_date ON orders (order_date)',
+    'CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id, sent_at)',
+    'CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver_id, sent_at)',
+    # admin_messages
+    'CREATE INDEX IF NOT EXISTS idx_messages_sent_at ON messages (sent_at)',
+    # main.view_user_profile
+    'CREATE INDEX IF NOT EXISTS idx_reviews_reviewed_user ON reviews (reviewed_user_id, created_at)',
+    # buyer.view_my_orders review lookup
+    'CREATE INDEX IF NOT EXISTS idx_reviews_order ON reviews (order_id, reviewer_id)',
+    'CREATE INDEX IF NOT EXISTS idx_reviews_reviewer ON reviews (reviewer_id)',
+    # admin_farmers, admin_buyers, admin_dashboard counts
+    'CREATE INDEX IF NOT EXISTS idx_users_role ON users (role, id)',
+]
+
+# FTS5 indexes for search.py, one row per crop/demand keyed by its id.
+SEARCH_INDEX = [
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS crops_fts USING fts5(
+        crop_name, quality, crop_grade, location, farmer_name,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    )
+    ''',
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS demands_fts USING fts5(
+        crop_name, quality, message, location,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    )
+    ''',
+    "CREATE VIRTUAL TABLE IF NOT EXISTS crops_fts_vocab USING fts5vocab(crops_fts, 'row')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS demands_fts_vocab USING fts5vocab(demands_fts, 'row')",
+    '''
+    CREATE TRIGGER IF NOT EXISTS crops_fts_insert AFTER INSERT ON crops BEGIN
+        INSERT INTO crops_fts (rowid, crop_name, quality, crop_grade, location, farmer_name)
+        VALUES (new.id, new.crop_name, new.quality, new.crop_grade, new.location,
+                (SELECT name FROM users WHERE id = new.farmer_id));
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS crops_fts_update
+    AFTER UPDATE OF crop_name, quality, crop_grade, location, farmer_id ON crops BEGIN
+        UPDATE crops_fts
+        SET crop_name = new.crop_name, quality = new.quality, crop_grade = new.crop_grade,
+            location = new.location,
+            farmer_name = (SELECT name FROM users WHERE id = new.farmer_id)
+        WHERE rowid = new.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS crops_fts_delete AFTER DELETE ON crops BEGIN
+        DELETE FROM crops_fts WHERE rowid = old.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS users_name_fts_update AFTER UPDATE OF name ON users BEGIN
+        UPDATE crops_fts SET farmer_name = new.name
+        WHERE rowid IN (SELECT id FROM crops WHERE farmer_id = new.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS demands_fts_insert AFTER INSERT ON demands BEGIN
+        INSERT INTO demands_fts (rowid, crop_name, quality, message, location)
+        VALUES (new.id, new.crop_name, new.quality, new.message, new.location);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS demands_fts_update
+    AFTER UPDATE OF crop_name, quality, message, location ON demands BEGIN
+        UPDATE demands_fts
+        SET crop_name = new.crop_name, quality = new.quality, message = new.message,
+            location = new.location
+        WHERE rowid = new.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS demands_fts_delete AFTER DELETE ON demands BEGIN
+        DELETE FROM demands_fts WHERE rowid = old.id;
+    END
+    ''',
+    # Backfill rows that existed before the index did.
+    '''
+    INSERT INTO crops_fts (rowid, crop_name, quality, crop_grade, location, farmer_name)
+    SELECT c.id, c.crop_name, c.quality, c.crop_grade, c.location, u.name
+    FROM crops c LEFT JOIN users u ON c.farmer_id = u.id
+    ''',
+    '''
+    INSERT INTO demands_fts (rowid, crop_name, quality, message, location)
+    SELECT id, crop_name, quality, message, location FROM demands
+    ''',
+    "INSERT INTO crops_fts (crops_fts) VALUES ('optimize')",
+    "INSERT INTO demands_fts (demands_fts) VALUES ('optimize')",
+]
+
+# Normalized numeric quantities, see quantities.py.
+NORMALIZED_QUANTITIES = [
+    'ALTER TABLE crops ADD COLUMN quantity_value REAL',
+    'ALTER TABLE crops ADD COLUMN quantity_unit TEXT',
+    'ALTER TABLE demands ADD COLUMN quantity_value REAL',
+    'ALTER TABLE demands ADD COLUMN quantity_unit TEXT',
+    quantities.backfill,
+    # buyer.dashboard volume filter / sort and price sort
+    'CREATE INDEX IF NOT EXISTS idx_crops_quantity ON crops (quantity_unit, quantity_value)',
+    'CREATE INDEX IF NOT EXISTS idx_crops_price ON crops (price, id)',
+    'CREATE INDEX IF NOT EXISTS idx_demands_quantity ON demands (quantity_unit, quantity_value)',
+]
+
+# Stock reservations held by pending orders, see inventory.py.
+ORDER_RESERVATIONS = [
+    'ALTER TABLE orders ADD COLUMN reserved_until TIMESTAMP',
+    "CREATE INDEX IF NOT EXISTS idx_orders_reserved_until ON orders (reserved_until) WHERE order_status = 'pending'",
+]
+
+# Persistent outbound mail queue, see outbox.py.
+MAIL_OUTBOX = [
+    '''
+    CREATE TABLE IF NOT EXISTS mail_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender TEXT,
+        recipients TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT,
+        html TEXT,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        locked_until TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        sent_at TIMESTAMP
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_mail_outbox_due ON mail_outbox (status, next_attempt_at)',
+]
+
+# Append-only log of payment provider callbacks, see payments.py.
+PAYMENT_EVENTS = [
+    '''
+    CREATE TABLE IF NOT EXISTS payment_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        provider TEXT NOT NULL,
+        transaction_id TEXT NOT NULL,
+        tx_ref TEXT,
+        order_id INTEGER,
+        status TEXT,
+        amount REAL,
+        payload TEXT,
+        outcome TEXT,
+        note TEXT,
+        received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (provider, transaction_id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_payment_events_order ON payment_events (order_id, id)',
+]
+
+# Running totals and per-day counts for the admin pages, see stats.py.
+def _bump(name, delta, where=''):
+    """Trigger statement adding ``delta`` to the counter named by SQL expression ``name``."""
+    return (f"INSERT INTO stats_counters (name, value) SELECT {name}, {delta} WHERE 1 {where} "
+            f"ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;")
+
+
+def _daily(kind):
+    return (f"INSERT INTO stats_daily (day, name, value) VALUES (date('now'), '{kind}', 1) "
+            f"ON CONFLICT (day, name) DO UPDATE SET value = value + 1;")
+
+
+def _listing_triggers(table, owner, counter):
+    """Count rows in ``table`` and the number of distinct owners that have any."""
+    first = f"AND NOT EXISTS (SELECT 1 FROM {table} WHERE {owner} = new.{owner} AND id != new.id)"
+    last = f"AND NOT EXISTS (SELECT 1 FROM {table} WHERE {owner} = old.{owner})"
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS stats_{table}_insert AFTER INSERT ON {table} BEGIN
+            {_bump(f"'{table}'", 1)}
+            {_bump(f"'{counter}'", 1, first)}
+            {_daily(table)}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS stats_{table}_delete AFTER DELETE ON {table} BEGIN
+            {_bump(f"'{table}'", -1)}
+            {_bump(f"'{counter}'", -1, last)}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS stats_{table}_owner AFTER UPDATE OF {owner} ON {table}
+        WHEN old.{owner} IS NOT new.{owner} BEGIN
+            {_bump(f"'{counter}'", -1, last)}
+            {_bump(f"'{counter}'", 1, first)}
+        END""",
+    ]
+
+
+_ROLE = "'users:' || COALESCE({row}.role, 'unknown')"
+_ORDER_STATUS = "'orders:' || LOWER(COALESCE({row}.order_status, 'unknown'))"
+
+STATS_COUNTERS = [
+    '''
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS stats_daily (
+        day TEXT NOT NULL,
+        name TEXT NOT NULL,
+        value INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, name)
+    ) WITHOUT ROWID
+    ''',
+    f"""CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users BEGIN
+        {_bump("'users'", 1)}
+        {_bump(_ROLE.format(row='new'), 1)}
+        {_daily('users')}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users BEGIN
+        {_bump("'users'", -1)}
+        {_bump(_ROLE.format(row='old'), -1)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS stats_users_role AFTER UPDATE OF role ON users
+    WHEN old.role IS NOT new.role BEGIN
+        {_bump(_ROLE.format(row='old'), -1)}
+        {_bump(_ROLE.format(row='new'), 1)}
+    END""",
+    *_listing_triggers('crops', 'farmer_id', 'active_farmers'),
+    *_listing_triggers('demands', 'buyer_id', 'active_buyers'),
+    f"""CREATE TRIGGER IF NOT EXISTS stats_messages_insert AFTER INSERT ON messages BEGIN
+        {_bump("'messages'", 1)}
+        {_daily('messages')}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS stats_messages_delete AFTER DELETE ON messages BEGIN
+        {_bump("'messages'", -1)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS stats_orders_insert AFTER INSERT ON orders BEGIN
+        {_bump("'orders'", 1)}
+        {_bump(_ORDER_STATUS.format(row='new'), 1)}
+        {_daily('orders')}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS stats_orders_delete AFTER DELETE ON orders BEGIN
+        {_bump("'orders'", -1)}
+        {_bump(_ORDER_STATUS.format(row='old'), -1)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS stats_orders_status AFTER UPDATE OF order_status ON orders
+    WHEN old.order_status IS NOT new.order_status BEGIN
+        {_bump(_ORDER_STATUS.format(row='old'), -1)}
+        {_bump(_ORDER_STATUS.format(row='new'), 1)}
+    END""",
+    stats.rebuild,
+]
+
+# Cross-worker invalidations for the logged-in user cache, see user_cache.py.
+USER_INVALIDATIONS = [
+    '''
+    CREATE TABLE IF NOT EXISTS user_invalidations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_user_invalidations_created ON user_invalidations (created_at)',
+]
+
+# Versions that cached pages are keyed on, see page_cache.py.
+_BUMP_CROPS = "UPDATE data_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE name = 'crops';"
+
+DATA_VERSIONS = [
+    '''
+    CREATE TABLE IF NOT EXISTS data_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    "INSERT OR IGNORE INTO data_versions (name) VALUES ('crops')",
+    f'CREATE TRIGGER IF NOT EXISTS data_version_crops_insert AFTER INSERT ON crops BEGIN {_BUMP_CROPS} END',
+    f'CREATE TRIGGER IF NOT EXISTS data_version_crops_update AFTER UPDATE ON crops BEGIN {_BUMP_CROPS} END',
+    f'CREATE TRIGGER IF NOT EXISTS data_version_crops_delete AFTER DELETE ON crops BEGIN {_BUMP_CROPS} END',
+    # Listings show the farmer's name and picture.
+    f'''CREATE TRIGGER IF NOT EXISTS data_version_farmer_update AFTER UPDATE OF name, profile_pic ON users
+    WHEN new.role = 'farmer' BEGIN {_BUMP_CROPS} END''',
+]
+
+# Conversation threads and unread counters for messaging, see conversations.py.
+CONVERSATIONS = [
+    '''
+    CREATE TABLE IF NOT EXISTS conversations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_low INTEGER NOT NULL,
+        user_high INTEGER NOT NULL,
+        crop_id INTEGER,
+        demand_id INTEGER,
+        subject TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_low) REFERENCES users (id),
+        FOREIGN KEY (user_high) REFERENCES users (id)
+    )
+    ''',
+    '''CREATE UNIQUE INDEX IF NOT EXISTS idx_conversations_participants
+       ON conversations (user_low, user_high, IFNULL(crop_id, 0), IFNULL(demand_id, 0))''',
+    'CREATE INDEX IF NOT EXISTS idx_conversations_user_high ON conversations (user_high)',
+    '''
+    CREATE TABLE IF NOT EXISTS conversation_members (
+        conversation_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        last_message_id INTEGER,
+        last_read_message_id INTEGER NOT NULL DEFAULT 0,
+        unread INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (conversation_id, user_id)
+    ) WITHOUT ROWID
+    ''',
+    # One user's inbox, newest conversation first.
+    'CREATE INDEX IF NOT EXISTS idx_conversation_members_inbox ON conversation_members (user_id, last_message_id)',
+    'ALTER TABLE messages ADD COLUMN conversation_id INTEGER REFERENCES conversations (id)',
+    'CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, id)',
+    'ALTER TABLE users ADD COLUMN unread_messages INTEGER NOT NULL DEFAULT 0',
+    conversations.rebuild,
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_conversation_insert AFTER INSERT ON messages
+    WHEN new.conversation_id IS NOT NULL BEGIN
+        UPDATE conversation_members SET last_message_id = new.id WHERE conversation_id = new.conversation_id;
+        UPDATE conversation_members SET unread = unread + 1
+        WHERE conversation_id = new.conversation_id AND user_id = new.receiver_id;
+        UPDATE users SET unread_messages = unread_messages + 1 WHERE id = new.receiver_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_conversation_delete AFTER DELETE ON messages
+    WHEN old.conversation_id IS NOT NULL BEGIN
+        UPDATE users SET unread_messages = MAX(unread_messages - 1, 0)
+        WHERE id = old.receiver_id AND EXISTS (
+            SELECT 1 FROM conversation_members
+            WHERE conversation_id = old.conversation_id AND user_id = old.receiver_id
+              AND old.id > last_read_message_id AND unread > 0);
+        UPDATE conversation_members SET unread = unread - 1
+        WHERE conversation_id = old.conversation_id AND user_id = old.receiver_id
+          AND old.id > last_read_message_id AND unread > 0;
+        UPDATE conversation_members
+        SET last_message_id = (SELECT MAX(id) FROM messages WHERE conversation_id = old.conversation_id)
+        WHERE conversation_id = old.conversation_id AND last_message_id = old.id;
+    END
+    ''',
+]
+
+# Cross-worker fanout for Server-Sent Events, see push.py.
+PUSH_EVENTS = [
+    '''
+    CREATE TABLE IF NOT EXISTS push_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        event TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_push_events_created ON push_events (created_at)',
+]
+
+# Precomputed demand/listing matches for the dashboards, see matching.py.
+MATCHES = [
+    'ALTER TABLE crops ADD COLUMN match_name TEXT',
+    'ALTER TABLE demands ADD COLUMN match_name TEXT',
+    '''
+    CREATE TABLE IF NOT EXISTS crop_matches (
+        crop_id INTEGER NOT NULL,
+        demand_id INTEGER NOT NULL,
+        farmer_id INTEGER NOT NULL,
+        score REAL NOT NULL,
+        PRIMARY KEY (crop_id, demand_id)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS demand_matches (
+        demand_id INTEGER NOT NULL,
+        crop_id INTEGER NOT NULL,
+        buyer_id INTEGER NOT NULL,
+        score REAL NOT NULL,
+        PRIMARY KEY (demand_id, crop_id)
+    ) WITHOUT ROWID
+    ''',
+    matching.rebuild,
+    # Candidate lookups when a crop or demand is saved.
+    'CREATE INDEX IF NOT EXISTS idx_crops_match ON crops (match_name, location, id)',
+    'CREATE INDEX IF NOT EXISTS idx_demands_match ON demands (match_name, location, id)',
+    # Dashboards, and clearing a row out of the other side's lists.
+    'CREATE INDEX IF NOT EXISTS idx_crop_matches_farmer ON crop_matches (farmer_id, score)',
+    'CREATE INDEX IF NOT EXISTS idx_crop_matches_demand ON crop_matches (demand_id)',
+    'CREATE INDEX IF NOT EXISTS idx_demand_matches_buyer ON demand_matches (buyer_id, score)',
+    'CREATE INDEX IF NOT EXISTS idx_demand_matches_crop ON demand_matches (crop_id)',
+    '''
+    CREATE TRIGGER IF NOT EXISTS crop_matches_crop_delete AFTER DELETE ON crops BEGIN
+        DELETE FROM crop_matches WHERE crop_id = old.id;
+        DELETE FROM demand_matches WHERE crop_id = old.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS demand_matches_demand_delete AFTER DELETE ON demands BEGIN
+        DELETE FROM demand_matches WHERE demand_id = old.id;
+        DELETE FROM crop_matches WHERE demand_id = old.id;
+    END
+    ''',
+]
+
+# Follow-up work for bulk-imported listings, see crop_import.py.
+CROP_IMPORT_QUEUE = [
+    '''
+    CREATE TABLE IF NOT EXISTS crop_import_queue (
+        crop_id INTEGER PRIMARY KEY,
+        image_url TEXT,
+        indexed INTEGER NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        locked_until TIMESTAMP
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_crop_import_queue_due ON crop_import_queue (indexed, next_attempt_at)',
+    # matching._candidates' newest-by-name lookup, which scoring an import runs once per listing;
+    # (match_name, location, id) made it sort every row with that name.
+    'CREATE INDEX IF NOT EXISTS idx_crops_match_name ON crops (match_name, id)',
+    'CREATE INDEX IF NOT EXISTS idx_demands_match_name ON demands (match_name, id)',
+    '''
+    CREATE TRIGGER IF NOT EXISTS crop_import_queue_crop_delete AFTER DELETE ON crops BEGIN
+        DELETE FROM crop_import_queue WHERE crop_id = old.id;
+    END
+    ''',
+]
+
+# Data versions for the JSON API's ETags, see blueprints/api.py.
+_BUMP_VERSION = "UPDATE data_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE name = '{}';"
+
+API_DATA_VERSIONS = [
+    "INSERT OR IGNORE INTO data_versions (name) VALUES ('demands'), ('orders'), ('users')",
+    f"CREATE TRIGGER IF NOT EXISTS data_version_demands_insert AFTER INSERT ON demands BEGIN {_BUMP_VERSION.format('demands')} END",
+    f"CREATE TRIGGER IF NOT EXISTS data_version_demands_update AFTER UPDATE ON demands BEGIN {_BUMP_VERSION.format('demands')} END",
+    f"CREATE TRIGGER IF NOT EXISTS data_version_demands_delete AFTER DELETE ON demands BEGIN {_BUMP_VERSION.format('demands')} END",
+    f"CREATE TRIGGER IF NOT EXISTS data_version_orders_insert AFTER INSERT ON orders BEGIN {_BUMP_VERSION.format('orders')} END",
+    f"CREATE TRIGGER IF NOT EXISTS data_version_orders_update AFTER UPDATE ON orders BEGIN {_BUMP_VERSION.format('orders')} END",
+    f"CREATE TRIGGER IF NOT EXISTS data_version_orders_delete AFTER DELETE ON orders BEGIN {_BUMP_VERSION.format('orders')} END",
+    # Profiles show the user's reviews and average rating.
+    f"CREATE TRIGGER IF NOT EXISTS data_version_reviews_insert AFTER INSERT ON reviews BEGIN {_BUMP_VERSION.format('users')} END",
+    f"CREATE TRIGGER IF NOT EXISTS data_version_reviews_update AFTER UPDATE ON reviews BEGIN {_BUMP_VERSION.format('users')} END",
+    f"CREATE TRIGGER IF NOT EXISTS data_version_reviews_delete AFTER DELETE ON reviews BEGIN {_BUMP_VERSION.format('users')} END",
+    f"CREATE TRIGGER IF NOT EXISTS data_version_users_insert AFTER INSERT ON users BEGIN {_BUMP_VERSION.format('users')} END",
+    f"CREATE TRIGGER IF NOT EXISTS data_version_users_delete AFTER DELETE ON users BEGIN {_BUMP_VERSION.format('users')} END",
+    f'''CREATE TRIGGER IF NOT EXISTS data_version_users_update AFTER UPDATE OF name, profile_pic, role ON users
+    BEGIN {_BUMP_VERSION.format('users')} END''',
+]
+
+# Login and registration token buckets shared between workers, see ratelimit.py.
+RATE_LIMITS = [
+    '''
+    CREATE TABLE IF NOT EXISTS rate_limits (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_rate_limits_updated ON rate_limits (updated_at)',
+]
+
+# Server-side session store, see sessions.py.
+SESSIONS = [
+    '''
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        data TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)',
+    'CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)',
+]
+
+# ON DELETE actions for every foreign key, enforced on connections that turn on
+# PRAGMA foreign_keys (db.py does). Deleted users are purged child rows first,
+# in small batches (see user_purge.py); the actions guarantee nothing is left
+# dangling, and RESTRICT keeps a listing that has orders from being deleted.
+FOREIGN_KEY_ACTIONS = {
+    'crops': {'farmer_id': 'CASCADE'},
+    'demands': {'buyer_id': 'CASCADE'},
+    'orders': {'buyer_id': 'CASCADE', 'crop_id': 'RESTRICT'},
+    'messages': {'sender_id': 'SET NULL', 'receiver_id': 'CASCADE', 'crop_id': 'SET NULL',
+                 'demand_id': 'SET NULL', 'conversation_id': 'CASCADE'},
+    'reviews': {'order_id': 'CASCADE', 'reviewer_id': 'CASCADE', 'reviewed_user_id': 'CASCADE'},
+    'conversations': {'user_low': 'CASCADE', 'user_high': 'CASCADE'},
+}
+
+# Rows left behind by the old admin_delete_user (listings of deleted users,
+# orders of deleted listings and the like), which the rebuilt tables would
+# reject. They are moved to orphaned_rows as JSON, not dropped, in an order
+# that lets each step see the previous ones' moves; references that the new
+# rules would set to NULL are set to NULL. Counts go to the log.
+_ORPHANS = [
+    ('crops', 'farmer_id NOT IN (SELECT id FROM users)'),
+    ('demands', 'buyer_id NOT IN (SELECT id FROM users)'),
+    ('orders', 'buyer_id NOT IN (SELECT id FROM users) OR crop_id NOT IN (SELECT id FROM crops)'),
+    ('reviews', 'order_id NOT IN (SELECT id FROM orders) OR reviewer_id NOT IN (SELECT id FROM users) '
+                'OR reviewed_user_id NOT IN (SELECT id FROM users)'),
+    ('conversation_members', 'conversation_id IN (SELECT id FROM conversations '
+                             'WHERE user_low NOT IN (SELECT id FROM users) OR user_high NOT IN (SELECT id FROM users))'),
+    ('conversations', 'user_low NOT IN (SELECT id FROM users) OR user_high NOT IN (SELECT id FROM users)'),
+    # Contact-form messages have no conversation.
+    ('messages', 'receiver_id NOT IN (SELECT id FROM users) '
+                 'OR (conversation_id IS NOT NULL AND conversation_id NOT IN (SELECT id FROM conversations))'),
+]
+_DANGLING = [('messages', 'sender_id', 'users'), ('messages', 'crop_id', 'crops'), ('messages', 'demand_id', 'demands')]
+
+
+def archive(conn, table, condition, params=()):
+    """Move the rows of ``table`` matching ``condition`` to orphaned_rows as JSON. Returns the count."""
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    fields = ', '.join(f"'{column}', {column}" for column in columns)
+    moved = conn.execute(f'INSERT INTO orphaned_rows (table_name, data) '
+                         f'SELECT ?, json_object({fields}) FROM {table} WHERE {condition}',
+                         (table, *params)).rowcount
+    if moved:
+        conn.execute(f'DELETE FROM {table} WHERE {condition}', params)
+    return moved
+
+
+def _archive_orphans(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS orphaned_rows (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        data TEXT NOT NULL,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    for table, condition in _ORPHANS:
+        moved = archive(conn, table, condition)
+        if moved:
+            logger.warning('Moved %d orphaned %s rows to orphaned_rows', moved, table)
+    for table, column, parent in _DANGLING:
+        cleared = conn.execute(f'UPDATE {table} SET {column} = NULL '
+                               f'WHERE {column} NOT IN (SELECT id FROM {parent})').rowcount
+        if cleared:
+            logger.warning('Cleared %d dangling %s.%s references', cleared, table, column)
+
+
+def _rebuild_foreign_keys(conn):
+    """Recreate each table of FOREIGN_KEY_ACTIONS with the actions added.
+
+    SQLite cannot alter a constraint, so this is its documented table rebuild:
+    copy into a new table, drop the old one, rename, and restore the indexes,
+    triggers and AUTOINCREMENT counter. Runs with foreign_keys off (migrate()
+    sees to that); legacy_alter_table stops the rename from rewriting other
+    tables' triggers that mention the table while it is briefly missing.
+    """
+    conn.execute('PRAGMA legacy_alter_table = ON')
+    try:
+        for table, actions in FOREIGN_KEY_ACTIONS.items():
+            sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+            for column, action in actions.items():
+                reference = rf'((?:FOREIGN KEY\s*\(\s*{column}\s*\)|\b{column}\s+INTEGER)\s+REFERENCES\s+"?\w+"?\s*\(\s*id\s*\))'
+                sql, found = re.subn(reference, rf'\1 ON DELETE {action}', sql)
+                if found != 1:
+                    raise sqlite3.DatabaseError(f'Could not find the foreign key on {table}.{column}')
+            dependents = conn.execute("SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') "
+                                      "AND sql IS NOT NULL", (table,)).fetchall()
+            sequence = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+            conn.execute(re.sub(rf'^CREATE TABLE "?{table}"?', f'CREATE TABLE {table}_rebuilt', sql))
+            conn.execute(f'INSERT INTO {table}_rebuilt SELECT * FROM {table}')
+            conn.execute(f'DROP TABLE {table}')
+            conn.execute(f'ALTER TABLE {table}_rebuilt RENAME TO {table}')
+            if sequence:
+                conn.execute('UPDATE sqlite_sequence SET seq = ? WHERE name = ?', (sequence[0], table))
+            for (statement,) in dependents:
+                conn.execute(statement)
+    finally:
+        conn.execute('PRAGMA legacy_alter_table = OFF')
+
+
+def _check_foreign_keys(conn):
+    violations = conn.execute('PRAGMA foreign_key_check').fetchall()
+    if violations:
+        raise sqlite3.IntegrityError(f'{len(violations)} rows violate foreign keys, e.g. {tuple(violations[0])}')
+
+
+FOREIGN_KEYS_AND_SOFT_DELETE = [
+    _archive_orphans,
+    _rebuild_foreign_keys,
+    _check_foreign_keys,
+    # Lookups that ON DELETE SET NULL runs for every deleted listing or demand.
+    'CREATE INDEX IF NOT EXISTS idx_messages_crop ON messages (crop_id)',
+    'CREATE INDEX IF NOT EXISTS idx_messages_demand ON messages (demand_id)',
+    '''
+    CREATE TRIGGER IF NOT EXISTS conversation_members_conversation_delete AFTER DELETE ON conversations BEGIN
+        DELETE FROM conversation_members WHERE conversation_id = old.id;
+    END
+    ''',
+    'ALTER TABLE users ADD COLUMN deleted_at TIMESTAMP',
+    'CREATE INDEX IF NOT EXISTS idx_users_deleted ON users (deleted_at) WHERE deleted_at IS NOT NULL',
+    f'''CREATE TRIGGER IF NOT EXISTS data_version_users_deleted AFTER UPDATE OF deleted_at ON users BEGIN
+        {_BUMP_VERSION.format('users')}
+    END''',
+    'ANALYZE',
+]
+
+# Per-user rating count, sum and histogram, kept current by triggers on
+# reviews, so a profile reads one row instead of scanning its reviews. Each
+# listing carries its farmer's average (0 until rated) for the buyer
+# dashboard's rating sort, which pages through idx_crops_farmer_rating.
+_RATING_COLUMNS = ['rating_count', 'rating_sum'] + [f'rating_{star}' for star in range(1, 6)]
+
+
+def _rate(row, sign):
+    return ', '.join([f'rating_count = rating_count {sign} 1', f'rating_sum = rating_sum {sign} {row}.rating']
+                     + [f'rating_{star} = rating_{star} {sign} ({row}.rating = {star})' for star in range(1, 6)])
+
+
+_FARMER_RATING = 'COALESCE(rating_sum * 1.0 / NULLIF(rating_count, 0), 0)'
+
+
+def _archive_duplicate_reviews(conn):
+    # One review per order; keep the latest where the form was submitted twice.
+    moved = archive(conn, 'reviews', 'id NOT IN (SELECT MAX(id) FROM reviews GROUP BY order_id, reviewer_id)')
+    if moved:
+        logger.warning('Moved %d duplicate reviews rows to orphaned_rows', moved)
+
+RATING_AGGREGATES = [
+    *[f'ALTER TABLE users ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0' for column in _RATING_COLUMNS],
+    'ALTER TABLE crops ADD COLUMN farmer_rating REAL NOT NULL DEFAULT 0',
+    _archive_duplicate_reviews,
+    'DROP INDEX IF EXISTS idx_reviews_order',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_reviews_order ON reviews (order_id, reviewer_id)',
+    f"""UPDATE users SET ({', '.join(_RATING_COLUMNS)}) = (
+        SELECT COUNT(*), TOTAL(rating), {', '.join(f'TOTAL(rating = {star})' for star in range(1, 6))}
+        FROM reviews WHERE reviewed_user_id = users.id
+    ) WHERE id IN (SELECT reviewed_user_id FROM reviews)""",
+    f"""UPDATE crops SET farmer_rating = (SELECT {_FARMER_RATING} FROM users WHERE id = crops.farmer_id)
+    WHERE farmer_id IN (SELECT reviewed_user_id FROM reviews)""",
+    'CREATE INDEX IF NOT EXISTS idx_crops_farmer_rating ON crops (farmer_rating, id)',
+    f"""CREATE TRIGGER IF NOT EXISTS reviews_rating_insert AFTER INSERT ON reviews BEGIN
+        UPDATE users SET {_rate('new', '+')} WHERE id = new.reviewed_user_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS reviews_rating_delete AFTER DELETE ON reviews BEGIN
+        UPDATE users SET {_rate('old', '-')} WHERE id = old.reviewed_user_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS reviews_rating_update AFTER UPDATE OF rating, reviewed_user_id ON reviews
+    WHEN old.rating IS NOT new.rating OR old.reviewed_user_id IS NOT new.reviewed_user_id BEGIN
+        UPDATE users SET {_rate('old', '-')} WHERE id = old.reviewed_user_id;
+        UPDATE users SET {_rate('new', '+')} WHERE id = new.reviewed_user_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS users_farmer_rating AFTER UPDATE OF rating_count, rating_sum ON users
+    WHEN old.rating_sum IS NOT new.rating_sum OR old.rating_count IS NOT new.rating_count BEGIN
+        UPDATE crops SET farmer_rating = (SELECT {_FARMER_RATING} FROM users WHERE id = new.id)
+        WHERE farmer_id = new.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS crops_farmer_rating_insert AFTER INSERT ON crops
+    WHEN (SELECT rating_count FROM users WHERE id = new.farmer_id) > 0 BEGIN
+        UPDATE crops SET farmer_rating = (SELECT {_FARMER_RATING} FROM users WHERE id = new.farmer_id)
+        WHERE id = new.id;
+    END""",
+    'ANALYZE',
+]
+
+# (version, description, steps)
+MIGRATIONS = [
+    (1, 'baseline schema', BASELINE_SCHEMA),
+    (2, 'hot-path indexes', HOT_PATH_INDEXES + ['ANALYZE']),
+    (3, 'full-text search for crops and demands', SEARCH_INDEX),
+    (4, 'normalized crop and demand quantities', NORMALIZED_QUANTITIES),
+    (5, 'order stock reservations', ORDER_RESERVATIONS),
+    (6, 'mail outbox', MAIL_OUTBOX),
+    (7, 'payment webhook events', PAYMENT_EVENTS),
+    (8, 'admin statistics counters', STATS_COUNTERS),
+    (9, 'user cache invalidations', USER_INVALIDATIONS),
+    (10, 'page cache data versions', DATA_VERSIONS),
+    (11, 'messaging conversations', CONVERSATIONS),
+    (12, 'push event fanout', PUSH_EVENTS),
+    (13, 'demand and listing matches', MATCHES),
+    (14, 'bulk import queue', CROP_IMPORT_QUEUE),
+    (15, 'API data versions', API_DATA_VERSIONS),
+    (16, 'login rate limits', RATE_LIMITS),
+    (17, 'server-side sessions', SESSIONS),
+    (18, 'foreign key actions and soft-deleted users', FOREIGN_KEYS_AND_SOFT_DELETE),
+    (19, 'rating aggregates and unique reviews', RATING_AGGREGATES),
+]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, target=None):
+    """Bring the database up to ``target`` (default: latest). Returns the new version."""
+    target = target if target is not None else MIGRATIONS[-1][0]
+    # Table rebuilds must not cascade; the pragma is ignored inside a transaction.
+    foreign_keys = conn.execute('PRAGMA foreign_keys').fetchone()[0]
+    conn.execute('PRAGMA foreign_keys = OFF')
+    try:
+        _apply(conn, target)
+    finally:
+        conn.execute(f'PRAGMA foreign_keys = {int(foreign_keys)}')
+    return schema_version(conn)
+
+
+def _apply(conn, target):
+    for version, description, steps in MIGRATIONS:
+        if version > target:
+            break
+        if version <= schema_version(conn):
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another worker may have applied it while we waited for the lock.
+            if version <= schema_version(conn):
+                conn.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else 'agrilink.db'
+    conn = sqlite3.connect(database)
+    before = schema_version(conn)
+    after = migrate(conn)
+    conn.close()
+    print(f"Database {database} migrated from version {before} to {after}.")
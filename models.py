@@ -1,6 +1,8 @@
 from flask_login import UserMixin
 
 class User(UserMixin):
+    __slots__ = ('id', 'email', 'name', 'role')
+
     def __init__(self, id, email, name, role):
         self.id = id
         self.email = email
@@ -0,0 +1,180 @@
+"""Persistent outbound mail queue.
+
+Routes call ``enqueue()`` instead of ``mail.send()``: the message is written
+to the ``mail_outbox`` table and the request returns straight away. A small
+pool of sender threads claims due messages in batches, delivers each batch
+over a single SMTP connection and retries failures with exponential backoff.
+Rows are claimed under ``BEGIN IMMEDIATE`` with a lease, so several worker
+processes can share one outbox and a crashed sender's batch is picked up
+again once its lease runs out.
+"""
+import json
+import random
+import smtplib
+import sqlite3
+import threading
+
+from flask_mail import Message
+
+import metrics
+from db import connect
+
+SENDER_THREADS = 2
+BATCH_SIZE = 20
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 30  # seconds; doubles on every failed attempt
+BACKOFF_MAX = 3600
+LEASE_SECONDS = 300
+IDLE_POLL = 15  # seconds between checks for retries that became due
+
+_wakeup = threading.Event()
+
+
+def enqueue(conn, msg):
+    """Queue a flask_mail Message for delivery and commit. Returns the outbox id."""
+    cursor = conn.execute("""
+        INSERT INTO mail_outbox (sender, recipients, subject, body, html)
+        VALUES (?, ?, ?, ?, ?)
+    """, (json.dumps(msg.sender), json.dumps(list(msg.recipients)), msg.subject, msg.body, msg.html))
+    conn.commit()
+    metrics.inc('agrilink_mail_enqueued_total')
+    _wakeup.set()
+    return cursor.lastrowid
+
+
+def queue_depth(conn):
+    return conn.execute("SELECT COUNT(*) FROM mail_outbox WHERE status IN ('queued', 'sending')").fetchone()[0]
+
+
+def claim_batch(conn, limit=BATCH_SIZE):
+    """Lease up to ``limit`` due messages to the caller."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rows = conn.execute("""
+            SELECT id, sender, recipients, subject, body, html, attempts FROM mail_outbox
+            WHERE (status = 'queued' AND next_attempt_at <= datetime('now'))
+               OR (status = 'sending' AND locked_until <= datetime('now'))
+            ORDER BY next_attempt_at
+            LIMIT ?
+        """, (limit,)).fetchall()
+        conn.executemany(
+            "UPDATE mail_outbox SET status = 'sending', locked_until = datetime('now', ?) WHERE id = ?",
+            [(f'+{LEASE_SECONDS} seconds', row['id']) for row in rows])
+        conn.commit()
+        return rows
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _to_message(row):
+    sender = json.loads(row['sender'])
+    return Message(row['subject'], recipients=json.loads(row['recipients']), body=row['body'],
+                   html=row['html'], sender=tuple(sender) if isinstance(sender, list) else sender)
+
+
+def mark_sent(conn, outbox_id):
+    conn.execute("""
+        UPDATE mail_outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP, locked_until = NULL, last_error = NULL
+        WHERE id = ?
+    """, (outbox_id,))
+    conn.commit()
+    metrics.inc('agrilink_mail_sent_total')
+
+
+def mark_failed(conn, row, error):
+    """Schedule a retry with exponential backoff, or give up after MAX_ATTEMPTS."""
+    attempts = row['attempts'] + 1
+    if attempts >= MAX_ATTEMPTS:
+        conn.execute("""
+            UPDATE mail_outbox SET status = 'failed', attempts = ?, last_error = ?, locked_until = NULL
+            WHERE id = ?
+        """, (attempts, str(error)[:500], row['id']))
+        retry = 'no'
+    else:
+        delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+        delay = int(delay * random.uniform(0.8, 1.2))
+        conn.execute("""
+            UPDATE mail_outbox
+            SET status = 'queued', attempts = ?, last_error = ?, locked_until = NULL,
+                next_attempt_at = datetime('now', ?)
+            WHERE id = ?
+        """, (attempts, str(error)[:500], f'+{delay} seconds', row['id']))
+        retry = 'yes'
+    conn.commit()
+    metrics.inc('agrilink_mail_failed_total', retry=retry)
+
+
+def deliver_batch(mail, conn, rows):
+    """Send ``rows`` over one SMTP connection. Returns the number delivered."""
+    delivered = 0
+    pending = list(rows)
+    try:
+        with mail.connect() as smtp:
+            while pending:
+                row = pending[0]
+                try:
+                    smtp.send(_to_message(row))
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError,
+                        smtplib.SMTPSenderRefused, AssertionError) as e:
+                    # This message is the problem, not the connection.
+                    mark_failed(conn, row, e)
+                else:
+                    mark_sent(conn, row['id'])
+                    delivered += 1
+                pending.pop(0)
+    except (smtplib.SMTPException, OSError) as e:
+        for row in pending:
+            mark_failed(conn, row, e)
+    return delivered
+
+
+class MailSender:
+    """Background pool of sender threads for one Flask app."""
+
+    def __init__(self, app, threads=SENDER_THREADS, batch_size=BATCH_SIZE):
+        self.app = app
+        self.threads = threads
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._workers = []
+
+    def start(self):
+        for i in range(self.threads):
+            worker = threading.Thread(target=self._run, name=f'mail-sender-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        self._stop.set()
+        _wakeup.set()
+
+    def run_once(self, conn):
+        rows = claim_batch(conn, self.batch_size)
+        if rows:
+            deliver_batch(self.app.extensions['mail'], conn, rows)
+        return len(rows)
+
+    def _run(self):
+        conn = connect(self.app.config['DATABASE'])
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    claimed = self.run_once(conn)
+                except sqlite3.Error:
+                    self.app.logger.exception('Mail outbox sender failed')
+                    claimed = 0
+                if claimed < self.batch_size:
+                    _wakeup.wait(IDLE_POLL)
+                    _wakeup.clear()
+        conn.close()
+
+
+def init_app(app):
+    app.config.setdefault('MAIL_OUTBOX_THREADS', SENDER_THREADS)
+    app.config.setdefault('MAIL_OUTBOX_BATCH_SIZE', BATCH_SIZE)
+    sender = MailSender(app, app.config['MAIL_OUTBOX_THREADS'], app.config['MAIL_OUTBOX_BATCH_SIZE'])
+    app.extensions['mail_outbox'] = sender
+    if app.config['MAIL_OUTBOX_THREADS']:
+        sender.start()
+    return sender
@@ -0,0 +1,159 @@
+"""Response and fragment caching for pages built from crop listings.
+
+Triggers added by migration 10 bump a row in ``data_versions`` whenever a
+crop (or a farmer's name or picture) changes. Cached pages and fragments are
+keyed on that version, so they stay valid until the data they show changes:
+
+* ``@cached('crops')`` gives a view an ETag built from the version, the URL
+  and the visitor's session. A matching ``If-None-Match`` is answered with
+  304 before the view runs, so a view that only some users may see names
+  their role (``@cached('crops', role='buyer')``) and everyone else goes
+  straight to the view and its own check. Pages for anonymous visitors are
+  also stored whole and served with ``Last-Modified`` without touching
+  Jinja. Image URLs depend on ``Accept`` (WebP or not), so responses say
+  ``Vary: Accept``.
+* ``fragment(key, 'crops', render)`` caches one rendered piece of a page,
+  for pages that differ per user around a shared part.
+
+Each process reads the version at most once every ``VERSION_TTL`` seconds.
+"""
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+from markupsafe import Markup
+
+from db import get_db_connection
+from uploads import accepts_webp
+
+VERSION_TTL = 1  # seconds
+PAGE_CACHE_SIZE = 512
+PAGE_CACHE_TTL = 300  # seconds; also picks up thumbnails rendered after an upload
+
+
+class PageCache:
+
+    def __init__(self, max_entries=PAGE_CACHE_SIZE, ttl=PAGE_CACHE_TTL, version_ttl=VERSION_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+        self._versions = {}  # name -> (version, updated_at, expires_at)
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, conn, name):
+        """Return ``(version, updated_at)`` for a data set, re-read at most every ``version_ttl`` seconds."""
+        now = time.monotonic()
+        entry = self._versions.get(name)
+        if entry and entry[2] > now:
+            return entry[0], entry[1]
+        row = conn.execute('SELECT version, updated_at FROM data_versions WHERE name = ?', (name,)).fetchone()
+        version, updated_at = (row[0], row[1]) if row else (0, None)
+        if updated_at:
+            updated_at = datetime.strptime(updated_at, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        self._versions[name] = (version, updated_at, now + self.version_ttl)
+        return version, updated_at
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+def _etag(name, version):
+    # Everything the rendered page depends on besides the data itself.
+    visitor = sorted((key, repr(value)) for key, value in session.items())
+    raw = repr((name, version, request.full_path, accepts_webp(), visitor))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def _add_validators(response, etag, updated_at, public):
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    response.cache_control.no_cache = True
+    if public:
+        response.cache_control.public = True
+        if updated_at:
+            response.last_modified = updated_at
+    else:
+        response.cache_control.private = True
+    return response
+
+
+def cached(name, role=None):
+    """Serve a GET view with ETag/304 support, keyed on data version ``name``.
+
+    With ``role``, only users of that role are served from the cache.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or '_flashes' in session:
+                return view(*args, **kwargs)
+            if role is not None and getattr(current_user, 'role', None) != role:
+                return view(*args, **kwargs)
+            cache = current_app.extensions['page_cache']
+            version, updated_at = cache.version(get_db_connection(), name)
+            public = not current_user.is_authenticated
+            etag = _etag(name, version)
+
+            if request.if_none_match.contains(etag):
+                return _add_validators(make_response('', 304), etag, updated_at, public)
+            body = cache.get(('page', etag)) if public else None
+            if body is not None:
+                response = make_response(body)
+                return _add_validators(response, etag, updated_at, public).make_conditional(request)
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.mimetype != 'text/html' or '_flashes' in session:
+                return response
+            if public:
+                cache.put(('page', etag), response.get_data())
+            return _add_validators(response, etag, updated_at, public).make_conditional(request)
+        return wrapper
+    return decorator
+
+
+def fragment(key, name, render):
+    """Return the cached HTML for ``key``, calling ``render()`` when data version ``name`` has moved on."""
+    cache = current_app.extensions['page_cache']
+    version, _ = cache.version(get_db_connection(), name)
+    cache_key = ('fragment', name, version, accepts_webp()) + tuple(key)
+    html = cache.get(cache_key)
+    if html is None:
+        html = render()
+        cache.put(cache_key, html)
+    return Markup(html)
+
+
+def init_app(app):
+    app.config.setdefault('PAGE_CACHE_SIZE', PAGE_CACHE_SIZE)
+    app.config.setdefault('PAGE_CACHE_TTL', PAGE_CACHE_TTL)
+    cache = PageCache(app.config['PAGE_CACHE_SIZE'], app.config['PAGE_CACHE_TTL'])
+    app.extensions['page_cache'] = cache
+    return cache
@@ -0,0 +1,141 @@
+"""Keyset (seek) pagination and cached approximate counts.
+
+Instead of ``LIMIT ? OFFSET ?`` every list walks an index from the last row
+the client saw, so page 1000 costs the same as page 1. The position is handed
+to the client as an opaque ``after=`` / ``before=`` token holding the sort key
+of the last / first row on the current page.
+"""
+import base64
+import json
+import threading
+import time
+
+COUNT_CACHE_TTL = 60  # seconds
+COUNT_CACHE_SIZE = 1024
+
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, size):
+    """Return the sort-key tuple in ``token``, or None if it is missing or malformed."""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    if not all(isinstance(v, (int, float, str)) for v in values):
+        return None
+    return tuple(values)
+
+
+class Page:
+    """One page of rows plus the tokens needed to move to its neighbours."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def fetch_page(conn, query, conditions, params, keys, args, per_page, descending=True):
+    """Run ``query`` one page at a time, highest sort key first unless ``descending`` is False.
+
+    ``keys`` is a list of ``(sql_expression, column_name)`` pairs forming a
+    unique sort key; every column name must be present in the SELECT list so
+    the next cursor can be read off the last row. ``args`` is the request's
+    query-string mapping holding the optional ``after`` / ``before`` tokens.
+    """
+    expressions = [expression for expression, _ in keys]
+    columns = [column for _, column in keys]
+    conditions = list(conditions)
+    params = list(params)
+
+    after = decode_cursor(args.get('after'), len(keys))
+    before = decode_cursor(args.get('before'), len(keys)) if after is None else None
+    backwards = before is not None
+    cursor = before if backwards else after
+    if cursor is not None:
+        comparison = '>' if backwards == descending else '<'
+        conditions.append(f"({', '.join(expressions)}) {comparison} ({', '.join('?' * len(keys))})")
+        params.extend(cursor)
+
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    direction = " ASC" if backwards == descending else " DESC"
+    query += " ORDER BY " + ", ".join(expression + direction for expression in expressions)
+    query += " LIMIT ?"
+    params.append(per_page + 1)
+
+    rows = conn.execute(query, tuple(params)).fetchall()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    def cursor_of(row):
+        return encode_cursor(row[column] for column in columns)
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more or backwards:
+            next_cursor = cursor_of(rows[-1])
+        if (has_more and backwards) or (not backwards and cursor is not None):
+            prev_cursor = cursor_of(rows[0])
+    return Page(rows, next_cursor, prev_cursor)
+
+
+class CountCache:
+    """Short-lived cache of COUNT(*) results shared by one worker process.
+
+    Totals shown next to a paginated list only need to be roughly right, so
+    they are recomputed at most once per ``ttl`` seconds per query.
+    """
+
+    def __init__(self, ttl=COUNT_CACHE_TTL, max_entries=COUNT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def count(self, conn, query, params=()):
+        key = (query, tuple(params))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                return entry[0]
+        total = conn.execute(query, tuple(params)).fetchone()[0]
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries = {k: v for k, v in self._entries.items() if v[1] > now}
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[key] = (total, now + self.ttl)
+        return total
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+count_cache = CountCache()
+
+
+def approximate_count(conn, query, params=()):
+    return count_cache.count(conn, query, params)
@@ -0,0 +1,124 @@
+"""Password hashing off the request thread.
+
+scrypt and pbkdf2 are deliberately slow. Run inline, a burst of login
+attempts keeps every request thread busy hashing and the rest of the site
+waits behind it. ``Hasher`` runs werkzeug's hash functions in a small process
+pool instead and admits at most ``PASSWORD_QUEUE_DEPTH`` hashes at a time
+(running or waiting); past that ``hash_password()`` and ``verify()`` raise
+``Busy`` straight away, so the route can answer 503 rather than queue
+without bound.
+
+``needs_rehash()`` reports hashes made with other parameters than
+``PASSWORD_HASH_METHOD``; the login route re-hashes those with the password
+it has just checked. Spell the method out in full (``scrypt:32768:8:1``,
+``pbkdf2:sha256:1000000``), the way werkzeug writes it into the hash.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import metrics
+
+HASH_METHOD = 'scrypt:32768:8:1'
+PASSWORD_WORKERS = 2
+PASSWORD_QUEUE_DEPTH = 16
+HASH_TIMEOUT = 10  # seconds a request waits for its hash
+
+
+class Busy(Exception):
+    """Too many hashes are queued; try again shortly."""
+
+
+class Hasher:
+
+    def __init__(self, method=HASH_METHOD, workers=PASSWORD_WORKERS, queue_depth=PASSWORD_QUEUE_DEPTH,
+                 timeout=HASH_TIMEOUT):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_depth)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._dummy_hash = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn, not fork: the web process runs background threads.
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            metrics.inc('agrilink_password_hashes_rejected_total')
+            raise Busy()
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self._get_pool().submit(fn, *args)
+        except BrokenProcessPool:
+            # A worker died (OOM killer, say); start a fresh pool next time.
+            with self._lock:
+                self._pool = None
+            self._release(None)
+            raise Busy()
+        except BaseException:
+            self._release(None)
+            raise
+        # The slot stays taken until the hash finishes, even if we stop waiting.
+        future.add_done_callback(self._release)
+        try:
+            return future.result(self.timeout)
+        except (TimeoutError, BrokenProcessPool):
+            raise Busy()
+
+    def queue_depth(self):
+        return self._pending
+
+    def hash_password(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        """Check ``password`` against ``pwhash``; a None hash (unknown user) costs the same and fails."""
+        if pwhash is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = self.hash_password('')
+            self._run(check_password_hash, self._dummy_hash, password)
+            return False
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self.method
+
+
+def hash_password(password):
+    return current_app.extensions['passwords'].hash_password(password)
+
+
+def verify(pwhash, password):
+    return current_app.extensions['passwords'].verify(pwhash, password)
+
+
+def needs_rehash(pwhash):
+    return current_app.extensions['passwords'].needs_rehash(pwhash)
+
+
+def init_app(app):
+    app.config.setdefault('PASSWORD_HASH_METHOD', HASH_METHOD)
+    app.config.setdefault('PASSWORD_WORKERS', PASSWORD_WORKERS)
+    app.config.setdefault('PASSWORD_QUEUE_DEPTH', PASSWORD_QUEUE_DEPTH)
+    hasher = Hasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_WORKERS'],
+                    app.config['PASSWORD_QUEUE_DEPTH'])
+    app.extensions['passwords'] = hasher
+    return hasher
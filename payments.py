@@ -0,0 +1,213 @@
+"""Idempotent PayChangu webhook ingestion.
+
+Every callback is appended to ``payment_events`` under a unique provider
+transaction id, so a replayed callback is recognised and ignored. Orders only
+ever move forward (pending -> paid); late or out-of-order callbacks cannot
+undo a payment. Callbacks that arrive together are written by a single
+writer thread in one transaction (group commit) instead of one fsync each.
+"""
+import hashlib
+import hmac
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+from db import connect
+from quantities import format_quantity
+
+PROVIDER = 'paychangu'
+MAX_ORDER_ID = 2 ** 63 - 1  # largest SQLite integer
+MAX_BATCH = 200
+# Extra time to wait for more callbacks to share a commit. Zero still batches
+# everything that queued up while the previous commit was running.
+MAX_BATCH_DELAY = 0
+SUBMIT_TIMEOUT = 10
+
+# Outcomes recorded on each event.
+APPLIED = 'applied'
+DUPLICATE = 'duplicate'
+IGNORED = 'ignored'
+REJECTED = 'rejected'
+
+
+class InvalidEvent(ValueError):
+    pass
+
+
+def verify_signature(secret, raw_body, signature):
+    """Check the HMAC-SHA256 ``Signature`` header PayChangu sends with each webhook.
+
+    Without a configured secret every callback is accepted (development only).
+    """
+    if not secret:
+        return True
+    if not signature:
+        return False
+    expected = hmac.new(secret.encode(), raw_body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature.strip().lower())
+
+
+def parse_event(payload):
+    """Pull the fields we need out of a callback payload."""
+    if not isinstance(payload, dict):
+        raise InvalidEvent('payload must be a JSON object')
+    data = payload.get('data') if isinstance(payload.get('data'), dict) else payload
+    tx_ref = data.get('tx_ref') or payload.get('tx_ref')
+    if not tx_ref:
+        raise InvalidEvent('tx_ref not found')
+    # tx_ref looks like 'agri_order_123'
+    try:
+        order_id = int(str(tx_ref).split('_')[-1])
+    except ValueError:
+        raise InvalidEvent('Invalid tx_ref format')
+    if not 0 < order_id <= MAX_ORDER_ID:
+        raise InvalidEvent('Invalid tx_ref format')
+    status = str(data.get('status') or payload.get('status') or '').lower()
+    transaction_id = (data.get('reference') or data.get('transaction_id') or data.get('charge_id')
+                      or payload.get('reference'))
+    if not transaction_id:
+        # Without a provider id, a replay of the same outcome is the same event.
+        transaction_id = f'{tx_ref}:{status}'
+    amount = data.get('amount')
+    try:
+        amount = float(amount) if amount is not None else None
+    except (TypeError, ValueError):
+        amount = None
+    return {
+        'transaction_id': str(transaction_id),
+        'tx_ref': str(tx_ref),
+        'order_id': order_id,
+        'status': status,
+        'amount': amount,
+        'payload': json.dumps(payload, separators=(',', ':'), sort_keys=True),
+    }
+
+
+def _mark_paid(conn, event):
+    order = conn.execute('SELECT order_status, crop_id, quantity, total_price FROM orders WHERE id = ?',
+                         (event['order_id'],)).fetchone()
+    if order is None:
+        return REJECTED, 'unknown order'
+    status, crop_id, quantity, total_price = order
+    if event['amount'] is not None and event['amount'] + 0.5 < int(total_price):
+        return REJECTED, f"amount {event['amount']:g} is less than order total {total_price:g}"
+    if status == 'pending':
+        conn.execute("UPDATE orders SET order_status = 'paid', reserved_until = NULL WHERE id = ? AND order_status = 'pending'",
+                     (event['order_id'],))
+        return APPLIED, None
+    if status == 'expired':
+        # Paid after the reservation lapsed: take the stock again if it is still there.
+        crop = conn.execute('SELECT quantity_value, quantity_unit FROM crops WHERE id = ?', (crop_id,)).fetchone()
+        if crop is None or crop[0] is None or crop[0] < quantity:
+            return REJECTED, 'paid after reservation expired and stock is gone; refund required'
+        conn.execute('UPDATE crops SET quantity_value = ?, quantity = ? WHERE id = ?',
+                     (crop[0] - quantity, format_quantity(crop[0] - quantity, crop[1]), crop_id))
+        conn.execute("UPDATE orders SET order_status = 'paid' WHERE id = ? AND order_status = 'expired'",
+                     (event['order_id'],))
+        return APPLIED, 'stock re-reserved after expiry'
+    # Already paid or further along: never move backwards.
+    return IGNORED, f'order already {status}'
+
+
+def record_and_apply(conn, events):
+    """Record ``events`` and apply their transitions inside the caller's transaction.
+
+    Returns one outcome per event, in order.
+    """
+    outcomes = []
+    for event in events:
+        cursor = conn.execute("""
+            INSERT OR IGNORE INTO payment_events (provider, transaction_id, tx_ref, order_id, status, amount, payload)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (PROVIDER, event['transaction_id'], event['tx_ref'], event['order_id'], event['status'],
+              event['amount'], event['payload']))
+        if cursor.rowcount == 0:
+            outcomes.append(DUPLICATE)
+            continue
+        if event['status'] == 'success':
+            outcome, note = _mark_paid(conn, event)
+        else:
+            outcome, note = IGNORED, f"status '{event['status']}' does not change the order"
+        conn.execute('UPDATE payment_events SET outcome = ?, note = ? WHERE id = ?',
+                     (outcome, note, cursor.lastrowid))
+        outcomes.append(outcome)
+    return outcomes
+
+
+class GroupCommitter:
+    """Single writer thread that commits bursts of webhook events together."""
+
+    def __init__(self, database, max_batch=MAX_BATCH, max_delay=MAX_BATCH_DELAY):
+        self.database = database
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.events = 0
+
+    def submit(self, event, timeout=SUBMIT_TIMEOUT):
+        """Queue ``event`` and block until its transaction has committed."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((event, future, time.perf_counter()))
+        return future.result(timeout)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='payment-webhooks', daemon=True)
+                    self._thread.start()
+
+    def _drain(self):
+        batch = [self._queue.get()]
+        try:
+            while len(batch) < self.max_batch:
+                if self.max_delay:
+                    batch.append(self._queue.get(timeout=self.max_delay))
+                else:
+                    batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _commit(self, conn, batch):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            outcomes = record_and_apply(conn, [event for event, _, _ in batch])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            if len(batch) > 1:
+                # Retry one by one, so only the event at fault fails and the rest of the burst commits.
+                for item in batch:
+                    self._commit(conn, [item])
+                return
+            batch[0][1].set_exception(e)
+            metrics.inc('agrilink_payment_webhooks_total', outcome='error')
+            return
+        committed = time.perf_counter()
+        self.batches += 1
+        self.events += len(batch)
+        for (_, future, received), outcome in zip(batch, outcomes):
+            metrics.inc('agrilink_payment_webhooks_total', outcome=outcome)
+            metrics.observe('agrilink_payment_webhook_seconds', committed - received)
+            future.set_result(outcome)
+
+    def _run(self):
+        conn = connect(self.database)
+        while True:
+            self._commit(conn, self._drain())
+
+
+def init_app(app):
+    app.config.setdefault('PAYCHANGU_WEBHOOK_SECRET', None)
+    app.extensions['payment_webhooks'] = GroupCommitter(app.config['DATABASE'])
@@ -0,0 +1,203 @@
+"""Server-Sent Events push to logged-in users.
+
+Routes call ``notify(user_id, event, data)`` after committing a change the
+user should see (a new message, an order moving status). The ``Broker``
+holds one small ``Subscription`` per open ``/events`` stream and hands each
+notification to that user's streams; an idle stream costs one blocked
+waiter and a short deque, so a gevent/eventlet worker
+(``gunicorn -k gevent``) can hold thousands of them.
+
+How notifications reach the broker is pluggable:
+
+* ``LocalFanout`` delivers straight to this process. Enough for one worker.
+* ``SQLiteFanout`` appends to the ``push_events`` table, which every worker
+  with open streams polls; a local stand-in for Redis pub/sub when running
+  several workers on one machine. Select it with ``PUSH_FANOUT=sqlite``.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from flask import Response, current_app
+
+from db import connect
+
+HEARTBEAT = 25  # seconds between keep-alive comments on an idle stream
+MAX_PENDING = 50  # events buffered per stream before the oldest are dropped
+RECONNECT_MS = 5000
+POLL_INTERVAL = 0.5  # seconds, SQLiteFanout
+EVENT_RETENTION = 300  # seconds, SQLiteFanout
+
+
+class Subscription:
+    __slots__ = ('user_id', 'events', 'ready')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.events = deque(maxlen=MAX_PENDING)
+        self.ready = threading.Event()
+
+    def put(self, event):
+        self.events.append(event)
+        self.ready.set()
+
+    def wait(self, timeout):
+        """Return the events received since the last call; empty after ``timeout``."""
+        self.ready.wait(timeout)
+        self.ready.clear()
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return events
+
+
+class Broker:
+    """In-process registry of open streams by user id."""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            streams = self._subscribers.get(subscription.user_id)
+            if streams:
+                streams.discard(subscription)
+                if not streams:
+                    del self._subscribers[subscription.user_id]
+
+    def deliver(self, user_id, event):
+        with self._lock:
+            streams = list(self._subscribers.get(user_id, ()))
+        for subscription in streams:
+            subscription.put(event)
+        return len(streams)
+
+    def connection_count(self):
+        with self._lock:
+            return sum(len(streams) for streams in self._subscribers.values())
+
+
+class LocalFanout:
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def publish(self, user_id, event):
+        self.broker.deliver(user_id, event)
+
+    def subscribed(self):
+        pass
+
+
+class SQLiteFanout:
+    """Share notifications between worker processes through the ``push_events`` table."""
+
+    def __init__(self, broker, database, logger, poll_interval=POLL_INTERVAL):
+        self.broker = broker
+        self.database = database
+        self.logger = logger
+        self.poll_interval = poll_interval
+        self._conn = None
+        self._lock = threading.Lock()
+        self._poller = None
+
+    def publish(self, user_id, event):
+        with self._lock:
+            if self._conn is None:
+                self._conn = connect(self.database)
+            self._conn.execute('INSERT INTO push_events (user_id, event) VALUES (?, ?)',
+                               (user_id, json.dumps(event, separators=(',', ':'))))
+            self._conn.commit()
+
+    def subscribed(self):
+        """Start polling once this process has a stream open."""
+        if self._poller is None:
+            with self._lock:
+                if self._poller is None:
+                    self._poller = threading.Thread(target=self._poll, name='push-fanout', daemon=True)
+                    self._poller.start()
+
+    def _poll(self):
+        conn = connect(self.database)
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM push_events').fetchone()[0]
+        next_prune = 0
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                rows = conn.execute('SELECT id, user_id, event FROM push_events WHERE id > ? ORDER BY id',
+                                    (last_id,)).fetchall()
+                for row_id, user_id, event in rows:
+                    self.broker.deliver(user_id, json.loads(event))
+                    last_id = row_id
+                if time.monotonic() > next_prune:
+                    conn.execute("DELETE FROM push_events WHERE created_at < datetime('now', ?)",
+                                 (f'-{EVENT_RETENTION} seconds',))
+                    conn.commit()
+                    next_prune = time.monotonic() + EVENT_RETENTION
+            except sqlite3.Error:
+                self.logger.exception('Push fanout poll failed')
+
+
+class PushChannel:
+
+    def __init__(self, fanout, broker, heartbeat=HEARTBEAT):
+        self.fanout = fanout
+        self.broker = broker
+        self.heartbeat = heartbeat
+
+    def publish(self, user_id, event, data):
+        self.fanout.publish(user_id, {'event': event, 'data': data})
+
+    def stream(self, user_id):
+        """Response streaming ``user_id``'s events until the client disconnects.
+
+        Built without stream_with_context on purpose: the request's pooled
+        database connection is returned as soon as the response starts.
+        """
+        subscription = self.broker.subscribe(user_id)
+        self.fanout.subscribed()
+
+        def generate():
+            try:
+                yield f'retry: {RECONNECT_MS}\n\n'
+                while True:
+                    events = subscription.wait(self.heartbeat)
+                    if not events:
+                        yield ': keep-alive\n\n'
+                    for event in events:
+                        yield f"event: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+            finally:
+                self.broker.unsubscribe(subscription)
+
+        return Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def notify(user_id, event, data):
+    """Push ``event`` to every open stream of ``user_id``. Never fails the caller's request."""
+    try:
+        current_app.extensions['push'].publish(user_id, event, data)
+    except sqlite3.Error:
+        current_app.logger.exception('Could not publish %s event for user %s', event, user_id)
+
+
+def init_app(app):
+    app.config.setdefault('PUSH_FANOUT', 'local')
+    app.config.setdefault('PUSH_HEARTBEAT', HEARTBEAT)
+    broker = Broker()
+    if app.config['PUSH_FANOUT'] == 'sqlite':
+        fanout = SQLiteFanout(broker, app.config['DATABASE'], app.logger)
+    else:
+        fanout = LocalFanout(broker)
+    channel = PushChannel(fanout, broker, app.config['PUSH_HEARTBEAT'])
+    app.extensions['push'] = channel
+    return channel
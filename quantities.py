@@ -0,0 +1,55 @@
+"""Parse free-text quantities such as '500kg', '2 tonnes' or '500 bunches'.
+
+Crops and demands keep the text the user typed in ``quantity`` and store a
+normalized ``quantity_value`` / ``quantity_unit`` pair next to it, so volume
+can be filtered and sorted in SQL. Mass is always stored in kilograms.
+"""
+import re
+
+BAG_KG = 50  # the standard Malawian grain bag
+
+# alias -> (canonical unit, factor to the canonical unit)
+UNITS = {
+    '': ('kg', 1),  # prices are quoted per kg, so a bare number means kg
+    'kg': ('kg', 1), 'kgs': ('kg', 1), 'kilo': ('kg', 1), 'kilos': ('kg', 1),
+    'kilogram': ('kg', 1), 'kilograms': ('kg', 1),
+    'g': ('kg', 0.001), 'gram': ('kg', 0.001), 'grams': ('kg', 0.001),
+    't': ('kg', 1000), 'mt': ('kg', 1000), 'ton': ('kg', 1000), 'tons': ('kg', 1000),
+    'tonne': ('kg', 1000), 'tonnes': ('kg', 1000),
+    'bag': ('kg', BAG_KG), 'bags': ('kg', BAG_KG),
+    'bunch': ('bunch', 1), 'bunches': ('bunch', 1),
+}
+
+_QUANTITY_RE = re.compile(r'^\s*(\d[\d,]*(?:\.\d+)?|\.\d+)\s*([a-zA-Z]*)')
+
+
+def parse_quantity(text):
+    """Return ``(value, unit)`` in canonical units, or ``(None, None)``.
+
+    Units that are not recognised are kept as typed (lower-cased) without
+    conversion rather than being guessed at.
+    """
+    if text is None:
+        return None, None
+    match = _QUANTITY_RE.match(str(text))
+    if not match:
+        return None, None
+    value = float(match.group(1).replace(',', ''))
+    unit = match.group(2).lower()
+    canonical, factor = UNITS.get(unit, (unit, 1))
+    return value * factor, canonical
+
+
+def format_quantity(value, unit):
+    """Render a normalized quantity back to text, e.g. ``(490.0, 'kg')`` -> '490 kg'."""
+    number = ('%.3f' % value).rstrip('0').rstrip('.')
+    return f"{number} {unit}" if unit else number
+
+
+def backfill(conn):
+    """Migration step: fill the normalized columns for existing rows."""
+    for table in ('crops', 'demands'):
+        rows = conn.execute(f"SELECT id, quantity FROM {table}").fetchall()
+        conn.executemany(
+            f"UPDATE {table} SET quantity_value = ?, quantity_unit = ? WHERE id = ?",
+            [parse_quantity(quantity) + (row_id,) for row_id, quantity in rows])
@@ -0,0 +1,246 @@
+"""Per-request SQL instrumentation.
+
+Every connection opened by ``db.connect()`` is an ``InstrumentedConnection``.
+While a request holds one, each statement it runs is recorded in that
+request's ``QueryLog``: the normalized statement, time spent executing and
+fetching, and rows returned. When the request finishes:
+
+* a ``Server-Timing`` header reports SQL time, query count and rows next to
+  the total (browser devtools show it on the Timing tab),
+* statements slower than ``SLOW_QUERY_MS`` are logged as JSON on the
+  ``agrilink.sql`` logger together with their ``EXPLAIN QUERY PLAN``,
+* a SELECT run ``N_PLUS_ONE_THRESHOLD`` times or more in one request is
+  logged as a likely N+1 pattern.
+
+Outside a request (sweepers, committers, scripts) nothing is recorded and
+the wrapper only adds an attribute check per call.
+"""
+import functools
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, request
+
+SLOW_QUERY_MS = 100
+N_PLUS_ONE_THRESHOLD = 10
+PLAN_CACHE_SIZE = 256
+
+logger = logging.getLogger('agrilink.sql')
+
+_SPACES = re.compile(r'\s+')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|(?<![\w?$:@.])-?\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r'\bIN \( ?\?(?: ?, ?\?)* ?\)', re.IGNORECASE)
+_VALUES_LISTS = re.compile(r'\bVALUES (\([^()]*\))(?:, \([^()]*\))+', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(sql):
+    """Collapse whitespace, literals and IN/VALUES lists so repeats of one query compare equal."""
+    sql = _LITERALS.sub('?', _SPACES.sub(' ', sql).strip())
+    sql = _IN_LISTS.sub('IN (...)', sql)
+    return _VALUES_LISTS.sub(r'VALUES \1, ...', sql)
+
+
+class Statement:
+    __slots__ = ('sql', 'params', 'many', 'elapsed', 'rows')
+
+    def __init__(self, sql, params, many, elapsed):
+        self.sql = sql
+        self.params = params
+        self.many = many
+        self.elapsed = elapsed
+        self.rows = 0
+
+
+class QueryLog:
+    """The statements one request ran, in order."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = []
+
+    def record(self, sql, params, elapsed, many=False):
+        statement = Statement(sql, params, many, elapsed)
+        self.statements.append(statement)
+        return statement
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def elapsed(self):
+        return sum(s.elapsed for s in self.statements)
+
+    @property
+    def rows(self):
+        return sum(s.rows for s in self.statements)
+
+    def repeated(self):
+        """``{normalized SELECT: [statements]}`` for SELECTs run more than once."""
+        groups = {}
+        for statement in self.statements:
+            groups.setdefault(normalize(statement.sql), []).append(statement)
+        return {sql: runs for sql, runs in groups.items()
+                if len(runs) > 1 and sql[:6].upper() in ('SELECT', 'WITH ')}
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    _statement = None
+
+    def execute(self, sql, parameters=()):
+        log = self.connection.query_log
+        if log is None:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._statement = log.record(sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        log = self.connection.query_log
+        if log is None:
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._statement = log.record(sql, None, time.perf_counter() - started, many=True)
+
+    def _fetched(self, started, rows):
+        self._statement.elapsed += time.perf_counter() - started
+        self._statement.rows += rows
+
+    def fetchone(self):
+        if self._statement is None:
+            return super().fetchone()
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        if self._statement is None:
+            return super().fetchmany(size)
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        if self._statement is None:
+            return super().fetchall()
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+    def __next__(self):
+        if self._statement is None:
+            return super().__next__()
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(started, 0)
+            raise
+        self._fetched(started, 1)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """A connection that records into ``query_log`` while one is attached."""
+
+    query_log = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class PlanCache:
+    """EXPLAIN QUERY PLAN output by normalized statement, so a repeat offender is explained once."""
+
+    def __init__(self, max_entries=PLAN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def explain(self, conn, statement):
+        key = normalize(statement.sql)
+        with self._lock:
+            if key in self._plans:
+                self._plans.move_to_end(key)
+                return self._plans[key]
+        if statement.many or key[:6].upper() not in ('SELECT', 'WITH ', 'INSERT', 'UPDATE', 'DELETE'):
+            plan = None
+        else:
+            try:
+                # Through the base class, so the EXPLAIN itself is not recorded.
+                rows = sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + statement.sql, statement.params)
+                plan = [row[3] for row in rows]
+            except sqlite3.Error:
+                plan = None
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.max_entries:
+                self._plans.popitem(last=False)
+        return plan
+
+
+def _log(level, event, **fields):
+    logger.log(level, json.dumps({'event': event, 'method': request.method, 'path': request.path,
+                                  'endpoint': request.endpoint, **fields}, default=str))
+
+
+def start_request():
+    g.query_log = QueryLog()
+
+
+def finish_request(response):
+    log = g.get('query_log')
+    if log is None:
+        return response
+    config = current_app.config
+    total_ms = (time.perf_counter() - log.started) * 1000
+    sql_ms = log.elapsed * 1000
+    if config['SERVER_TIMING']:
+        response.headers.add('Server-Timing', f'db;dur={sql_ms:.2f};desc="{log.count} queries, {log.rows} rows"')
+        response.headers.add('Server-Timing', f'app;dur={total_ms:.2f}')
+
+    conn = g.get('db')
+    slow_ms = config['SLOW_QUERY_MS']
+    for statement in log.statements:
+        if statement.elapsed * 1000 >= slow_ms:
+            plan = current_app.extensions['query_plans'].explain(conn, statement) if conn is not None else None
+            _log(logging.WARNING, 'slow_query', ms=round(statement.elapsed * 1000, 2), rows=statement.rows,
+                 sql=normalize(statement.sql), plan=plan)
+    for sql, runs in log.repeated().items():
+        if len(runs) >= config['N_PLUS_ONE_THRESHOLD']:
+            _log(logging.WARNING, 'n_plus_one', count=len(runs), ms=round(sum(s.elapsed for s in runs) * 1000, 2),
+                 sql=sql)
+    if logger.isEnabledFor(logging.DEBUG):
+        _log(logging.DEBUG, 'request_sql', queries=log.count, rows=log.rows, sql_ms=round(sql_ms, 2),
+             total_ms=round(total_ms, 2))
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('SERVER_TIMING', True)
+    app.config.setdefault('SLOW_QUERY_MS', SLOW_QUERY_MS)
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', N_PLUS_ONE_THRESHOLD)
+    app.extensions['query_plans'] = PlanCache()
+    app.before_request(start_request)
+    app.after_request(finish_request)
@@ -0,0 +1,150 @@
+"""Token-bucket rate limits for the login and registration forms.
+
+Each key (``auth_ip:<address>``, ``login_email:<address>``) has a bucket
+holding up to ``capacity`` tokens that refills evenly over ``period`` seconds;
+every attempt takes one token and an attempt finding the bucket empty is
+refused with the number of seconds until the next token. Rules are written
+as ``"<capacity>/<period>"``, e.g. ``"5/300"`` allows a burst of five and then
+one more every minute. ``refund()`` gives a token back, so the login route
+only counts failed passwords against an address.
+
+Buckets live in process memory by default. With several worker processes
+each would allow the full rate, so ``RATE_LIMIT_STORE=sqlite`` keeps them in
+the ``rate_limits`` table instead, shared by every worker using the database.
+"""
+import threading
+import time
+
+from flask import current_app
+
+import metrics
+
+AUTH_IP_RULE = '30/60'
+LOGIN_EMAIL_RULE = '5/300'
+MAX_KEYS = 100_000
+# The SQLite store deletes idle buckets once every this many attempts.
+PRUNE_EVERY = 1000
+
+
+class Rule:
+    __slots__ = ('capacity', 'period', 'rate')
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period  # tokens per second
+
+    @classmethod
+    def parse(cls, text):
+        capacity, period = text.split('/')
+        return cls(int(capacity), float(period))
+
+
+class MemoryStore:
+
+    def __init__(self, max_idle, max_keys=MAX_KEYS):
+        self.max_idle = max_idle  # seconds after which any bucket is full again
+        self.max_keys = max_keys
+        self._buckets = {}  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, conn, key, rule, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (rule.capacity, now))
+            tokens = min(rule.capacity, tokens + (now - updated) * rule.rate)
+            if tokens < 1:
+                return (1 - tokens) / rule.rate
+            if key not in self._buckets and len(self._buckets) >= self.max_keys:
+                self._prune(now)
+            self._buckets[key] = (tokens - 1, now)
+            return 0
+
+    def refund(self, conn, key, rule, now):
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated = self._buckets[key]
+                self._buckets[key] = (min(rule.capacity, tokens + (now - updated) * rule.rate + 1), now)
+
+    def _prune(self, now):
+        # A full bucket behaves the same as an absent one.
+        cutoff = now - self.max_idle
+        self._buckets = {k: v for k, v in self._buckets.items() if v[1] > cutoff}
+        while len(self._buckets) >= self.max_keys:
+            self._buckets.pop(next(iter(self._buckets)))
+
+
+class SQLiteStore:
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self._attempts = 0
+
+    def take(self, conn, key, rule, now):
+        # One statement, so concurrent workers cannot both spend the last token.
+        cursor = conn.execute('''
+            INSERT INTO rate_limits (key, tokens, updated_at) VALUES (:key, :capacity - 1, :now)
+            ON CONFLICT (key) DO UPDATE SET
+                tokens = MIN(:capacity, tokens + (:now - updated_at) * :rate) - 1,
+                updated_at = :now
+            WHERE MIN(:capacity, tokens + (:now - updated_at) * :rate) >= 1
+        ''', {'key': key, 'capacity': rule.capacity, 'now': now, 'rate': rule.rate})
+        allowed = cursor.rowcount > 0
+        self._attempts += 1
+        if self._attempts % PRUNE_EVERY == 0:
+            conn.execute('DELETE FROM rate_limits WHERE updated_at < ?',
+                         (now - self.max_idle,))
+        conn.commit()
+        if allowed:
+            return 0
+        tokens, updated = conn.execute('SELECT tokens, updated_at FROM rate_limits WHERE key = ?',
+                                       (key,)).fetchone()
+        return (1 - min(rule.capacity, tokens + (now - updated) * rule.rate)) / rule.rate
+
+    def refund(self, conn, key, rule, now):
+        conn.execute('''
+            UPDATE rate_limits SET tokens = MIN(:capacity, tokens + (:now - updated_at) * :rate + 1), updated_at = :now
+            WHERE key = :key
+        ''', {'key': key, 'capacity': rule.capacity, 'now': now, 'rate': rule.rate})
+        conn.commit()
+
+
+class RateLimiter:
+
+    def __init__(self, store, rules):
+        self.store = store
+        self.rules = rules
+
+    def hit(self, conn, rule_name, key):
+        """Spend one token from ``key``'s bucket; returns 0, or seconds to wait if it was empty."""
+        rule = self.rules[rule_name]
+        retry_after = self.store.take(conn, f'{rule_name}:{key}', rule, time.time())
+        if retry_after:
+            metrics.inc('agrilink_rate_limited_total', rule=rule_name)
+        return retry_after
+
+    def refund(self, conn, rule_name, key):
+        """Give back the token a successful attempt took from ``key``'s bucket."""
+        self.store.refund(conn, f'{rule_name}:{key}', self.rules[rule_name], time.time())
+
+
+def hit(conn, rule_name, key):
+    return current_app.extensions['rate_limiter'].hit(conn, rule_name, key)
+
+
+def refund(conn, rule_name, key):
+    return current_app.extensions['rate_limiter'].refund(conn, rule_name, key)
+
+
+def init_app(app):
+    app.config.setdefault('RATE_LIMIT_STORE', 'memory')
+    app.config.setdefault('RATE_LIMIT_AUTH_IP', AUTH_IP_RULE)
+    app.config.setdefault('RATE_LIMIT_LOGIN_EMAIL', LOGIN_EMAIL_RULE)
+    rules = {
+        'auth_ip': Rule.parse(app.config['RATE_LIMIT_AUTH_IP']),
+        'login_email': Rule.parse(app.config['RATE_LIMIT_LOGIN_EMAIL']),
+    }
+    max_idle = max(rule.period for rule in rules.values())
+    store = SQLiteStore(max_idle) if app.config['RATE_LIMIT_STORE'] == 'sqlite' else MemoryStore(max_idle)
+    limiter = RateLimiter(store, rules)
+    app.extensions['rate_limiter'] = limiter
+    return limiter
@@ -0,0 +1,93 @@
+"""Full-text search over crop listings and buyer demands.
+
+``crops_fts`` and ``demands_fts`` are FTS5 tables keyed by the source row id
+and kept in sync by the triggers installed in migration 3. Queries are turned
+into prefix matches ("mai" finds "Maize"); when nothing matches, each word is
+swapped for the closest terms in the index vocabulary so small typos
+("maze", "tobaco") still find listings.
+"""
+import re
+
+# bm25 column weights, in table column order.
+CROPS_WEIGHTS = (10.0, 2.0, 2.0, 3.0, 1.0)    # crop_name, quality, crop_grade, location, farmer_name
+DEMANDS_WEIGHTS = (10.0, 2.0, 1.0, 3.0)        # crop_name, quality, message, location
+
+MAX_TERMS = 8
+MAX_FUZZY_CANDIDATES = 5
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall((text or '').lower())[:MAX_TERMS]
+
+
+def _prefix_query(tokens):
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def _edit_distance(a, b, limit):
+    """Levenshtein distance, giving up early once it exceeds ``limit``."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def _similar_terms(conn, vocab_table, token):
+    """Vocabulary terms within one (short words) or two edits of ``token``.
+
+    Only terms sharing the first letter are considered, which keeps the scan
+    on the vocabulary's sorted term index small.
+    """
+    limit = 1 if len(token) <= 4 else 2
+    rows = conn.execute(
+        f"SELECT term, doc FROM {vocab_table} WHERE term >= ? AND term < ?",
+        (token[0], token[0] + '\U0010ffff')).fetchall()
+    scored = []
+    for term, doc in rows:
+        distance = _edit_distance(token, term, limit)
+        if distance <= limit:
+            scored.append((distance, -doc, term))
+    scored.sort()
+    return [term for _, _, term in scored[:MAX_FUZZY_CANDIDATES]]
+
+
+def match_expression(conn, fts_table, text):
+    """Return an FTS5 MATCH expression for ``text``, or None if it has no words."""
+    tokens = tokenize(text)
+    if not tokens:
+        return None
+    expression = _prefix_query(tokens)
+    if conn.execute(f"SELECT 1 FROM {fts_table} WHERE {fts_table} MATCH ? LIMIT 1",
+                    (expression,)).fetchone():
+        return expression
+
+    # Typo-tolerant fallback: OR together the nearest indexed spellings.
+    groups = []
+    for token in tokens:
+        candidates = _similar_terms(conn, f'{fts_table}_vocab', token)
+        alternatives = [f'"{token}"*'] + [f'"{term}"' for term in candidates]
+        groups.append('(' + ' OR '.join(alternatives) + ')')
+    return ' AND '.join(groups)
+
+
+def crops_match(conn, text):
+    return match_expression(conn, 'crops_fts', text)
+
+
+def demands_match(conn, text):
+    return match_expression(conn, 'demands_fts', text)
+
+
+def rank_expression(fts_table, weights):
+    """Weighted bm25 relevance, negated so that higher means a better match."""
+    return f"-bm25({fts_table}, {', '.join(str(w) for w in weights)})"
@@ -0,0 +1,265 @@
+"""Server-side sessions.
+
+Flask's default session is a signed cookie carrying the whole session dict,
+so every request uploads and verifies it and a value copied into it (role,
+name, profile picture) stays whatever it was at login. ``SQLiteSessionInterface``
+keeps the dict in the ``sessions`` table instead and the cookie holds only a
+random session id; the table is keyed on the id's SHA-256, so a copy of the
+database does not hand out live sessions.
+
+Sessions read recently are served from a per-process LRU, trusted for
+``SESSION_CACHE_TTL`` seconds before being read again; that is also how
+long another worker may keep honouring a session revoked elsewhere. An
+unchanged session is written back at most once per ``SESSION_REFRESH_INTERVAL``
+to push its expiry forward, and a sweeper thread deletes expired rows.
+
+``revoke_user()`` ends every session of a user (deleted account, password
+reset); ``update_user()`` rewrites values kept in all of a user's sessions.
+``SESSION_BACKEND=cookie`` keeps Flask's cookie sessions.
+"""
+import hashlib
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+
+from db import connect
+
+SESSION_CACHE_SIZE = 4096
+SESSION_CACHE_TTL = 5  # seconds
+SESSION_REFRESH_INTERVAL = 24 * 3600  # seconds
+ANONYMOUS_SESSION_LIFETIME = 3600  # seconds; a visitor's flash messages need no more
+SWEEP_INTERVAL = 300  # seconds
+SWEEP_BATCH = 1000
+# Flask-Login writes these into otherwise empty sessions; alone they are not worth storing.
+_BOOKKEEPING_KEYS = frozenset(('_fresh', '_id'))
+
+
+def _key(sid):
+    return hashlib.sha256(sid.encode()).hexdigest()
+
+
+class ServerSession(SecureCookieSession):
+    """A session dict with the id it is stored under (None until first saved)."""
+
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.new = sid is None
+        self.previous_sid = None
+
+    def regenerate(self):
+        """Move the session to a fresh id, so an id known before login is worthless after it."""
+        if self.sid is not None and self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+
+class SQLiteSessionInterface(SessionInterface):
+    # The same tagged JSON as Flask's cookie, unsigned: the data never leaves the server.
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, cache_size=SESSION_CACHE_SIZE, cache_ttl=SESSION_CACHE_TTL,
+                 refresh_interval=SESSION_REFRESH_INTERVAL):
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.refresh_interval = refresh_interval
+        self._cache = OrderedDict()  # key -> (data, expires_at, user_id, cached_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Session I/O borrows its own pooled connection, so committing a session
+    # never commits (or is rolled back with) the route's open transaction.
+    def _execute(self, app, sql, params=(), commit=False):
+        pool = app.extensions['db_pool']
+        conn = pool.acquire()
+        try:
+            rows = conn.execute(sql, params).fetchall()
+            if commit:
+                conn.commit()
+            return rows
+        finally:
+            pool.release(conn)
+
+    def _cached(self, key, now):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None or now - entry[3] > self.cache_ttl:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def _remember(self, key, data, expires_at, user_id, now):
+        with self._lock:
+            self._cache[key] = (data, expires_at, user_id, now)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _forget(self, keys=(), user_id=None):
+        with self._lock:
+            for key in keys:
+                self._cache.pop(key, None)
+            if user_id is not None:
+                for key in [k for k, entry in self._cache.items() if entry[2] == user_id]:
+                    del self._cache[key]
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return ServerSession()
+        key, now = _key(sid), time.time()
+        entry = self._cached(key, now)
+        if entry is None:
+            rows = self._execute(app, 'SELECT data, expires_at, user_id FROM sessions WHERE id = ?', (key,))
+            if not rows:
+                return ServerSession()
+            entry = (rows[0]['data'], rows[0]['expires_at'], rows[0]['user_id'], now)
+            self._remember(key, *entry)
+        if entry[1] <= now:
+            return ServerSession()
+        return ServerSession(self.serializer.loads(entry[0]), sid, entry[1])
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        stale = [_key(sid) for sid in (session.previous_sid,) if sid]
+
+        if not session.keys() - _BOOKKEEPING_KEYS:
+            if session.modified:
+                if session.sid:
+                    stale.append(_key(session.sid))
+                response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app), httponly=self.get_cookie_httponly(app))
+            if stale:
+                self._forget(stale)
+                self._execute(app, f"DELETE FROM sessions WHERE id IN ({', '.join('?' * len(stale))})", stale,
+                              commit=True)
+            return
+
+        now = time.time()
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        refresh = (session.expires_at is not None and session.get('_user_id') is not None
+                   and session.expires_at - now < lifetime - self.refresh_interval)
+        if not (session.modified or refresh or session.sid is None):
+            return
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        key = _key(session.sid)
+        data = self.serializer.dumps(dict(session))
+        user_id = session.get('_user_id')
+        user_id = int(user_id) if user_id is not None else None
+        expires_at = now + (lifetime if user_id is not None else min(lifetime, ANONYMOUS_SESSION_LIFETIME))
+        pool = app.extensions['db_pool']
+        conn = pool.acquire()
+        try:
+            conn.execute('''
+                INSERT INTO sessions (id, user_id, data, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    user_id = excluded.user_id, data = excluded.data, expires_at = excluded.expires_at
+            ''', (key, user_id, data, expires_at))
+            if stale:
+                conn.execute(f"DELETE FROM sessions WHERE id IN ({', '.join('?' * len(stale))})", stale)
+            conn.commit()
+        finally:
+            pool.release(conn)
+        self._forget(stale)
+        self._remember(key, data, expires_at, user_id, now)
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+    def revoke_user(self, conn, user_id, keep=None):
+        """Delete every session of ``user_id`` except ``keep`` (a session id)."""
+        if keep:
+            conn.execute('DELETE FROM sessions WHERE user_id = ? AND id != ?', (user_id, _key(keep)))
+        else:
+            conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+        self._forget(user_id=user_id)
+
+    def update_user(self, conn, user_id, **values):
+        """Set ``values`` in every stored session of ``user_id``."""
+        rows = conn.execute('SELECT id, data FROM sessions WHERE user_id = ?', (user_id,)).fetchall()
+        conn.executemany('UPDATE sessions SET data = ? WHERE id = ?',
+                         [(self.serializer.dumps({**self.serializer.loads(row['data']), **values}), row['id'])
+                          for row in rows])
+        self._forget(user_id=user_id)
+
+
+def delete_expired(conn, batch=SWEEP_BATCH):
+    """Delete expired sessions a batch per transaction. Returns the count."""
+    deleted = 0
+    while True:
+        cursor = conn.execute('DELETE FROM sessions WHERE id IN '
+                              '(SELECT id FROM sessions WHERE expires_at <= ? LIMIT ?)', (time.time(), batch))
+        conn.commit()
+        deleted += cursor.rowcount
+        if cursor.rowcount < batch:
+            return deleted
+
+
+def start_sweeper(app):
+    """Run delete_expired() every SESSION_SWEEP_INTERVAL seconds in a daemon thread."""
+    database = app.config['DATABASE']
+    interval = app.config.get('SESSION_SWEEP_INTERVAL', SWEEP_INTERVAL)
+
+    def sweep_forever():
+        while True:
+            time.sleep(interval)
+            try:
+                conn = connect(database)
+                try:
+                    count = delete_expired(conn)
+                finally:
+                    conn.close()
+                if count:
+                    app.logger.info('Deleted %d expired sessions', count)
+            except sqlite3.Error:
+                app.logger.exception('Session sweep failed')
+
+    thread = threading.Thread(target=sweep_forever, name='session-sweeper', daemon=True)
+    thread.start()
+    return thread
+
+
+def regenerate():
+    """Give the current session a new id (call on login). No-op with cookie sessions."""
+    if isinstance(session._get_current_object(), ServerSession):
+        session.regenerate()
+
+
+def revoke_user(conn, user_id, keep_current=False):
+    store = current_app.extensions.get('sessions')
+    if store is not None:
+        store.revoke_user(conn, user_id, keep=session.sid if keep_current else None)
+
+
+def update_user(conn, user_id, **values):
+    store = current_app.extensions.get('sessions')
+    if store is not None:
+        store.update_user(conn, user_id, **values)
+
+
+def init_app(app):
+    app.config.setdefault('SESSION_BACKEND', 'sqlite')
+    app.config.setdefault('SESSION_SWEEP_INTERVAL', SWEEP_INTERVAL)
+    if app.config['SESSION_BACKEND'] != 'sqlite':
+        return None
+    interface = SQLiteSessionInterface()
+    app.session_interface = interface
+    app.extensions['sessions'] = interface
+    start_sweeper(app)
+    return interface
@@ -0,0 +1,99 @@
+"""A tiny local SMTP server that accepts and records every message.
+
+Stands in for Gmail while developing or load testing the mail outbox, so no
+real email leaves the machine. Point the app at it with
+
+    MAIL_SERVER=127.0.0.1 MAIL_PORT=1025 MAIL_USE_TLS=0 python app.py
+
+Usage: python smtp_stub.py [port]
+"""
+import socketserver
+import sys
+import threading
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def _reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        self._reply('220 agrilink-smtp-stub ESMTP ready')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                self._reply('250-agrilink-smtp-stub')
+                self._reply('250 AUTH PLAIN')
+            elif verb == 'HELO':
+                self._reply('250 agrilink-smtp-stub')
+            elif verb == 'AUTH':
+                # Any credentials are accepted.
+                self._reply('235 Authentication successful')
+            elif verb == 'MAIL':
+                sender, recipients = command[10:].strip(' <>'), []
+                self._reply('250 OK')
+            elif verb == 'RCPT':
+                address = command[8:].strip(' <>')
+                if server.reject_recipient and server.reject_recipient in address:
+                    self._reply('550 No such user')
+                    continue
+                recipients.append(address)
+                self._reply('250 OK')
+            elif verb == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    chunk = self.rfile.readline()
+                    if not chunk or chunk in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(chunk[1:] if chunk.startswith(b'..') else chunk)
+                with server.lock:
+                    server.messages.append((sender, recipients, b''.join(data)))
+                    server.connections_used.add(id(self))
+                self._reply('250 OK: queued')
+            elif verb in ('RSET', 'NOOP'):
+                self._reply('250 OK')
+            elif verb == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Command not implemented')
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """Records ``(sender, recipients, raw_message)`` tuples in ``messages``."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, reject_recipient=None):
+        super().__init__((host, port), _SMTPHandler)
+        self.messages = []
+        self.connections_used = set()
+        self.reject_recipient = reject_recipient
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='smtp-stub', daemon=True)
+        thread.start()
+        return self
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 1025
+    server = LocalSMTPServer(port=port)
+    print(f"SMTP stub listening on 127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\nReceived {len(server.messages)} messages.")
@@ -0,0 +1,128 @@
+"""Precomputed counters for the admin pages.
+
+Triggers installed by migration 8 keep ``stats_counters`` (running totals such
+as ``users:farmer``, ``crops`` or ``orders:paid``) and ``stats_daily`` (rows
+created per day) in step with every insert, update and delete, so the admin
+dashboard reads a handful of rows instead of counting whole tables. A short
+per-process cache sits in front of that.
+
+Usage: python stats.py [path/to/agrilink.db]   (recompute every counter)
+"""
+import sqlite3
+import sys
+import threading
+import time
+from datetime import date, timedelta
+
+STATS_CACHE_TTL = 30  # seconds
+TREND_DAYS = 14
+
+# Kinds of rows counted per day in stats_daily.
+DAILY_KINDS = ('users', 'crops', 'demands', 'orders', 'messages')
+
+# Queries that recompute the totals in rebuild(), each yielding (name, value) rows.
+_TOTALS = [
+    "SELECT 'users', COUNT(*) FROM users",
+    "SELECT 'users:' || COALESCE(role, 'unknown'), COUNT(*) FROM users GROUP BY 1",
+    "SELECT 'crops', COUNT(*) FROM crops",
+    "SELECT 'demands', COUNT(*) FROM demands",
+    "SELECT 'messages', COUNT(*) FROM messages",
+    "SELECT 'orders', COUNT(*) FROM orders",
+    "SELECT 'orders:' || LOWER(COALESCE(order_status, 'unknown')), COUNT(*) FROM orders GROUP BY 1",
+    "SELECT 'active_farmers', COUNT(DISTINCT farmer_id) FROM crops",
+    "SELECT 'active_buyers', COUNT(DISTINCT buyer_id) FROM demands",
+]
+
+# Source table and timestamp column for each daily kind.
+_DAILY_SOURCES = {
+    'users': ('users', 'created_at'),
+    'crops': ('crops', 'created_at'),
+    'demands': ('demands', 'created_at'),
+    'orders': ('orders', 'order_date'),
+    'messages': ('messages', 'sent_at'),
+}
+
+
+def rebuild(conn):
+    """Recompute every counter from the base tables.
+
+    Used as the migration backfill and to repair counters after bulk edits
+    made with triggers disabled. Runs inside the caller's transaction.
+    """
+    conn.execute('DELETE FROM stats_counters')
+    conn.execute('DELETE FROM stats_daily')
+    for query in _TOTALS:
+        conn.execute(f'INSERT INTO stats_counters (name, value) {query}')
+    for kind, (table, column) in _DAILY_SOURCES.items():
+        conn.execute(f"""
+            INSERT INTO stats_daily (day, name, value)
+            SELECT date({column}), ?, COUNT(*) FROM {table}
+            WHERE {column} IS NOT NULL
+            GROUP BY date({column})
+        """, (kind,))
+
+
+def read_counters(conn):
+    """Return every counter as a dict, e.g. ``{'users:farmer': 12, 'orders:paid': 3}``."""
+    return {name: value for name, value in conn.execute('SELECT name, value FROM stats_counters')}
+
+
+def read_trends(conn, days=TREND_DAYS):
+    """Rows created per day for the last ``days`` days, oldest first.
+
+    Days with no activity are included with zeros so charts line up.
+    """
+    start = date.today() - timedelta(days=days - 1)
+    rows = conn.execute('SELECT day, name, value FROM stats_daily WHERE day >= ?', (start.isoformat(),))
+    by_day = {}
+    for day, name, value in rows:
+        by_day.setdefault(day, {})[name] = value
+    trends = []
+    for offset in range(days):
+        day = (start + timedelta(days=offset)).isoformat()
+        counts = by_day.get(day, {})
+        trends.append(dict({kind: counts.get(kind, 0) for kind in DAILY_KINDS}, day=day))
+    return trends
+
+
+class StatsCache:
+    """Per-process cache of the admin counters and trends."""
+
+    def __init__(self, ttl=STATS_CACHE_TTL):
+        self.ttl = ttl
+        self._entry = None
+        self._lock = threading.Lock()
+
+    def snapshot(self, conn):
+        """Return ``(counters, trends)``, at most ``ttl`` seconds old."""
+        now = time.monotonic()
+        with self._lock:
+            if self._entry and self._entry[1] > now:
+                return self._entry[0]
+        value = (read_counters(conn), read_trends(conn))
+        with self._lock:
+            self._entry = (value, now + self.ttl)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entry = None
+
+
+stats_cache = StatsCache()
+
+
+def snapshot(conn):
+    return stats_cache.snapshot(conn)
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else 'agrilink.db'
+    conn = sqlite3.connect(database)
+    conn.execute('BEGIN IMMEDIATE')
+    rebuild(conn)
+    conn.commit()
+    counters = read_counters(conn)
+    conn.close()
+    for name in sorted(counters):
+        print(f"{name}: {counters[name]}")
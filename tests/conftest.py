@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import connect  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Path of an empty database migrated to the latest schema."""
+    path = str(tmp_path / 'agrilink.db')
+    conn = connect(path)
+    migrate(conn)
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def conn(database):
+    conn = connect(database)
+    yield conn
+    conn.close()
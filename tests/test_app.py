@@ -0,0 +1,16 @@
+"""Importing app.py the way a spawned process-pool worker does."""
+import os
+import runpy
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_spawned_worker_import_starts_nothing(tmp_path, monkeypatch):
+    database = tmp_path / 'agrilink.db'
+    monkeypatch.setenv('AGRILINK_DATABASE', str(database))
+    before = {thread.name for thread in threading.enumerate()}
+    # multiprocessing's spawn runs the parent's main module under this name.
+    runpy.run_path(os.path.join(ROOT, 'app.py'), run_name='__mp_main__')
+    assert {thread.name for thread in threading.enumerate()} == before
+    assert not database.exists()
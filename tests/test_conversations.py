@@ -0,0 +1,24 @@
+"""Sending messages: never to an account that has been deleted."""
+import pytest
+
+import conversations
+
+
+@pytest.fixture
+def users(conn):
+    conn.execute("INSERT INTO users (name, email, password, role) VALUES ('Farmer', 'f@example.com', 'x', 'farmer')")
+    conn.execute("INSERT INTO users (name, email, password, role) VALUES ('Buyer', 'b@example.com', 'x', 'buyer')")
+    conn.commit()
+    return 1, 2
+
+
+def test_send_to_deleted_user_is_refused(conn, users):
+    farmer, buyer = users
+    conversations.send(conn, buyer, farmer, 'Is the maize still available?', subject='Maize')
+    conn.execute('UPDATE users SET deleted_at = CURRENT_TIMESTAMP WHERE id = ?', (farmer,))
+    conn.commit()
+
+    with pytest.raises(conversations.MessagingError):
+        conversations.send(conn, buyer, farmer, 'Hello?', subject='Maize')
+    assert conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 1
+    assert not conn.in_transaction
@@ -0,0 +1,117 @@
+"""Stock reservations: many concurrent buyers never oversell a listing."""
+import threading
+
+import pytest
+
+import inventory
+from db import connect
+
+START_STOCK = 500.0
+BUYERS = 16
+ATTEMPTS = 40
+
+
+@pytest.fixture
+def listing(conn):
+    conn.execute("INSERT INTO users (name, email, password, role) VALUES ('Farmer', 'f@example.com', 'x', 'farmer')")
+    conn.execute("INSERT INTO users (name, email, password, role) VALUES ('Buyer', 'b@example.com', 'x', 'buyer')")
+    conn.execute("INSERT INTO crops (farmer_id, crop_name, quantity, quantity_value, quantity_unit, price) "
+                 "VALUES (1, 'Maize', '500 kg', ?, 'kg', 150)", (START_STOCK,))
+    conn.commit()
+    return 1
+
+
+def stock(conn, crop_id):
+    return conn.execute('SELECT quantity_value FROM crops WHERE id = ?', (crop_id,)).fetchone()[0]
+
+
+def held(conn, crop_id):
+    return conn.execute("SELECT COALESCE(SUM(quantity), 0) FROM orders WHERE crop_id = ? "
+                        "AND order_status NOT IN ('expired', 'cancelled')", (crop_id,)).fetchone()[0]
+
+
+def test_concurrent_buyers_never_oversell(database, conn, listing):
+    lowest = [START_STOCK]
+    reserved = []
+    done = threading.Event()
+
+    def buyer(seed):
+        buyer_conn = connect(database)
+        try:
+            for attempt in range(ATTEMPTS):
+                quantity = (1, 2.5, 5, 10)[(seed + attempt) % 4]
+                try:
+                    inventory.reserve(buyer_conn, listing, 2, quantity, 'pickup', ttl=-1 if attempt % 3 else 3600)
+                    reserved.append(quantity)
+                except inventory.InsufficientStock:
+                    pass
+        finally:
+            buyer_conn.close()
+
+    def watch():
+        watch_conn = connect(database)
+        while not done.is_set():
+            lowest[0] = min(lowest[0], stock(watch_conn, listing))
+            watch_conn.rollback()
+        watch_conn.close()
+
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    threads = [threading.Thread(target=buyer, args=(seed,)) for seed in range(BUYERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    watcher.join()
+
+    assert lowest[0] >= 0
+    assert stock(conn, listing) >= 0
+    # Far more was asked for than listed; what was granted never exceeds the stock.
+    assert sum(reserved) <= START_STOCK
+    assert stock(conn, listing) + held(conn, listing) == pytest.approx(START_STOCK)
+
+    # Two of every three reservations were made already expired; sweeping returns their stock.
+    assert inventory.release_expired(conn) > 0
+    assert stock(conn, listing) + held(conn, listing) == pytest.approx(START_STOCK)
+
+
+def test_release_returns_stock_once(conn, listing):
+    order_id, _ = inventory.reserve(conn, listing, 2, 100, 'pickup')
+    assert stock(conn, listing) == START_STOCK - 100
+    assert inventory.release(conn, order_id, 'cancelled')
+    assert not inventory.release(conn, order_id, 'cancelled')
+    assert stock(conn, listing) == START_STOCK
+
+
+def test_reserve_refuses_more_than_is_left(conn, listing):
+    with pytest.raises(inventory.InsufficientStock):
+        inventory.reserve(conn, listing, 2, START_STOCK + 1, 'pickup')
+    assert stock(conn, listing) == START_STOCK
+
+
+def test_edit_applies_only_the_farmers_change(conn, listing):
+    # The farmer opens the form at 500 kg; a buyer reserves 120 kg before they save 600 kg.
+    inventory.reserve(conn, listing, 2, 120, 'pickup')
+    inventory.edit_stock(conn, listing, START_STOCK, '600 kg')
+    conn.commit()
+    assert stock(conn, listing) == START_STOCK - 120 + 100
+    assert conn.execute('SELECT quantity FROM crops WHERE id = ?', (listing,)).fetchone()[0] == '480 kg'
+
+
+def test_edit_without_quantity_change_keeps_reservations(conn, listing):
+    inventory.reserve(conn, listing, 2, 120, 'pickup')
+    inventory.edit_stock(conn, listing, START_STOCK, '500kg')
+    conn.commit()
+    assert stock(conn, listing) == START_STOCK - 120
+
+
+def test_edit_in_another_unit_refuses_stale_form(conn, listing):
+    inventory.reserve(conn, listing, 2, 120, 'pickup')
+    with pytest.raises(inventory.StockChanged):
+        inventory.edit_stock(conn, listing, START_STOCK, '40 bunches')
+    conn.rollback()
+    inventory.edit_stock(conn, listing, START_STOCK - 120, '40 bunches')
+    conn.commit()
+    assert tuple(conn.execute('SELECT quantity_value, quantity_unit FROM crops WHERE id = ?',
+                              (listing,)).fetchone()) == (40, 'bunch')
@@ -0,0 +1,41 @@
+"""Per-thread metric shards: exited threads are folded away without losing counts."""
+import threading
+
+from metrics import Registry
+
+THREADS = 1000
+
+
+def record(registry):
+    registry.inc('agrilink_http_requests_total', endpoint='main.homepage')
+    registry.observe('agrilink_http_request_duration_seconds', 0.02, endpoint='main.homepage')
+
+
+def run_threads(registry, count):
+    for _ in range(count):
+        thread = threading.Thread(target=record, args=(registry,))
+        thread.start()
+        thread.join()
+
+
+def test_short_lived_threads_do_not_accumulate_shards():
+    registry = Registry()
+    run_threads(registry, THREADS)
+    snapshot = registry.snapshot()
+
+    assert len(registry._shards) <= 1
+    key = ('agrilink_http_requests_total', (('endpoint', 'main.homepage'),))
+    assert snapshot['counters'][key] == THREADS
+    [histogram] = snapshot['histograms'].values()
+    assert sum(histogram[:-1]) == THREADS
+
+
+def test_totals_never_go_backwards_when_threads_exit():
+    registry = Registry()
+    key = ('agrilink_http_requests_total', (('endpoint', 'main.homepage'),))
+    record(registry)
+    seen = [registry.snapshot()['counters'][key]]
+    for _ in range(5):
+        run_threads(registry, 20)
+        seen.append(registry.snapshot()['counters'][key])
+    assert seen == [1, 21, 41, 61, 81, 101]
@@ -0,0 +1,234 @@
+"""Schema migrations: upgrading in place keeps every row, and the hot-path
+queries are served by the indexes version 2 added for them."""
+import sqlite3
+
+import pytest
+
+from db import connect
+from migrations import MIGRATIONS, migrate, schema_version
+from pagination import fetch_page
+
+FARMERS, BUYERS, CROPS_PER_FARMER = 20, 20, 10
+LOCATIONS = ['Lilongwe', 'Blantyre', 'Mzuzu', 'Zomba']
+CROP_NAMES = ['Maize', 'Groundnuts', 'Soya', 'Tobacco', 'Beans']
+BASELINE_TABLES = ['users', 'crops', 'demands', 'orders', 'messages', 'reviews']
+
+
+def seed_baseline(conn):
+    """Fill a version-1 database the way the original app would have."""
+    users = [(f'Farmer {i}', f'farmer{i}@example.com', 'x', 'farmer') for i in range(FARMERS)]
+    users += [(f'Buyer {i}', f'buyer{i}@example.com', 'x', 'buyer') for i in range(BUYERS)]
+    conn.executemany('INSERT INTO users (name, email, password, role) VALUES (?, ?, ?, ?)', users)
+    farmer_ids = range(1, FARMERS + 1)
+    buyer_ids = range(FARMERS + 1, FARMERS + BUYERS + 1)
+    conn.executemany(
+        'INSERT INTO crops (farmer_id, crop_name, quantity, price, location) VALUES (?, ?, ?, ?, ?)',
+        [(farmer, CROP_NAMES[n % len(CROP_NAMES)], f'{100 + n} kg', 50 + n, LOCATIONS[n % len(LOCATIONS)])
+         for farmer in farmer_ids for n in range(CROPS_PER_FARMER)])
+    conn.executemany(
+        'INSERT INTO demands (buyer_id, crop_name, quantity, location) VALUES (?, ?, ?, ?)',
+        [(buyer, CROP_NAMES[buyer % len(CROP_NAMES)], '2 tonnes', LOCATIONS[buyer % len(LOCATIONS)])
+         for buyer in buyer_ids])
+    crop_count = FARMERS * CROPS_PER_FARMER
+    conn.executemany(
+        "INSERT INTO orders (buyer_id, crop_id, quantity, total_price, delivery_option, order_status) "
+        "VALUES (?, ?, 5, 250, 'pickup', ?)",
+        [(buyer, (buyer * 7 + n) % crop_count + 1, 'paid' if n % 2 else 'pending')
+         for buyer in buyer_ids for n in range(3)])
+    conn.executemany(
+        'INSERT INTO messages (sender_id, receiver_id, crop_id, subject, message) VALUES (?, ?, ?, ?, ?)',
+        [(buyer, farmer, None, 'Maize', 'Is this still available?')
+         for buyer, farmer in zip(buyer_ids, farmer_ids)])
+    # The contact form: no sender account and no conversation.
+    conn.execute("INSERT INTO messages (sender_id, receiver_id, sender_name, sender_contact, subject, message) "
+                 "VALUES (NULL, 1, 'Visitor', 'visitor@example.com', 'Hello', 'How do I sign up?')")
+    conn.executemany(
+        'INSERT INTO reviews (order_id, reviewer_id, reviewed_user_id, rating, comment) '
+        'SELECT o.id, o.buyer_id, c.farmer_id, ?, ? FROM orders o JOIN crops c ON c.id = o.crop_id WHERE o.id = ?',
+        [(order_id % 5 + 1, 'Good', order_id) for order_id in range(1, 31)])
+    conn.commit()
+
+
+def counts(conn):
+    return {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in BASELINE_TABLES}
+
+
+@pytest.fixture
+def baseline(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'baseline.db'))
+    conn.row_factory = sqlite3.Row
+    migrate(conn, target=1)
+    seed_baseline(conn)
+    yield conn
+    conn.close()
+
+
+def test_upgrade_keeps_every_row(baseline):
+    before = counts(baseline)
+    assert migrate(baseline) == MIGRATIONS[-1][0]
+    assert counts(baseline) == before
+    assert baseline.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+    assert baseline.execute('PRAGMA foreign_key_check').fetchall() == []
+
+
+def test_upgrade_is_idempotent(baseline):
+    migrate(baseline)
+    version, before = schema_version(baseline), counts(baseline)
+    assert migrate(baseline) == version
+    assert counts(baseline) == before
+
+
+def test_contact_message_survives_without_any_conversation(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'contact.db'))
+    migrate(conn, target=1)
+    conn.execute("INSERT INTO users (name, email, password, role) VALUES ('Admin', 'admin@example.com', 'x', 'admin')")
+    conn.execute("INSERT INTO messages (receiver_id, sender_name, sender_contact, subject, message) "
+                 "VALUES (1, 'Visitor', 'visitor@example.com', 'Hello', 'How do I sign up?')")
+    conn.commit()
+    migrate(conn)
+    assert conn.execute('SELECT sender_name, conversation_id FROM messages').fetchall() == [('Visitor', None)]
+    conn.close()
+
+
+def test_orphans_are_archived_not_lost(baseline, caplog):
+    # The old admin_delete_user removed the user row and left the rest behind.
+    baseline.execute('DELETE FROM users WHERE id = 2')
+    baseline.commit()
+    before = counts(baseline)
+    orphaned_orders = baseline.execute('SELECT o.id, o.buyer_id, o.total_price FROM orders o '
+                                       'WHERE o.crop_id IN (SELECT id FROM crops WHERE farmer_id = 2) '
+                                       'ORDER BY o.id').fetchall()
+    assert orphaned_orders
+
+    with caplog.at_level('WARNING', logger='agrilink.migrations'):
+        migrate(baseline)
+
+    archived = dict(baseline.execute('SELECT table_name, COUNT(*) FROM orphaned_rows GROUP BY table_name').fetchall())
+    after = counts(baseline)
+    for table in BASELINE_TABLES:
+        assert after[table] + archived.get(table, 0) == before[table], table
+    assert archived['crops'] == CROPS_PER_FARMER
+    assert f"Moved {archived['orders']} orphaned orders rows" in caplog.text
+    # A buyer's order history is kept, column for column.
+    assert [tuple(row) for row in orphaned_orders] == [tuple(row) for row in baseline.execute("""
+        SELECT json_extract(data, '$.id'), json_extract(data, '$.buyer_id'), json_extract(data, '$.total_price')
+        FROM orphaned_rows WHERE table_name = 'orders' ORDER BY json_extract(data, '$.id')
+    """)]
+    # The contact-form message is not an orphan.
+    assert baseline.execute("SELECT COUNT(*) FROM messages WHERE sender_name = 'Visitor'").fetchone()[0] == 1
+    assert baseline.execute('PRAGMA foreign_key_check').fetchall() == []
+
+
+def test_duplicate_reviews_are_archived(baseline, caplog):
+    baseline.execute("INSERT INTO reviews (order_id, reviewer_id, reviewed_user_id, rating, comment) "
+                     "SELECT order_id, reviewer_id, reviewed_user_id, 1, 'Submitted twice' FROM reviews WHERE id = 1")
+    baseline.commit()
+    first = tuple(baseline.execute('SELECT id, order_id, rating, comment FROM reviews WHERE id = 1').fetchone())
+    before = counts(baseline)
+
+    with caplog.at_level('WARNING', logger='agrilink.migrations'):
+        migrate(baseline)
+
+    assert counts(baseline)['reviews'] == before['reviews'] - 1
+    assert [first] == [tuple(row) for row in baseline.execute("""
+        SELECT json_extract(data, '$.id'), json_extract(data, '$.order_id'), json_extract(data, '$.rating'),
+               json_extract(data, '$.comment')
+        FROM orphaned_rows WHERE table_name = 'reviews'
+    """)]
+    assert 'Moved 1 duplicate reviews rows to orphaned_rows' in caplog.text
+
+
+def test_upgrade_backfills_derived_columns(baseline):
+    migrate(baseline)
+    assert baseline.execute('SELECT COUNT(*) FROM crops WHERE quantity_value IS NULL').fetchone()[0] == 0
+    assert baseline.execute('SELECT COUNT(*) FROM messages WHERE sender_id IS NOT NULL '
+                            'AND conversation_id IS NULL').fetchone()[0] == 0
+    rated = baseline.execute('SELECT SUM(rating_count), SUM(rating_sum) FROM users').fetchone()
+    assert tuple(rated) == tuple(baseline.execute('SELECT COUNT(*), SUM(rating) FROM reviews').fetchone())
+
+
+class PlanRecorder:
+    """Stands in for a connection and keeps the query plan of every statement run."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.plans = []
+
+    def execute(self, sql, params=()):
+        rows = self.conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+        self.plans.append([row['detail'] for row in rows])
+        return self.conn.execute(sql, params)
+
+
+@pytest.fixture
+def seeded(baseline):
+    migrate(baseline)
+    baseline.execute('ANALYZE')
+    return baseline
+
+
+def page_plan(conn, query, conditions, params, keys, descending=True):
+    recorder = PlanRecorder(conn)
+    fetch_page(recorder, query, conditions, params, keys, {}, 10, descending)
+    return recorder.plans[0]
+
+
+# (route, query, conditions, params, sort keys, index the plan must use), mirroring the routes.
+HOT_PATH_QUERIES = [
+    ('farmer.view_my_listings',
+     'SELECT c.*, u.name as farmer_name, u.profile_pic FROM crops c JOIN users u ON c.farmer_id = u.id',
+     ['c.farmer_id = ?'], [1], [('c.id', 'id')], 'idx_crops_farmer'),
+    ('buyer.dashboard category',
+     'SELECT c.*, u.name as farmer_name, u.profile_pic FROM crops c JOIN users u ON c.farmer_id = u.id',
+     ['c.farmer_id != ?', 'c.crop_name = ?'], [FARMERS + 1, 'Maize'], [('c.id', 'id')], 'idx_crops_name'),
+    ('buyer.dashboard location',
+     'SELECT c.*, u.name as farmer_name, u.profile_pic FROM crops c JOIN users u ON c.farmer_id = u.id',
+     ['c.farmer_id != ?', 'c.location = ?'], [FARMERS + 1, 'Zomba'], [('c.id', 'id')], 'idx_crops_location'),
+    ('farmer.dashboard location',
+     'SELECT d.*, u.name as buyer_name FROM demands d JOIN users u ON d.buyer_id = u.id',
+     ['d.location = ?'], ['Zomba'], [('d.id', 'id')], 'idx_demands_location'),
+    ('buyer.view_my_demands',
+     'SELECT d.*, u.name as buyer_name FROM demands d JOIN users u ON d.buyer_id = u.id',
+     ['d.buyer_id = ?'], [FARMERS + 1], [('d.id', 'id')], 'idx_demands_buyer'),
+    ('farmer.my_sales',
+     'SELECT o.id, o.quantity, o.total_price, o.order_status, o.order_date, c.crop_name, u.name as buyer_name '
+     'FROM orders o JOIN crops c ON o.crop_id = c.id JOIN users u ON o.buyer_id = u.id',
+     ['c.farmer_id = ?'], [1], [('o.order_date', 'order_date'), ('o.id', 'id')], 'idx_crops_farmer'),
+    ('buyer.view_my_orders',
+     'SELECT o.id, o.order_date, c.crop_name, r.id as review_id FROM orders o '
+     'JOIN crops c ON o.crop_id = c.id JOIN users u ON c.farmer_id = u.id '
+     'LEFT JOIN reviews r ON o.id = r.order_id AND r.reviewer_id = o.buyer_id',
+     ['o.buyer_id = ?'], [FARMERS + 1], [('o.order_date', 'order_date'), ('o.id', 'id')], 'idx_orders_buyer_date'),
+    ('admin_all_orders',
+     'SELECT o.id, o.order_date, o.total_price, o.order_status, c.crop_name, b.name as buyer_name, '
+     'f.name as farmer_name FROM orders o JOIN crops c ON o.crop_id = c.id JOIN users b ON o.buyer_id = b.id '
+     'JOIN users f ON c.farmer_id = f.id',
+     [], [], [('o.order_date', 'order_date'), ('o.id', 'id')], 'idx_orders_date'),
+    ('admin_farmers', 'SELECT id, name, email FROM users',
+     ["role = 'farmer'", 'deleted_at IS NULL'], [], [('id', 'id')], 'idx_users_role'),
+    ('admin_messages',
+     'SELECT m.id, m.message, m.subject, m.sent_at FROM messages m',
+     [], [], [('m.sent_at', 'sent_at'), ('m.id', 'id')], 'idx_messages_sent_at'),
+    ('main.view_user_profile',
+     'SELECT r.id, r.rating, r.comment, r.created_at, u.name as reviewer_name '
+     'FROM reviews r JOIN users u ON r.reviewer_id = u.id',
+     ['r.reviewed_user_id = ?'], [1], [('r.created_at', 'created_at'), ('r.id', 'id')],
+     'idx_reviews_reviewed_user'),
+]
+
+
+@pytest.mark.parametrize('route, query, conditions, params, keys, index', HOT_PATH_QUERIES,
+                         ids=[q[0] for q in HOT_PATH_QUERIES])
+def test_hot_path_query_uses_index(seeded, route, query, conditions, params, keys, index):
+    plan = page_plan(seeded, query, conditions, params, keys)
+    assert any(index in step for step in plan), plan
+    # Every table is reached through an index or its primary key, never scanned whole.
+    assert not [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step], plan
+
+
+def test_new_database_is_current(database):
+    conn = connect(database)
+    try:
+        assert schema_version(conn) == MIGRATIONS[-1][0]
+    finally:
+        conn.close()
@@ -0,0 +1,88 @@
+"""Mail outbox delivery against the local SMTP stand-in in smtp_stub.py."""
+import socket
+
+import pytest
+from flask import Flask
+from flask_mail import Mail, Message
+
+import outbox
+from smtp_stub import LocalSMTPServer
+
+
+def make_mail(port):
+    app = Flask(__name__)
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_USE_TLS=False, MAIL_USE_SSL=False,
+                      MAIL_USERNAME=None, MAIL_PASSWORD=None, MAIL_DEFAULT_SENDER='noreply@agrilink.test')
+    return app, Mail(app)
+
+
+@pytest.fixture
+def smtp_server():
+    server = LocalSMTPServer().start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def queue(conn, *recipients):
+    return [outbox.enqueue(conn, Message('Order update', recipients=[address], body='Your order shipped.',
+                                         sender='noreply@agrilink.test'))
+            for address in recipients]
+
+
+def status(conn, outbox_id):
+    return conn.execute("""
+        SELECT status, attempts, last_error, (julianday(next_attempt_at) - julianday('now')) * 86400 AS retry_in
+        FROM mail_outbox WHERE id = ?
+    """, (outbox_id,)).fetchone()
+
+
+def test_batch_is_delivered_over_one_connection(conn, smtp_server):
+    ids = queue(conn, 'a@example.com', 'b@example.com', 'c@example.com')
+    app, mail = make_mail(smtp_server.port)
+    with app.app_context():
+        rows = outbox.claim_batch(conn)
+        assert outbox.deliver_batch(mail, conn, rows) == 3
+    assert [recipients for _, recipients, _ in smtp_server.messages] == [
+        ['a@example.com'], ['b@example.com'], ['c@example.com']]
+    assert len(smtp_server.connections_used) == 1
+    assert [status(conn, i)['status'] for i in ids] == ['sent'] * 3
+    assert outbox.queue_depth(conn) == 0
+
+
+def test_refused_recipient_is_retried_with_backoff(conn):
+    server = LocalSMTPServer(reject_recipient='nobody').start()
+    try:
+        good, bad = queue(conn, 'a@example.com', 'nobody@example.com')
+        app, mail = make_mail(server.port)
+        with app.app_context():
+            assert outbox.deliver_batch(mail, conn, outbox.claim_batch(conn)) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert status(conn, good)['status'] == 'sent'
+    failed = status(conn, bad)
+    assert (failed['status'], failed['attempts']) == ('queued', 1)
+    assert '550' in failed['last_error']
+    assert outbox.BACKOFF_BASE * 0.8 - 2 <= failed['retry_in'] <= outbox.BACKOFF_BASE * 1.2 + 2
+    # Not due yet, so the next claim leaves it alone.
+    assert outbox.claim_batch(conn) == []
+
+
+def test_unreachable_server_fails_the_whole_batch_and_backs_off(conn):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]  # nothing listens here once the socket is closed
+    ids = queue(conn, 'a@example.com', 'b@example.com')
+    app, mail = make_mail(port)
+    with app.app_context():
+        assert outbox.deliver_batch(mail, conn, outbox.claim_batch(conn)) == 0
+    assert [(status(conn, i)['status'], status(conn, i)['attempts']) for i in ids] == [('queued', 1)] * 2
+
+    # Each further failure doubles the delay, up to BACKOFF_MAX; the last attempt gives up.
+    row = conn.execute('SELECT id, attempts FROM mail_outbox WHERE id = ?', (ids[0],)).fetchone()
+    outbox.mark_failed(conn, {'id': row['id'], 'attempts': 2}, 'timeout')
+    assert outbox.BACKOFF_BASE * 4 * 0.8 - 2 <= status(conn, ids[0])['retry_in'] <= outbox.BACKOFF_BASE * 4 * 1.2 + 2
+    outbox.mark_failed(conn, {'id': row['id'], 'attempts': outbox.MAX_ATTEMPTS - 1}, 'timeout')
+    assert (status(conn, ids[0])['status'], status(conn, ids[0])['attempts']) == ('failed', outbox.MAX_ATTEMPTS)
+    assert outbox.queue_depth(conn) == 1
@@ -0,0 +1,64 @@
+"""ETag caching: a 304 never skips a role check, and responses vary on Accept."""
+import pytest
+from flask import Flask, redirect
+from flask_login import LoginManager, UserMixin, current_user, login_user
+
+import db
+import page_cache
+
+
+class User(UserMixin):
+    def __init__(self, role):
+        self.id = role
+        self.role = role
+
+
+@pytest.fixture
+def client(database):
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY='test', DATABASE=database, DATABASE_AUTO_MIGRATE=False)
+    db.init_app(app)
+    page_cache.init_app(app)
+    login_manager = LoginManager(app)
+    login_manager.user_loader(User)
+
+    @app.route('/login/<role>')
+    def login(role):
+        login_user(User(role))
+        return 'ok'
+
+    @app.route('/listing')
+    @page_cache.cached('crops')
+    def listing():
+        return '<p>listing</p>'
+
+    @app.route('/crop')
+    @page_cache.cached('crops', role='buyer')
+    def crop():
+        if current_user.role != 'buyer':
+            return redirect('/')
+        return '<p>crop</p>'
+
+    return app.test_client()
+
+
+def test_not_modified_does_not_skip_role_check(client, monkeypatch):
+    # The tag is not secret (it hashes the readable session), so take it as known.
+    monkeypatch.setattr(page_cache, '_etag', lambda name, version: 'known')
+    etag = 'known'
+    client.get('/login/buyer')
+    assert client.get('/crop', headers={'If-None-Match': etag}).status_code == 304
+
+    client.get('/login/farmer')
+    response = client.get('/crop', headers={'If-None-Match': etag})
+    assert (response.status_code, response.location) == (302, '/')
+
+
+def test_responses_vary_on_accept(client):
+    response = client.get('/listing')
+    assert 'Accept' in response.vary
+    assert response.cache_control.public
+    etag = response.headers['ETag'].strip('"')
+    not_modified = client.get('/listing', headers={'If-None-Match': etag})
+    assert not_modified.status_code == 304 and 'Accept' in not_modified.vary
+    assert client.get('/listing', headers={'Accept': 'image/webp,*/*'}).headers['ETag'].strip('"') != etag
@@ -0,0 +1,67 @@
+"""PayChangu webhook ingestion: dedup, forward-only transitions and group commit."""
+import time
+from concurrent.futures import Future
+
+import pytest
+
+import inventory
+import payments
+
+
+@pytest.fixture
+def orders(conn):
+    conn.execute("INSERT INTO users (name, email, password, role) VALUES ('Farmer', 'f@example.com', 'x', 'farmer')")
+    conn.execute("INSERT INTO users (name, email, password, role) VALUES ('Buyer', 'b@example.com', 'x', 'buyer')")
+    conn.execute("INSERT INTO crops (farmer_id, crop_name, quantity, quantity_value, quantity_unit, price) "
+                 "VALUES (1, 'Maize', '500 kg', 500, 'kg', 100)")
+    conn.commit()
+    return [inventory.reserve(conn, 1, 2, 10, 'pickup')[0] for _ in range(3)]
+
+
+@pytest.fixture
+def committer(database):
+    return payments.GroupCommitter(database)
+
+
+def event(order_id, status='success', reference=None):
+    return payments.parse_event({'data': {'tx_ref': f'agri_order_{order_id}', 'status': status,
+                                          'reference': reference or f'ref-{order_id}-{status}'}})
+
+
+def order_status(conn, order_id):
+    conn.rollback()
+    return conn.execute('SELECT order_status FROM orders WHERE id = ?', (order_id,)).fetchone()[0]
+
+
+def test_replayed_callback_is_applied_once(conn, orders, committer):
+    assert committer.submit(event(orders[0])) == payments.APPLIED
+    assert committer.submit(event(orders[0])) == payments.DUPLICATE
+    assert order_status(conn, orders[0]) == 'paid'
+
+
+def test_late_failure_does_not_undo_payment(conn, orders, committer):
+    committer.submit(event(orders[0]))
+    assert committer.submit(event(orders[0], 'failed')) == payments.IGNORED
+    assert order_status(conn, orders[0]) == 'paid'
+
+
+@pytest.mark.parametrize('tx_ref', ['agri_order_' + '9' * 30, 'agri_order_0', 'agri_order_-4', 'agri_order_x'])
+def test_out_of_range_order_id_is_invalid(tx_ref):
+    with pytest.raises(payments.InvalidEvent):
+        payments.parse_event({'tx_ref': tx_ref, 'status': 'success'})
+
+
+def test_bad_event_fails_alone_and_writer_survives(conn, orders, committer):
+    bad = dict(event(orders[0]), transaction_id='bad', order_id=10 ** 30)  # cannot be bound as an integer
+    items = [(e, Future(), time.perf_counter()) for e in (event(orders[0]), bad, event(orders[1]))]
+    for item in items:
+        committer._queue.put(item)
+    committer._ensure_started()
+
+    assert items[0][1].result(5) == payments.APPLIED
+    with pytest.raises(OverflowError):
+        items[1][1].result(5)
+    assert items[2][1].result(5) == payments.APPLIED
+    assert committer._thread.is_alive()
+    assert committer.submit(event(orders[2]), timeout=5) == payments.APPLIED
+    assert [order_status(conn, order_id) for order_id in orders] == ['paid'] * 3
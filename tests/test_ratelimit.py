@@ -0,0 +1,33 @@
+"""Token buckets for sign-in: bursts are capped, successful sign-ins are refunded."""
+import pytest
+
+from ratelimit import MemoryStore, RateLimiter, Rule, SQLiteStore
+
+RULES = {'login_email': Rule.parse('5/300')}
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def limiter(request):
+    store = MemoryStore(300) if request.param == 'memory' else SQLiteStore(300)
+    return RateLimiter(store, RULES)
+
+
+def test_burst_then_refused(conn, limiter):
+    assert [limiter.hit(conn, 'login_email', 'a@example.com') for _ in range(5)] == [0] * 5
+    retry_after = limiter.hit(conn, 'login_email', 'a@example.com')
+    assert 0 < retry_after <= 60
+    # Other addresses have their own bucket.
+    assert limiter.hit(conn, 'login_email', 'b@example.com') == 0
+
+
+def test_successful_sign_ins_never_lock_out(conn, limiter):
+    for _ in range(20):
+        assert limiter.hit(conn, 'login_email', 'a@example.com') == 0
+        limiter.refund(conn, 'login_email', 'a@example.com')
+
+
+def test_refund_only_returns_what_was_taken(conn, limiter):
+    for _ in range(3):
+        limiter.refund(conn, 'login_email', 'a@example.com')
+    assert [limiter.hit(conn, 'login_email', 'a@example.com') for _ in range(5)] == [0] * 5
+    assert limiter.hit(conn, 'login_email', 'a@example.com') > 0
@@ -0,0 +1,64 @@
+"""Image uploads: content-addressed names, EXIF stripped before publishing."""
+import io
+import logging
+import os
+from concurrent.futures import Future
+
+import pytest
+from flask import Flask
+from werkzeug.datastructures import FileStorage
+
+import uploads
+
+Image = pytest.importorskip('PIL.Image')
+
+ORIENTATION, GPS_INFO = 0x0112, 0x8825
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config.update(UPLOAD_FOLDER=str(tmp_path / 'uploads'), IMAGE_WORKERS=1)
+    with app.app_context():
+        yield app
+    if uploads._pool is not None:
+        uploads._pool.shutdown()
+        uploads._pool = None
+
+
+def phone_photo():
+    """A 40x20 JPEG taken 'sideways', with GPS coordinates in its EXIF block."""
+    exif = Image.Exif()
+    exif[ORIENTATION] = 6  # rotate 90 degrees clockwise to display
+    exif[GPS_INFO] = {1: 'S', 2: (13.0, 57.0, 44.0), 3: 'E', 4: (33.0, 47.0, 13.0)}
+    buffer = io.BytesIO()
+    Image.new('RGB', (40, 20), (200, 30, 30)).save(buffer, 'JPEG', exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+def test_exif_is_stripped_before_the_file_is_published(app):
+    body = phone_photo()
+    filename = uploads.save_image(FileStorage(io.BytesIO(body)), app.config['UPLOAD_FOLDER'])
+    with Image.open(os.path.join(app.config['UPLOAD_FOLDER'], filename)) as stored:
+        assert not stored.info.get('exif')
+        assert stored.size == (20, 40)  # the rotation was applied before the EXIF went
+    # Named after the upload as received, so the same photo is still stored once.
+    assert uploads.save_image(FileStorage(io.BytesIO(body)), app.config['UPLOAD_FOLDER']) == filename
+    assert [name for name in os.listdir(app.config['UPLOAD_FOLDER']) if not name.startswith(('.', 'thumbs'))] \
+        == [filename]
+
+
+def test_unreadable_image_is_rejected_and_not_stored(app):
+    with pytest.raises(uploads.InvalidImage):
+        uploads.save_image(FileStorage(io.BytesIO(b'\xff\xd8\xff' + b'not really a jpeg' * 10)),
+                           app.config['UPLOAD_FOLDER'])
+    assert os.listdir(app.config['UPLOAD_FOLDER']) == []
+
+
+def test_failed_render_is_logged(app, caplog):
+    future = Future()
+    future.set_exception(OSError('truncated file'))
+    with caplog.at_level(logging.ERROR):
+        uploads._log_failure(logging.getLogger('agrilink-test'), 'abc.jpg', future)
+    assert 'Rendering thumbnails for abc.jpg failed' in caplog.text
+    assert 'truncated file' in caplog.text
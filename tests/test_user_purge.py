@@ -0,0 +1,51 @@
+"""Purging a deleted farmer keeps other buyers' orders and what they sent."""
+import json
+
+import pytest
+
+from user_purge import purge_user
+
+FARMER, BUYER = 1, 2
+
+
+@pytest.fixture
+def farmer(conn):
+    conn.execute("INSERT INTO users (name, email, password, role) VALUES ('Farmer', 'f@example.com', 'x', 'farmer')")
+    conn.execute("INSERT INTO users (name, email, password, role) VALUES ('Buyer', 'b@example.com', 'x', 'buyer')")
+    conn.execute("INSERT INTO crops (farmer_id, crop_name, quantity, price) VALUES (?, 'Maize', '0 kg', 150)", (FARMER,))
+    conn.execute("INSERT INTO crops (farmer_id, crop_name, quantity, price) VALUES (?, 'Soya', '10 kg', 90)", (FARMER,))
+    conn.execute("INSERT INTO orders (buyer_id, crop_id, quantity, total_price, delivery_option, order_status) "
+                 "VALUES (?, 1, 500, 75000, 'pickup', 'delivered')", (BUYER,))
+    conn.execute("INSERT INTO reviews (order_id, reviewer_id, reviewed_user_id, rating, comment) "
+                 "VALUES (1, ?, ?, 5, 'Good maize')", (BUYER, FARMER))
+    conn.execute("INSERT INTO messages (sender_id, receiver_id, subject, message) VALUES (?, ?, 'Hi', 'To farmer')",
+                 (BUYER, FARMER))
+    conn.execute("INSERT INTO messages (sender_id, receiver_id, subject, message) VALUES (?, ?, 'Hi', 'To buyer')",
+                 (FARMER, BUYER))
+    conn.execute('UPDATE users SET deleted_at = CURRENT_TIMESTAMP WHERE id = ?', (FARMER,))
+    conn.commit()
+    return FARMER
+
+
+def archived(conn, table):
+    return [json.loads(data) for (data,) in conn.execute(
+        'SELECT data FROM orphaned_rows WHERE table_name = ? ORDER BY id', (table,))]
+
+
+def test_purge_archives_other_buyers_orders(conn, farmer, tmp_path):
+    purge_user(conn, farmer, str(tmp_path), pause=0)
+
+    assert conn.execute('SELECT COUNT(*) FROM users WHERE id = ?', (farmer,)).fetchone()[0] == 0
+    assert conn.execute('SELECT COUNT(*) FROM crops').fetchone()[0] == 0
+    [order] = archived(conn, 'orders')
+    assert (order['buyer_id'], order['total_price'], order['order_status']) == (BUYER, 75000, 'delivered')
+    [review] = archived(conn, 'reviews')
+    assert (review['order_id'], review['reviewer_id'], review['comment']) == (1, BUYER, 'Good maize')
+    assert conn.execute('PRAGMA foreign_key_check').fetchall() == []
+
+
+def test_purge_keeps_messages_the_user_sent(conn, farmer, tmp_path):
+    purge_user(conn, farmer, str(tmp_path), pause=0)
+
+    assert [tuple(row) for row in conn.execute('SELECT sender_id, receiver_id, message FROM messages')] == [
+        (None, BUYER, 'To buyer')]
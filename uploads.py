@@ -0,0 +1,259 @@
+"""Image uploads for crops, demands and profile pictures.
+
+``save_image()`` streams an upload to disk while hashing it and names the file
+after its SHA-256 digest, so two uploads can never overwrite each other and
+the same photo uploaded twice is stored once. Before the file is moved into
+the public upload folder its EXIF block (phone photos carry GPS coordinates)
+is stripped in the worker pool; resized WebP and JPEG thumbnails are then
+rendered there in the background. Templates ask for a size with
+``image_url(filename, 'sm')`` and fall back to the original until the
+thumbnails exist.
+
+Pillow is optional: without it uploads are still stored and deduplicated, but
+no thumbnails are made and the original is published as uploaded, EXIF and
+all.
+
+Usage: python uploads.py [upload_folder]   (render missing thumbnails)
+"""
+import functools
+import hashlib
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from flask import current_app, request, url_for
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # thumbnails are skipped
+    Image = ImageOps = None
+
+CHUNK_SIZE = 64 * 1024
+THUMB_DIR = 'thumbs'
+# size name -> longest edge in pixels
+SIZES = {'sm': 320, 'md': 640, 'lg': 1280}
+WEBP_QUALITY = 75
+JPEG_QUALITY = 80
+IMAGE_WORKERS = 2
+STRIP_TIMEOUT = 30  # seconds an upload waits for its EXIF to be stripped
+
+# Leading bytes of the formats we accept -> extension stored on disk.
+_SIGNATURES = [
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+]
+_HASHED_NAME = re.compile(r'^[0-9a-f]{32}\.(jpg|png|gif|webp)$')
+
+_pool = None
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def _sniff_extension(head):
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    for signature, extension in _SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    return None
+
+
+def save_image(file_storage, upload_folder):
+    """Store an uploaded image and queue its thumbnails. Returns the stored filename.
+
+    Raises InvalidImage if the upload is not a JPEG, PNG, GIF or WebP file.
+    """
+    os.makedirs(upload_folder, exist_ok=True)
+    stream = file_storage.stream
+    head = stream.read(CHUNK_SIZE)
+    extension = _sniff_extension(head)
+    if extension is None:
+        raise InvalidImage('Please upload a JPEG, PNG, GIF or WebP image.')
+
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=upload_folder, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            chunk = head
+            while chunk:
+                digest.update(chunk)
+                out.write(chunk)
+                chunk = stream.read(CHUNK_SIZE)
+        filename = digest.hexdigest()[:32] + extension
+        path = os.path.join(upload_folder, filename)
+        if os.path.exists(path):
+            os.remove(temp_path)  # already stored
+        else:
+            if Image is not None:
+                try:
+                    _get_pool().submit(strip_metadata, temp_path).result(STRIP_TIMEOUT)
+                except TimeoutError:
+                    raise InvalidImage('Images are taking long to process right now. Please try again shortly.')
+                except (OSError, ValueError, SyntaxError):  # PIL raises these for unreadable files
+                    raise InvalidImage('This image could not be read. Please upload another one.')
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    if Image is not None and not _thumbnails_exist(upload_folder, filename):
+        future = _get_pool().submit(render_thumbnails, upload_folder, filename)
+        future.add_done_callback(functools.partial(_log_failure, current_app.logger, filename))
+    return filename
+
+
+def _log_failure(logger, filename, future):
+    error = future.exception()
+    if error is not None:
+        logger.error('Rendering thumbnails for %s failed', filename, exc_info=error)
+
+
+def thumbnail_name(filename, size, extension):
+    return f"{os.path.splitext(filename)[0]}_{size}{extension}"
+
+
+def _thumbnails_exist(upload_folder, filename):
+    return os.path.exists(os.path.join(upload_folder, THUMB_DIR, thumbnail_name(filename, 'lg', '.jpg')))
+
+
+def _save_atomic(image, path, format, **options):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.thumb-')
+    os.close(fd)
+    try:
+        image.save(temp_path, format, **options)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def strip_metadata(path):
+    """Worker process: re-save the image at ``path`` without its EXIF block. Returns True if it had one.
+
+    Animated images are left as they are; re-saving would drop their frames.
+    """
+    with Image.open(path) as original:
+        if not original.info.get('exif') or getattr(original, 'is_animated', False):
+            return False
+        source_format = original.format
+        # Apply the rotation the EXIF block asked for before dropping it.
+        image = ImageOps.exif_transpose(original)
+        options = {'quality': 90} if source_format in ('JPEG', 'WEBP') else {}
+        _save_atomic(image, path, source_format, **options)
+    return True
+
+
+def render_thumbnails(upload_folder, filename):
+    """Worker process: write every size of an upload as WebP and JPEG."""
+    path = os.path.join(upload_folder, filename)
+    thumb_dir = os.path.join(upload_folder, THUMB_DIR)
+    os.makedirs(thumb_dir, exist_ok=True)
+    # Uploads stored before EXIF was stripped on arrival still carry it.
+    strip_metadata(path)
+    with Image.open(path) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        for size, edge in SIZES.items():
+            thumb = image.copy()
+            thumb.thumbnail((edge, edge), Image.LANCZOS)
+            _save_atomic(thumb, os.path.join(thumb_dir, thumbnail_name(filename, size, '.webp')),
+                         'WEBP', quality=WEBP_QUALITY, method=4)
+            if thumb.mode == 'RGBA':
+                background = Image.new('RGB', thumb.size, (255, 255, 255))
+                background.paste(thumb, mask=thumb.getchannel('A'))
+                thumb = background
+            _save_atomic(thumb, os.path.join(thumb_dir, thumbnail_name(filename, size, '.jpg')),
+                         'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return filename
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # spawn, not fork: the web process runs background threads.
+        workers = current_app.config.get('IMAGE_WORKERS', IMAGE_WORKERS)
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def discard(conn, upload_folder, filename):
+    """Delete a stored image and its thumbnails once no crop, demand or user refers to it.
+
+    Call after the row that used it has been updated.
+    """
+    if not filename or not _HASHED_NAME.match(filename):
+        return False  # never touch files the pipeline did not create
+    in_use = conn.execute("""
+        SELECT 1 FROM crops WHERE image = ?1
+        UNION ALL SELECT 1 FROM demands WHERE image = ?1
+        UNION ALL SELECT 1 FROM users WHERE profile_pic = ?1
+        LIMIT 1
+    """, (filename,)).fetchone()
+    if in_use:
+        return False
+    paths = [os.path.join(upload_folder, filename)]
+    for size in SIZES:
+        for extension in ('.webp', '.jpg'):
+            paths.append(os.path.join(upload_folder, THUMB_DIR, thumbnail_name(filename, size, extension)))
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return True
+
+
+def accepts_webp():
+    # Only an explicit image/webp counts; plain */* also comes from browsers without WebP.
+    return bool(request) and any(value == 'image/webp' for value, _ in request.accept_mimetypes)
+
+
+def image_url(filename, size='md', default=None):
+    """URL of the best stored rendition of ``filename`` for ``size`` ('sm', 'md' or 'lg').
+
+    Serves WebP to browsers that accept it, JPEG otherwise, and the original
+    upload while the thumbnails are still being rendered. ``default`` is a
+    path under static/ used when there is no image.
+    """
+    if not filename:
+        return url_for('static', filename=default) if default else ''
+    if size in SIZES:
+        extension = '.webp' if accepts_webp() else '.jpg'
+        name = thumbnail_name(filename, size, extension)
+        if os.path.exists(os.path.join(current_app.config['UPLOAD_FOLDER'], THUMB_DIR, name)):
+            return url_for('static', filename=f'uploads/{THUMB_DIR}/{name}')
+    return url_for('static', filename='uploads/' + filename)
+
+
+def init_app(app):
+    app.config.setdefault('IMAGE_WORKERS', IMAGE_WORKERS)
+    app.add_template_global(image_url)
+
+
+if __name__ == '__main__':
+    if Image is None:
+        sys.exit('Pillow is not installed; run pip install Pillow first.')
+    folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join('static', 'uploads')
+    pending = [name for name in sorted(os.listdir(folder))
+               if os.path.isfile(os.path.join(folder, name)) and not name.startswith('.')
+               and not _thumbnails_exist(folder, name)]
+    failed = 0
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        futures = {pool.submit(render_thumbnails, folder, name): name for name in pending}
+        for future, name in futures.items():
+            try:
+                future.result()
+            except (OSError, ValueError) as e:  # PIL raises these for unreadable files
+                failed += 1
+                print(f"Skipped {name}: {e}")
+    print(f"Rendered thumbnails for {len(pending) - failed} images.")
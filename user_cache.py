@@ -0,0 +1,106 @@
+"""In-process cache of logged-in users for Flask-Login's user_loader.
+
+Every authenticated request used to re-read its user row. ``UserCache`` keeps
+recently seen users in an LRU with a short TTL. Routes that change a user
+call ``invalidate()``, which drops the local entry and appends the id to
+``user_invalidations`` so other worker processes drop theirs too; each
+process polls that table at most once every ``INVALIDATION_POLL`` seconds.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from models import User
+
+USER_CACHE_SIZE = 2048
+USER_CACHE_TTL = 300  # seconds
+INVALIDATION_POLL = 2  # seconds
+# Invalidations older than this can no longer matter: every entry cached
+# before them has expired.
+INVALIDATION_RETENTION = USER_CACHE_TTL * 2
+
+
+class UserCache:
+
+    def __init__(self, max_entries=USER_CACHE_SIZE, ttl=USER_CACHE_TTL, poll_interval=INVALIDATION_POLL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self._entries = OrderedDict()  # user id -> (User, expires_at)
+        self._lock = threading.Lock()
+        self._last_event = None
+        self._next_poll = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, conn, user_id):
+        """Return the User for ``user_id`` (an int or the session's string), or None."""
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        self._sync(conn)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        row = conn.execute('SELECT id, email, name, role FROM users WHERE id = ? AND deleted_at IS NULL', (user_id,)).fetchone()
+        if row is None:
+            return None
+        user = User(row['id'], row['email'], row['name'], row['role'])
+        with self._lock:
+            self._entries[user_id] = (user, now + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, conn, user_id):
+        """Forget ``user_id`` here and in every other worker. Commits."""
+        self._forget(int(user_id))
+        conn.execute('INSERT INTO user_invalidations (user_id) VALUES (?)', (int(user_id),))
+        conn.execute("DELETE FROM user_invalidations WHERE created_at < datetime('now', ?)",
+                     (f'-{INVALIDATION_RETENTION} seconds',))
+        conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _forget(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def _sync(self, conn):
+        """Apply invalidations published by other processes since the last poll."""
+        now = time.monotonic()
+        if now < self._next_poll:
+            return
+        self._next_poll = now + self.poll_interval
+        if self._last_event is None:
+            # Nothing is cached yet, so only later events matter.
+            self._last_event = conn.execute('SELECT COALESCE(MAX(id), 0) FROM user_invalidations').fetchone()[0]
+            return
+        rows = conn.execute('SELECT id, user_id FROM user_invalidations WHERE id > ? ORDER BY id',
+                            (self._last_event,)).fetchall()
+        for event_id, user_id in rows:
+            self._forget(user_id)
+            self._last_event = event_id
+
+
+def invalidate(conn, user_id):
+    current_app.extensions['user_cache'].invalidate(conn, user_id)
+
+
+def init_app(app):
+    app.config.setdefault('USER_CACHE_SIZE', USER_CACHE_SIZE)
+    app.config.setdefault('USER_CACHE_TTL', USER_CACHE_TTL)
+    cache = UserCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+    app.extensions['user_cache'] = cache
+    return cache
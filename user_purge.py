@@ -0,0 +1,181 @@
+"""Background removal of deleted accounts.
+
+``admin_delete_user`` only marks the user ``deleted_at`` (one UPDATE), which
+signs them out and hides them from login and the admin lists straight away.
+``PurgeWorker`` then deletes what belongs to them a ``PURGE_BATCH`` of rows
+per transaction, pausing between transactions so request writes get the
+lock, and removes their uploaded images once nothing else refers to them.
+The user row goes last; the ON DELETE rules (migrations.FOREIGN_KEY_ACTIONS)
+guarantee nothing points at it afterwards.
+
+Other buyers' orders on the user's listings are their purchase history, so
+they are not deleted: they move, with their reviews, to ``orphaned_rows``
+(the archive migration 18 set up) before anything else. That leaves the
+listings without orders, which RESTRICT requires before they go. Only the
+messages the user received are deleted; those they sent leave with their
+conversations or have ``sender_id`` set NULL with the user row. Each step is
+repeated until it finds nothing, so rows created while a purge is running
+(an order on a listing not yet removed) are caught too.
+
+Usage: python user_purge.py [path/to/agrilink.db] [upload_folder]   (purge now)
+"""
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import inventory
+import migrations
+import uploads
+from db import connect
+
+PURGE_BATCH = 50  # rows per transaction; a listing with its matches takes up to ~2 ms to delete
+BATCH_PAUSE = 0.05  # seconds between transactions
+IDLE_POLL = 60
+
+_wakeup = threading.Event()
+
+# (table, query for up to ?2 ids of user ?1's rows, image column or None, archive instead of delete)
+STEPS = [
+    ('orders', 'SELECT o.id FROM crops c JOIN orders o ON o.crop_id = c.id '
+               'WHERE c.farmer_id = ?1 AND o.buyer_id != ?1 LIMIT ?2', None, True),
+    ('reviews', 'SELECT id FROM reviews WHERE reviewer_id = ?1 '
+                'UNION ALL SELECT id FROM reviews WHERE reviewed_user_id = ?1 LIMIT ?2', None, False),
+    ('messages', 'SELECT id FROM messages WHERE receiver_id = ?1 LIMIT ?2', None, False),
+    ('conversations', 'SELECT id FROM conversations WHERE user_low = ?1 '
+                      'UNION ALL SELECT id FROM conversations WHERE user_high = ?1 LIMIT ?2', None, False),
+    ('orders', 'SELECT id FROM orders WHERE buyer_id = ?1 LIMIT ?2', None, False),
+    ('demands', 'SELECT id, image FROM demands WHERE buyer_id = ?1 LIMIT ?2', 'image', False),
+    ('crops', 'SELECT id, image FROM crops WHERE farmer_id = ?1 LIMIT ?2', 'image', False),
+]
+
+
+def wake():
+    _wakeup.set()
+
+
+def pending(conn):
+    """Ids of deleted users not purged yet, oldest deletion first."""
+    return [row[0] for row in conn.execute(
+        'SELECT id FROM users WHERE deleted_at IS NOT NULL ORDER BY deleted_at, id')]
+
+
+def _release_reservations(conn, user_id):
+    # A deleted buyer's unpaid orders give their stock back before they go.
+    for (order_id,) in conn.execute("SELECT id FROM orders WHERE buyer_id = ? AND order_status = 'pending'",
+                                    (user_id,)).fetchall():
+        inventory.release(conn, order_id, 'cancelled')
+
+
+def _delete_batch(conn, table, ids, archive=False):
+    marks = ', '.join('?' * len(ids))
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if archive:
+            # Reviews would go with the orders (ON DELETE CASCADE); keep them alongside.
+            migrations.archive(conn, 'reviews', f'order_id IN ({marks})', ids)
+            migrations.archive(conn, table, f'id IN ({marks})', ids)
+        else:
+            conn.execute(f"DELETE FROM {table} WHERE id IN ({marks})", ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def purge_user(conn, user_id, upload_folder, batch=PURGE_BATCH, pause=BATCH_PAUSE):
+    """Delete (or archive) everything of soft-deleted ``user_id``, then the user. Returns rows removed."""
+    _release_reservations(conn, user_id)
+    deleted = 0
+    for table, query, image_column, archive in STEPS:
+        while True:
+            rows = conn.execute(query, (user_id, batch)).fetchall()
+            if conn.in_transaction:
+                conn.rollback()
+            if not rows:
+                break
+            _delete_batch(conn, table, [row['id'] for row in rows], archive)
+            deleted += len(rows)
+            if image_column:
+                for image in {row[image_column] for row in rows}:
+                    uploads.discard(conn, upload_folder, image)
+            time.sleep(pause)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        user = conn.execute('SELECT profile_pic FROM users WHERE id = ? AND deleted_at IS NOT NULL',
+                            (user_id,)).fetchone()
+        if user is None:
+            conn.rollback()
+            return deleted
+        # Anything created since its step ran cascades here rather than being left behind.
+        conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    uploads.discard(conn, upload_folder, user['profile_pic'])
+    return deleted + 1
+
+
+class PurgeWorker:
+    """A background thread purging deleted users for one Flask app."""
+
+    def __init__(self, app):
+        self.app = app
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='user-purge', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        _wakeup.set()
+
+    def run_once(self, conn):
+        purged = 0
+        for user_id in pending(conn):
+            if self._stop.is_set():
+                break
+            try:
+                rows = purge_user(conn, user_id, self.app.config['UPLOAD_FOLDER'])
+            except sqlite3.IntegrityError:
+                # Typically an order placed on a listing between two steps; the next round gets it.
+                self.app.logger.warning('Purge of user %s hit a constraint; will retry', user_id, exc_info=True)
+                continue
+            self.app.logger.info('Purged deleted user %s (%d rows)', user_id, rows)
+            purged += 1
+        return purged
+
+    def _run(self):
+        conn = connect(self.app.config['DATABASE'])
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    self.run_once(conn)
+                except sqlite3.Error:
+                    self.app.logger.exception('User purge failed')
+                _wakeup.wait(IDLE_POLL)
+                _wakeup.clear()
+        conn.close()
+
+
+def init_app(app):
+    app.config.setdefault('USER_PURGE_ENABLED', True)
+    worker = PurgeWorker(app)
+    app.extensions['user_purge'] = worker
+    if app.config['USER_PURGE_ENABLED']:
+        worker.start()
+    return worker
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else 'agrilink.db'
+    folder = sys.argv[2] if len(sys.argv) > 2 else os.path.join('static', 'uploads')
+    conn = connect(database)
+    users = pending(conn)
+    rows = sum(purge_user(conn, user_id, folder, pause=0) for user_id in users)
+    conn.close()
+    print(f"Purged {len(users)} deleted users ({rows} rows).")